@@ -1,4 +1,5 @@
 from . import engine
+from . import properties
 from . import ui
 
 
@@ -26,6 +27,7 @@ def check_for_taichi():
 
 def register():
     check_for_taichi()
+    properties.register()
     engine.register()
     ui.register()
 
@@ -33,3 +35,4 @@ def register():
 def unregister():
     engine.unregister()
     ui.unregister()
+    properties.unregister()
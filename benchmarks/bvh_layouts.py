@@ -0,0 +1,141 @@
+''' Compares the mesh acceleration structure layouts on a big mesh:
+    the linear triangle loop, the binary BVH and the compressed 4 wide BVH.
+    Reports build time, bytes per triangle and rays/s on the Taichi CPU backend.
+
+    usage: python -m benchmarks.bvh_layouts [--triangles N] [--rays N] [--linear-rays N]
+'''
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import taichi as ti
+
+from export.scene import Scene
+from render import bvh, instance, mesh
+from render.ray import Ray
+from . import scenes
+
+
+LAYOUTS = ('LINEAR', 'BVH2', 'BVH4')
+
+# arrays making up the acceleration structure for each layout
+LAYOUT_ARRAYS = {
+    'LINEAR': (),
+    'BVH2': ('bvh_box_min', 'bvh_box_max', 'bvh_child_or_first', 'bvh_prim_count', 'bvh_tri_indices'),
+    'BVH4': ('wide_origin', 'wide_exponent', 'wide_child_base', 'wide_tri_base', 'wide_q_min', 'wide_q_max',
+             'wide_child_offset', 'wide_child_count', 'bvh_tri_indices'),
+}
+
+
+def accel_bytes(meshes):
+    ''' Size of the mesh acceleration structure arrays '''
+    return sum(getattr(meshes, name).nbytes for name in LAYOUT_ARRAYS[meshes.bvh_layout])
+
+
+def make_rays(count, center, radius, seed=0):
+    ''' Rays from a sphere around the mesh aimed at random points inside it '''
+    rng = np.random.default_rng(seed)
+    origins = rng.normal(size=(count, 3))
+    origins = center + 3.0 * radius * origins / np.linalg.norm(origins, axis=1)[:, None]
+    targets = center + rng.uniform(-radius, radius, (count, 3))
+    return origins.astype(np.float32), (targets - origins).astype(np.float32)
+
+
+ray_origins = None
+ray_dirs = None
+ray_hits = None
+
+
+@ti.kernel
+def trace_rays() -> ti.i32:
+    hits = 0
+    for i in ray_origins:
+        r = Ray(orig=ray_origins[i], dir=ray_dirs[i].normalized(), time=0.0)
+        hit, rec, mat_id = instance.hit(r, 0.001, 99999999.9)
+        ray_hits[i] = rec.t if hit else -1.0
+        if hit:
+            hits += 1
+    return hits
+
+
+def run_layout(layout, triangles, num_rays, max_rays, results):
+    ''' Exports and traces rays against the big mesh scene in one layout (run in its own process
+        since the layout is compiled into the kernels)
+    '''
+    global ray_origins, ray_dirs, ray_hits
+    ti.init(arch=ti.cpu, random_seed=0)
+
+    depsgraph = scenes.big_mesh(triangles)
+    t = time.time()
+    scene = Scene(depsgraph, (64, 64), layout)
+    build_time = time.time() - t
+    bvh.set_stack_size(max(scene.meshes.stack_size, scene.instances.stack_size))
+    mesh.setup_data(scene.meshes)
+    instance.setup_data(scene.instances)
+
+    # every layout traces the same rays (a prefix of them for the linear loop)
+    origins, dirs = make_rays(max_rays, np.array([0.0, 0.0, 1.2]), 1.0)
+    origins, dirs = origins[:num_rays], dirs[:num_rays]
+    ray_origins = ti.Vector.field(3, dtype=ti.f32, shape=num_rays)
+    ray_dirs = ti.Vector.field(3, dtype=ti.f32, shape=num_rays)
+    ray_hits = ti.field(dtype=ti.f32, shape=num_rays)
+    ray_origins.from_numpy(origins)
+    ray_dirs.from_numpy(dirs)
+
+    # first call compiles
+    t = time.time()
+    trace_rays()
+    compile_time = time.time() - t
+
+    t = time.time()
+    hits = trace_rays()
+    trace_time = time.time() - t
+
+    results.put({
+        'layout': layout,
+        'triangles': int(scene.meshes.tri_count),
+        'nodes': int(scene.meshes.node_count),
+        'build_s': build_time,
+        'compile_s': compile_time,
+        'bytes_per_tri': accel_bytes(scene.meshes) / scene.meshes.tri_count,
+        'rays': num_rays,
+        'hits': hits,
+        'rays_per_s': num_rays / trace_time,
+        't': ray_hits.to_numpy(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--triangles', type=int, default=1000000)
+    parser.add_argument('--rays', type=int, default=100000)
+    parser.add_argument('--linear-rays', type=int, default=256, help='rays for the (slow) linear loop')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for layout in LAYOUTS:
+        queue = context.Queue()
+        num_rays = args.linear_rays if layout == 'LINEAR' else args.rays
+        process = context.Process(target=run_layout, args=(layout, args.triangles, num_rays, args.rays, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    print('{:8} {:>10} {:>10} {:>10} {:>14} {:>12}'.format('layout', 'tris', 'nodes', 'build s',
+                                                            'bytes / tri', 'rays / s'))
+    for r in results:
+        print('{layout:8} {triangles:10d} {nodes:10d} {build_s:10.2f} {bytes_per_tri:14.2f} {rays_per_s:12.0f}'
+              .format(**r))
+
+    # all layouts should find exactly the same hits
+    reference = results[1]['t']
+    for r in results:
+        n = min(len(r['t']), len(reference))
+        if not np.array_equal(r['t'][:n], reference[:n]):
+            print('WARNING: {} hits differ from BVH2'.format(r['layout']))
+
+
+if __name__ == '__main__':
+    main()
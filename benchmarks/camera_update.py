@@ -0,0 +1,156 @@
+''' Times moving the camera of the Cornell box like orbiting the viewport, from the camera moving to the first
+    pixels (a sample for every pixel). Compares uploading just the camera against exporting and setting up the
+    scene again, and checks the image after orbiting matches the image of a render set up with the last camera.
+    Then orbits with the viewport thread, timing the move to its first low resolution image, and checks the image
+    it refines to once every pixel has its samples matches rendering them in this thread.
+    Runs on the Taichi CPU backend. First checks that cameras given a viewport region's projection, perspective
+    and orthographic, have the rays of that projection.
+
+    usage: python -m benchmarks.camera_update [--resolution N] [--steps N] [--bounces N] [--samples N]
+'''
+import argparse
+import math
+import time
+
+import numpy as np
+import taichi as ti
+
+from export.camera import Camera
+from export.scene import Scene
+from render import render, viewport
+from . import scenes
+
+
+def perspective_projection(angle, near=0.01, far=100.0):
+    ''' A square viewport region's projection matrix of a perspective view with a field of view of angle '''
+    f = 1.0 / math.tan(angle / 2.0)
+    return [[f, 0.0, 0.0, 0.0], [0.0, f, 0.0, 0.0],
+            [0.0, 0.0, (far + near) / (near - far), 2.0 * far * near / (near - far)], [0.0, 0.0, -1.0, 0.0]]
+
+
+def orthographic_projection(half_width, far=100.0):
+    ''' A square viewport region's projection matrix of an orthographic view, clipping like Blender's
+        from far / 2 behind the view to far / 2 in front of it
+    '''
+    return [[1.0 / half_width, 0.0, 0.0, 0.0], [0.0, 1.0 / half_width, 0.0, 0.0],
+            [0.0, 0.0, -2.0 / far, 0.0], [0.0, 0.0, 0.0, 1.0]]
+
+
+def camera_ray(camera, s, t):
+    ''' The (origin, direction) of the ray render.camera makes for an exported camera at s, t '''
+    origin = camera.origin + s * camera.origin_horizontal + t * camera.origin_vertical
+    return origin, camera.lower_left_corner + s * camera.horizontal + t * camera.vertical - camera.origin
+
+
+def check_projections(resolution, angle):
+    ''' Prints how far the rays of cameras made from viewport projections are from the rays they should have '''
+    matrix = np.array(orbit_matrix(1, 4))
+    eye, u, v, w = matrix[:3, 3], matrix[:3, 0], matrix[:3, 1], matrix[:3, 2]
+    corners = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (1.0, 1.0), (0.5, 0.5)]
+
+    reference = Camera(None, resolution, resolution, matrix, angle)
+    camera = Camera(None, resolution, resolution, matrix, projection=perspective_projection(angle))
+    error = 0.0
+    for s, t in corners:
+        origin, direction = camera_ray(camera, s, t)
+        reference_origin, reference_direction = camera_ray(reference, s, t)
+        error = max(error, np.abs(origin - reference_origin).max(), np.abs(direction - reference_direction).max())
+    print('max difference of perspective projection rays {:.2g}'.format(error))
+
+    # parallel rays along the view from a square 2 * half_width wide centered on the view's eye point
+    half_width = 3.0
+    camera = Camera(None, resolution, resolution, matrix, projection=orthographic_projection(half_width))
+    error = 0.0
+    for s, t in corners:
+        origin, direction = camera_ray(camera, s, t)
+        offset = origin - eye
+        expected = ((2.0 * s - 1.0) * half_width, (2.0 * t - 1.0) * half_width)
+        error = max(error, abs(offset.dot(u) - expected[0]), abs(offset.dot(v) - expected[1]),
+                    np.abs(direction / np.linalg.norm(direction) + w).max())
+    print('max difference of orthographic projection rays {:.2g}'.format(error))
+
+
+def first_pixels(resolution):
+    ''' Renders passes until every pixel has a sample, returns the image '''
+    samples_done = 0
+    while samples_done < resolution * resolution:
+        samples_done += render.render_pass()
+    return render.get_buffer()
+
+
+def orbit_matrix(step, steps):
+    ''' The camera matrix of a step of a half orbit around the box '''
+    angle = math.pi * (step / steps - 0.5)
+    return scenes.look_at_matrix([3.5 * math.sin(angle), -3.5 * math.cos(angle), 1.0], [0.0, 0.0, 1.0])
+
+
+def setup(depsgraph, resolution, bounces, matrix, samples=1024):
+    depsgraph.scene.camera.matrix_world = matrix
+    scene = Scene(depsgraph, (resolution, resolution))
+    render.setup_render(scene, resolution, resolution, samples, bounces, arch=ti.cpu)
+    return first_pixels(resolution)
+
+
+def orbit_thread(depsgraph, resolution, bounces, steps, samples):
+    ''' Orbits with the viewport thread, returns the seconds to each move's first image and the final image '''
+    angle = depsgraph.scene.camera.data.angle
+    setup(depsgraph, resolution, bounces, orbit_matrix(0, steps), samples)
+    renderer = viewport.ViewportRenderer(resolution, resolution)
+    renderer.start()
+    latencies = []
+    for step in range(1, steps + 1):
+        renderer.set_camera(Camera(None, resolution, resolution, orbit_matrix(step, steps), angle))
+        while renderer.latency is None:
+            time.sleep(0.001)
+        latencies.append(renderer.latency)
+        renderer.latency = None
+    while renderer.rendering:
+        time.sleep(0.01)
+    renderer.stop()
+    image, version = renderer.get_image()
+    return latencies, image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--bounces', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=16, help="samples the viewport thread refines to")
+    args = parser.parse_args()
+
+    depsgraph = scenes.cornell_box()
+    angle = depsgraph.scene.camera.data.angle
+    check_projections(args.resolution, angle)
+    # the first set up compiles the kernels
+    setup(depsgraph, args.resolution, args.bounces, orbit_matrix(0, args.steps))
+
+    t = time.time()
+    setup(depsgraph, args.resolution, args.bounces, orbit_matrix(0, args.steps))
+    setup_seconds = time.time() - t
+
+    latencies = []
+    for step in range(1, args.steps + 1):
+        t = time.time()
+        render.update_camera(Camera(None, args.resolution, args.resolution, orbit_matrix(step, args.steps), angle))
+        image = first_pixels(args.resolution)
+        latencies.append(time.time() - t)
+
+    reference = setup(depsgraph, args.resolution, args.bounces, orbit_matrix(args.steps, args.steps))
+    print('export and set up again {:10.1f} ms'.format(setup_seconds * 1000))
+    print('camera update mean      {:10.1f} ms'.format(np.mean(latencies) * 1000))
+    print('camera update max       {:10.1f} ms'.format(np.max(latencies) * 1000))
+    print('max difference from set up at the last camera {:.2g}'.format(np.abs(image - reference).max()))
+
+    latencies, image = orbit_thread(depsgraph, args.resolution, args.bounces, args.steps, args.samples)
+    setup(depsgraph, args.resolution, args.bounces, orbit_matrix(args.steps, args.steps), args.samples)
+    while render.get_finished_pixels() < args.resolution * args.resolution:
+        render.render_pass()
+    reference = render.get_buffer()
+    print('thread first image mean {:10.1f} ms'.format(np.mean(latencies) * 1000))
+    print('thread first image max  {:10.1f} ms'.format(np.max(latencies) * 1000))
+    print('max difference of the thread\'s final image {:.2g}'.format(np.abs(image - reference).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import time
+
+import taichi as ti
+
+from render import render
+
+
+# The render loop of the benchmarks that render the stand-in scenes,
+# kept out of scenes.py so the benchmarks that only export don't import Taichi
+
+
+# the scenes the render benchmarks render
+RENDER_SCENES = ('cornell_box', 'scatter', 'big_mesh')
+
+
+@ti.kernel
+def count_active() -> ti.i32:
+    ''' Number of pixels that will trace a ray in the next pass '''
+    active = 0
+    for i, j in render.sample_count:
+        if render.is_rendering(i, j):
+            active += 1
+    return active
+
+
+def render_to_completion(exported_scene, resolution, samples, bounces, **settings):
+    ''' Sets up the exported scene on the Taichi CPU backend with the other setup_render settings, compiles the
+        kernels with a first pass and starts again, then renders until every pixel has its samples.
+        Returns the rays traced (one per pixel still rendering each pass, shadow rays aren't counted),
+        the samples and the seconds of the passes
+    '''
+    render.setup_render(exported_scene, resolution, resolution, samples, bounces, arch=ti.cpu, **settings)
+    render.render_pass()
+    count_active()
+    render.reset_accumulation()
+
+    rays = completed = 0
+    seconds = 0.0
+    while render.get_finished_pixels() < resolution * resolution:
+        rays += count_active()
+        t = time.time()
+        completed += render.render_pass()
+        seconds += time.time() - t
+    return rays, completed, seconds
@@ -0,0 +1,71 @@
+''' Measures the denoiser on the Cornell box against a high sample reference.
+    For each sample count reports the render and denoise seconds, the RMS error and relative mean squared error
+    (squared error over the squared reference, so the few pixels around the light don't outweigh the rest of
+    the image) before and after denoising, and the samples the noisy render would need for the same relative
+    error (it falls as 1 / samples). Runs on the Taichi CPU backend.
+
+    usage: python -m benchmarks.denoise [--resolution N] [--samples N [N ...]] [--reference-samples N]
+                                        [--bounces N] [--iterations N]
+'''
+import argparse
+import time
+
+import numpy as np
+
+from export.scene import Scene
+from render import render
+from . import common, scenes
+
+
+def render_image(scene, resolution, samples, bounces):
+    ''' Renders the scene with the denoiser set up, returns the (pixels, 4) image and the seconds after compiling '''
+    _, _, seconds = common.render_to_completion(scene, resolution, samples, bounces, denoising=True)
+    return render.get_buffer(), seconds
+
+
+def denoise_image(resolution, iterations):
+    ''' Denoises the rendered image, returns the (pixels, 4) image and the seconds after compiling '''
+    render.store_denoise_tile()
+    render.denoise_image(iterations)
+    # the denoiser filters in place, so store the image again to time it
+    render.store_denoise_tile()
+    t = time.time()
+    render.denoise_image(iterations)
+    seconds = time.time() - t
+    return render.get_denoised_tile(0, 0, resolution, resolution).reshape(-1, 4), seconds
+
+
+def relative_error(image, reference):
+    ''' Mean squared error of each pixel over its squared reference luminance '''
+    return np.mean(np.mean((image - reference) ** 2, axis=1) / (np.mean(reference, axis=1) ** 2 + 0.01))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--samples', type=int, nargs='+', default=[16, 32])
+    parser.add_argument('--reference-samples', type=int, default=2048)
+    parser.add_argument('--bounces', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=3)
+    args = parser.parse_args()
+
+    scene = Scene(scenes.cornell_box(), (args.resolution, args.resolution))
+    reference, seconds = render_image(scene, args.resolution, args.reference_samples, args.bounces)
+    reference = reference[:, :3]
+    print('reference {} samples in {:.1f}s'.format(args.reference_samples, seconds))
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'samples', 'render', 'denoise', 'rms', 'denoised', 'rel mse', 'denoised', 'equal noise'))
+    for samples in args.samples:
+        image, render_seconds = render_image(scene, args.resolution, samples, args.bounces)
+        denoised, denoise_seconds = denoise_image(args.resolution, args.iterations)
+        noisy_relative = relative_error(image[:, :3], reference)
+        denoised_relative = relative_error(denoised[:, :3], reference)
+        print('{:8} {:9.3f}s {:9.3f}s {:10.4f} {:10.4f} {:10.4f} {:10.4f} {:8.0f} spp'.format(
+            samples, render_seconds, denoise_seconds, np.sqrt(np.mean((image[:, :3] - reference) ** 2)),
+            np.sqrt(np.mean((denoised[:, :3] - reference) ** 2)), noisy_relative, denoised_relative,
+            samples * noisy_relative / denoised_relative))
+
+
+if __name__ == '__main__':
+    main()
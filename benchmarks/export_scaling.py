@@ -0,0 +1,56 @@
+''' Times exporting scenes of more and more objects to check export time grows linearly.
+    Each object has its own small mesh and an instance, so the time per object should stay flat.
+    With --shared the objects are linked duplicates of one mesh, which is only exported once.
+    Fails if the time grows faster than count ** --max-exponent from the smallest to the largest count.
+
+    usage: python -m benchmarks.export_scaling [--counts 250 500 1000 ...] [--layout BVH2] [--shared] [--max-exponent 1.5]
+'''
+import argparse
+import math
+import time
+
+from export.scene import Scene
+from . import scenes
+
+
+def time_export(count, bvh_layout, shared):
+    ''' Returns the seconds to export a scene with count objects and the exported scene '''
+    depsgraph = scenes.many_objects(count, shared=shared)
+    t = time.time()
+    scene = Scene(depsgraph, (64, 64), bvh_layout)
+    return time.time() - t, scene
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000, 8000])
+    parser.add_argument('--layout', default='BVH2', choices=['LINEAR', 'BVH2', 'BVH4'])
+    parser.add_argument('--shared', action='store_true', help='objects share one mesh datablock')
+    parser.add_argument('--max-exponent', type=float, default=1.5,
+                        help='highest growth of the time with the count that passes, 1 is linear and 2 quadratic')
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>14} {:>8} {:>10} {:>14}'.format('objects', 'export s', 'us / object', 'ratio',
+                                                          'tris', 'object tris'))
+    first = None
+    times = []
+    for count in args.counts:
+        seconds, scene = time_export(count, args.layout, args.shared)
+        times.append(seconds)
+        per_object = seconds / count
+        first = first or per_object
+        print('{:8d} {:10.3f} {:14.1f} {:8.2f} {:10d} {:14d}'.format(
+            count, seconds, per_object * 1e6, per_object / first, scene.meshes.tri_count,
+            scene.meshes.object_tri_count))
+
+    # the exponent of count the time grows with, from the smallest to the largest scene
+    counts = sorted(zip(args.counts, times))
+    if counts[-1][0] > counts[0][0]:
+        exponent = math.log(counts[-1][1] / counts[0][1]) / math.log(counts[-1][0] / counts[0][0])
+        print('time grows with objects ** {:.2f}'.format(exponent))
+        if exponent > args.max_exponent:
+            raise SystemExit('FAIL: export time grows faster than objects ** {}'.format(args.max_exponent))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+''' Compares rendering with and without light sampling on the Cornell box.
+    Renders a reference with light sampling, then measures the RMS error against it and the render time of each
+    integrator and reports the time each needs to reach the same noise (error falls as 1 / sqrt(time)).
+    Runs on the Taichi CPU backend.
+
+    usage: python -m benchmarks.light_sampling [--resolution N] [--samples N] [--reference-samples N] [--bounces N]
+'''
+import argparse
+
+import numpy as np
+
+from export.scene import Scene
+from render import render
+from . import common, scenes
+
+
+def render_image(scene, resolution, samples, bounces, light_sampling):
+    ''' Renders the scene, returns the (pixels, 4) image and the seconds it took after compiling '''
+    _, _, seconds = common.render_to_completion(scene, resolution, samples, bounces, light_sampling=light_sampling)
+    return render.get_buffer(), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=64)
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--reference-samples', type=int, default=4096)
+    parser.add_argument('--bounces', type=int, default=4)
+    args = parser.parse_args()
+
+    scene = Scene(scenes.cornell_box(), (args.resolution, args.resolution))
+    reference, seconds = render_image(scene, args.resolution, args.reference_samples, args.bounces, True)
+    print('reference {} samples in {:.1f}s'.format(args.reference_samples, seconds))
+
+    results = {}
+    print('{:16} {:>10} {:>10}'.format('light sampling', 'seconds', 'rms error'))
+    for light_sampling in (False, True):
+        image, seconds = render_image(scene, args.resolution, args.samples, args.bounces, light_sampling)
+        error = np.sqrt(np.mean((image[:, :3] - reference[:, :3]) ** 2))
+        results[light_sampling] = (seconds, error)
+        print('{:16} {:10.3f} {:10.4f}'.format(str(light_sampling), seconds, error))
+
+    # time to reach the error of light sampling
+    seconds, error = results[False]
+    target = results[True][1]
+    equal_noise = seconds * (error / target) ** 2
+    print('without light sampling reaches the same error in {:.3f}s, {:.1f}x the time'.format(
+        equal_noise, equal_noise / results[True][0]))
+
+
+if __name__ == '__main__':
+    main()
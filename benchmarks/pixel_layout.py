@@ -0,0 +1,47 @@
+''' Compares laying the per pixel render state out in whole columns against square blocks of pixels on the
+    stand-in scenes. Reports rays/s (one ray per pixel still rendering each pass) and samples/s on the Taichi CPU
+    backend, and checks each layout renders the same image as the first.
+    Run a single layout with --blocks under `perf stat -e cache-references,cache-misses` to see its cache misses.
+
+    usage: python -m benchmarks.pixel_layout [--resolution N] [--samples N] [--bounces N] [--threads N]
+                                             [--scenes NAME [NAME ...]] [--blocks N [N ...]]
+'''
+import argparse
+
+import numpy as np
+
+from export.scene import Scene
+from render import render
+from . import common, scenes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--bounces', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=0, help="CPU threads, 0 uses every core")
+    parser.add_argument('--scenes', nargs='+', choices=common.RENDER_SCENES, default=list(common.RENDER_SCENES))
+    parser.add_argument('--blocks', type=int, nargs='+', default=[0, 4, 8, 16],
+                        help="pixels per side of the blocks of each layout, 0 lays out columns")
+    args = parser.parse_args()
+
+    print('{:12} {:>6} {:>10} {:>12} {:>12} {:>8}'.format('scene', 'block', 'seconds', 'rays / s', 'samples / s',
+                                                          'max diff'))
+    for name in args.scenes:
+        scene = Scene(scenes.SCENES[name](), (args.resolution, args.resolution))
+        reference = None
+        for pixel_block in args.blocks:
+            rays, completed, seconds = common.render_to_completion(scene, args.resolution, args.samples,
+                                                                   args.bounces, seed=0, cpu_threads=args.threads,
+                                                                   pixel_block=pixel_block)
+            image = render.get_buffer()
+            if reference is None:
+                reference = image
+            print('{:12} {:>6} {:10.2f} {:12.0f} {:12.0f} {:8.2g}'.format(
+                name, pixel_block or 'column', seconds, rays / seconds, completed / seconds,
+                np.abs(image - reference).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+''' Compares the megakernel and wavefront render modes on the stand-in scenes.
+    Reports rays/s (one ray per pixel still rendering each pass) and samples/s on the Taichi CPU backend.
+
+    usage: python -m benchmarks.render_modes [--resolution N] [--samples N] [--bounces N]
+'''
+import argparse
+
+from export.scene import Scene
+from . import common, scenes
+
+
+MODES = ('MEGAKERNEL', 'WAVEFRONT')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--bounces', type=int, default=8)
+    args = parser.parse_args()
+
+    print('{:12} {:12} {:>10} {:>12} {:>12}'.format('scene', 'mode', 'seconds', 'rays / s', 'samples / s'))
+    for name in common.RENDER_SCENES:
+        scene = Scene(scenes.SCENES[name](), (args.resolution, args.resolution))
+        for mode in MODES:
+            rays, completed, seconds = common.render_to_completion(scene, args.resolution, args.samples,
+                                                                   args.bounces, render_mode=mode)
+            print('{:12} {:12} {:10.3f} {:12.0f} {:12.0f}'.format(name, mode, seconds, rays / seconds,
+                                                                   completed / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+''' Compares uniform and cosine weighted hemisphere sampling, with and without Russian roulette, on the Cornell box
+    at a high bounce count. Renders a reference, then reports each setting's path rays/s (one ray per pixel still
+    rendering each pass, shadow rays aren't counted), samples/s, mean path length, RMS error against the reference
+    and the time it needs to reach the noise of the first setting (error falls as 1 / sqrt(time)).
+    Runs on the Taichi CPU backend.
+
+    usage: python -m benchmarks.roulette [--resolution N] [--samples N] [--reference-samples N] [--bounces N]
+                                         [--roulette-depth N]
+'''
+import argparse
+
+import numpy as np
+
+from export.scene import Scene
+from render import render, material
+from . import common, scenes
+
+
+def render_image(scene, resolution, samples, bounces, cosine_sampling, roulette_depth):
+    ''' Renders the scene, returns the (pixels, 4) image, the rays traced, samples and seconds after compiling '''
+    material.COSINE_SAMPLING = cosine_sampling
+    rays, completed, seconds = common.render_to_completion(scene, resolution, samples, bounces,
+                                                           roulette_depth=roulette_depth)
+    return render.get_buffer(), rays, completed, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=32)
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--reference-samples', type=int, default=1024)
+    parser.add_argument('--bounces', type=int, default=32)
+    parser.add_argument('--roulette-depth', type=int, default=3)
+    args = parser.parse_args()
+
+    # (name, cosine sampling, roulette depth)
+    settings = [('uniform', False, 0),
+                ('cosine', True, 0),
+                ('cosine+roulette', True, args.roulette_depth)]
+
+    scene = Scene(scenes.cornell_box(), (args.resolution, args.resolution))
+    reference, _, _, seconds = render_image(scene, args.resolution, args.reference_samples, args.bounces, True,
+                                            args.roulette_depth)
+    reference = reference[:, :3]
+    print('reference {} samples in {:.1f}s'.format(args.reference_samples, seconds))
+
+    print('{:16} {:>10} {:>12} {:>12} {:>8} {:>10} {:>12}'.format(
+        'sampling', 'seconds', 'rays / s', 'samples / s', 'length', 'rms error', 'equal noise'))
+    target = None
+    for name, cosine_sampling, roulette_depth in settings:
+        image, rays, completed, seconds = render_image(scene, args.resolution, args.samples, args.bounces,
+                                                       cosine_sampling, roulette_depth)
+        error = np.sqrt(np.mean((image[:, :3] - reference) ** 2))
+        if target is None:
+            target = error
+        print('{:16} {:10.3f} {:12.0f} {:12.0f} {:8.2f} {:10.4f} {:11.3f}s'.format(
+            name, seconds, rays / seconds, completed / seconds, rays / completed, error,
+            seconds * (error / target) ** 2))
+
+
+if __name__ == '__main__':
+    main()
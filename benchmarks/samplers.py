@@ -0,0 +1,71 @@
+''' Compares the error of the random and Sobol samplers as the samples per pixel go up.
+    Renders a high sample reference of the Cornell box, then renders with each sampler keeping each pixel's
+    mean at every power of 2 samples, and reports the RMS error against the reference at each count and the
+    rate the error falls at (-0.5 for plain Monte Carlo). Runs on the Taichi CPU backend.
+
+    usage: python -m benchmarks.samplers [--resolution N] [--samples N] [--reference-samples N] [--bounces N]
+'''
+import argparse
+import math
+import time
+
+import numpy as np
+import taichi as ti
+
+from export.scene import Scene
+from render import render
+from . import common, scenes
+
+
+SAMPLERS = ('RANDOM', 'SOBOL')
+
+
+def render_checkpoints(scene, resolution, samples, bounces, sampler_type):
+    ''' Renders the scene, returns the (checkpoints, pixels, 3) images at every power of 2 samples '''
+    render.setup_render(scene, resolution, resolution, samples, bounces, sampler_type=sampler_type, arch=ti.cpu)
+    checkpoints = [2 ** k for k in range(int(math.log2(samples)) + 1)]
+    images = ti.Vector.field(3, dtype=ti.f32, shape=(len(checkpoints), resolution, resolution))
+
+    @ti.kernel
+    def keep_checkpoints():
+        # a pixel gets at most one sample a pass so it is at each count for at least one pass
+        for k, i, j in images:
+            if render.sample_count[i, j] == (1 << k):
+                color = render.pixel_buffer[i, j] / render.sample_count[i, j]
+                images[k, i, j] = ti.Vector([color.x, color.y, color.z])
+
+    while render.get_finished_pixels() < resolution * resolution:
+        render.render_pass()
+        keep_checkpoints()
+    return checkpoints, images.to_numpy().swapaxes(1, 2).reshape(len(checkpoints), -1, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=32)
+    parser.add_argument('--samples', type=int, default=256)
+    parser.add_argument('--reference-samples', type=int, default=4096)
+    parser.add_argument('--bounces', type=int, default=4)
+    args = parser.parse_args()
+
+    scene = Scene(scenes.cornell_box(), (args.resolution, args.resolution))
+    t = time.time()
+    common.render_to_completion(scene, args.resolution, args.reference_samples, args.bounces)
+    reference = render.get_buffer()[:, :3]
+    print('reference {} samples in {:.1f}s'.format(args.reference_samples, time.time() - t))
+
+    errors = {}
+    for sampler_type in SAMPLERS:
+        checkpoints, images = render_checkpoints(scene, args.resolution, args.samples, args.bounces, sampler_type)
+        errors[sampler_type] = np.sqrt(np.mean((images - reference) ** 2, axis=(1, 2)))
+
+    print('{:>8}'.format('samples') + ''.join('{:>10}'.format(name) for name in SAMPLERS))
+    for k, samples in enumerate(checkpoints):
+        print('{:8}'.format(samples) + ''.join('{:10.4f}'.format(errors[name][k]) for name in SAMPLERS))
+    # slope of log error against log samples
+    rates = [np.polyfit(np.log(checkpoints), np.log(errors[name]), 1)[0] for name in SAMPLERS]
+    print('{:>8}'.format('rate') + ''.join('{:10.2f}'.format(rate) for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+''' Times applying depsgraph updates to an exported scene in place against exporting it again.
+    Reports the bytes uploaded for each kind of update on the Taichi CPU backend.
+    Each update is applied twice, the first time includes compiling the kernels that copy rows to fields.
+
+    usage: python -m benchmarks.scene_sync [--instances N] [--resolution N]
+'''
+import argparse
+import time
+
+import numpy as np
+import taichi as ti
+
+from export.scene import Scene
+from render import render
+from . import scenes
+
+
+def full_upload_bytes(scene):
+    ''' Size of all the arrays uploaded by a full setup of the scene '''
+    meshes = sum(getattr(scene.meshes, name).nbytes for name in render.mesh.fields)
+    instances = sum(array.nbytes for array in scene.instances.get_arrays().values())
+    materials = scene.materials.color.nbytes + scene.materials.emission_color.nbytes + \
+        scene.materials.pass_index.nbytes
+    lights = sum(array.nbytes for array in scene.lights.get_arrays().values())
+    return meshes + instances + materials + lights
+
+
+def move_instance(depsgraph):
+    ''' Moves one sphere instance '''
+    inst = depsgraph.object_instances[len(depsgraph.object_instances) // 2]
+    inst.matrix_world = inst.matrix_world.copy()
+    inst.matrix_world[:3, 3] += [0.5, 0.0, 0.0]
+    return [scenes.StandInUpdate(inst.object, transform=True)]
+
+
+def edit_mesh(depsgraph):
+    ''' Grows the sphere mesh keeping its topology, its instances' bounds grow with it '''
+    obj = depsgraph.objects[0]
+    verts = obj.data.verts * np.array([1.1, 1.1, 1.1], dtype=np.float32)
+    obj.data = scenes.StandInMesh(obj.data.name_full, verts, obj.data.loop_triangles.attributes['vertices'])
+    return [scenes.StandInUpdate(obj, geometry=True)]
+
+
+def edit_material(depsgraph):
+    ''' Changes the color of the sphere material '''
+    material = depsgraph.objects[0].material_slots[0].material
+    material.diffuse_color = [0.2, 0.4, 0.8, 1.0]
+    return [scenes.StandInUpdate(material, shading=True)]
+
+
+EDITS = {
+    'move instance': move_instance,
+    'edit mesh': edit_mesh,
+    'edit material': edit_material,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, default=20000)
+    parser.add_argument('--resolution', type=int, default=128)
+    args = parser.parse_args()
+    resolution = (args.resolution, args.resolution)
+
+    depsgraph = scenes.scatter(args.instances, sphere_rings=32)
+    t = time.time()
+    scene = Scene(depsgraph, resolution)
+    render.setup_render(scene, *resolution, 16, 4, arch=ti.cpu)
+    render.render_pass()
+    full_time = time.time() - t
+    full_bytes = full_upload_bytes(scene)
+
+    print('{:16} {:>10} {:>14}'.format('update', 'time s', 'uploaded bytes'))
+    print('{:16} {:10.3f} {:14d}'.format('full export', full_time, full_bytes))
+    for name, edit in EDITS.items():
+        for _ in range(2):
+            old_bounds = scene.instances.box_max
+            depsgraph.updates = edit(depsgraph)
+            t = time.time()
+            if scene.sync(depsgraph):
+                label = name
+                uploaded = render.update_render(scene)
+            else:
+                label = name + ' (full)'
+                scene = Scene(depsgraph, resolution)
+                render.setup_render(scene, *resolution, 16, 4, arch=ti.cpu)
+                uploaded = full_upload_bytes(scene)
+            render.render_pass()
+            print('{:16} {:10.3f} {:14d}'.format(label, time.time() - t, uploaded))
+            # the uploaded instance bounds have to match the edited scene or rays miss what grew
+            uploaded_bounds = render.instance.instance_data.box_max.to_numpy()
+            if not np.array_equal(uploaded_bounds, scene.instances.box_max):
+                print('  instance bounds are out of date after', name)
+            elif edit is edit_mesh and np.array_equal(uploaded_bounds, old_bounds):
+                print('  instance bounds didn\'t grow with the mesh')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+import numpy as np
+import math
+
+
+# Stand-ins for the parts of the Blender API the exporters use,
+# so scenes can be exported and rendered without Blender
+
+
+class StandInCollection:
+    ''' A bpy collection (vertices, loop_triangles) backed by numpy arrays '''
+    def __init__(self, length, **attributes):
+        self.length = length
+        self.attributes = attributes
+
+    def __len__(self):
+        return self.length
+
+    def foreach_get(self, name, data):
+        data[:] = self.attributes[name].ravel()
+
+
+class StandInMesh:
+    ''' Mesh data with vertices and triangles '''
+    def __init__(self, name, verts, tris, material_index=None):
+        verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+        tris = np.asarray(tris, dtype=np.uint32).reshape(-1, 3)
+        if material_index is None:
+            material_index = np.zeros(len(tris), dtype=np.uint32)
+
+        self.name_full = name
+        self.id_type = 'MESH'
+        self.original = self
+        self.verts = verts
+        self.vertices = StandInCollection(len(verts), co=verts)
+        self.loop_triangles = StandInCollection(len(tris), vertices=tris,
+                                                material_index=np.asarray(material_index, dtype=np.uint32))
+        # every triangle is its own polygon
+        self.loops = StandInCollection(tris.size, vertex_index=tris)
+        self.polygons = StandInCollection(len(tris), loop_total=np.full(len(tris), 3),
+                                          material_index=np.asarray(material_index, dtype=np.uint32))
+
+    def calc_loop_triangles(self):
+        pass
+
+
+class StandInMaterialSlot:
+    def __init__(self, material):
+        self.material = material
+        self.link = 'DATA'
+
+
+class StandInObject:
+    ''' A mesh object, with the local bound box Blender would compute '''
+    def __init__(self, name, mesh, materials=(), matrix=None):
+        self.name_full = name
+        self.id_type = 'OBJECT'
+        self.type = 'MESH'
+        self.data = mesh
+        self.original = self
+        self.modifiers = []
+        self.pass_index = 0
+        self.material_slots = [StandInMaterialSlot(m) for m in materials]
+        self.matrix_world = np.eye(4, dtype=np.float32) if matrix is None else np.asarray(matrix, dtype=np.float32)
+
+    @property
+    def bound_box(self):
+        # follows edits of the mesh like the bound box of an evaluated object
+        if len(self.data.verts) > 0:
+            lo, hi = self.data.verts.min(axis=0), self.data.verts.max(axis=0)
+        else:
+            lo, hi = np.zeros(3), np.zeros(3)
+        return [[(hi if i & 4 else lo)[0], (hi if i & 2 else lo)[1], (hi if i & 1 else lo)[2]] for i in range(8)]
+
+
+class StandInInstance:
+    ''' A depsgraph object instance '''
+    def __init__(self, obj, matrix=None):
+        self.object = obj
+        self.matrix_world = obj.matrix_world if matrix is None else np.asarray(matrix, dtype=np.float32)
+
+
+class StandInSocket:
+    def __init__(self, default_value=None, links=()):
+        self.default_value = default_value
+        self.links = list(links)
+
+
+class StandInLink:
+    def __init__(self, from_node):
+        self.from_node = from_node
+
+
+class StandInNode:
+    def __init__(self, bl_idname, inputs):
+        self.bl_idname = bl_idname
+        self.inputs = inputs
+
+
+class StandInNodeTree:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+
+class StandInMaterial:
+    ''' A material with a diffuse color, and an emission node tree if emissive '''
+    def __init__(self, name, color, emission_color=None, emission_strength=1.0):
+        self.name_full = name
+        self.id_type = 'MATERIAL'
+        self.diffuse_color = list(color)
+        self.pass_index = 0
+        self.node_tree = None
+        if emission_color is not None:
+            emission = StandInNode('ShaderNodeEmission', {'Color': StandInSocket(list(emission_color)),
+                                                          'Strength': StandInSocket(emission_strength)})
+            output = StandInNode('ShaderNodeOutputMaterial',
+                                 {'Surface': StandInSocket(links=[StandInLink(emission)])})
+            self.node_tree = StandInNodeTree([output, emission])
+
+
+class StandInCameraData:
+    def __init__(self, angle):
+        self.angle = angle
+
+
+class StandInCamera:
+    def __init__(self, matrix, angle=0.69):
+        self.name_full = 'Camera'
+        self.id_type = 'OBJECT'
+        self.type = 'CAMERA'
+        self.data = StandInCameraData(angle)
+        self.matrix_world = np.asarray(matrix, dtype=np.float32)
+
+
+class StandInScene:
+    def __init__(self, camera):
+        self.name_full = 'Scene'
+        self.id_type = 'SCENE'
+        self.camera = camera
+
+
+class StandInDepsgraph:
+    ''' The depsgraph of a scene, objects and their instances '''
+    def __init__(self, objects, instances, camera):
+        self.objects = objects
+        self.object_instances = instances
+        self.scene = StandInScene(camera)
+        self.updates = []
+
+
+class StandInUpdate:
+    ''' A depsgraph update of a datablock '''
+    def __init__(self, datablock, transform=False, geometry=False, shading=False):
+        self.id = datablock
+        self.is_updated_transform = transform
+        self.is_updated_geometry = geometry
+        self.is_updated_shading = shading
+
+
+# geometry
+
+
+def quad(corner, edge_u, edge_v):
+    ''' Returns verts, tris of a quad '''
+    corner, edge_u, edge_v = (np.asarray(v, dtype=np.float32) for v in (corner, edge_u, edge_v))
+    verts = [corner, corner + edge_u, corner + edge_u + edge_v, corner + edge_v]
+    return np.array(verts), np.array([[0, 1, 2], [0, 2, 3]])
+
+
+def uv_sphere(rings, radius=1.0, center=(0.0, 0.0, 0.0)):
+    ''' Returns verts, tris of a sphere with 4 * rings^2 triangles '''
+    theta = np.linspace(0.0, math.pi, rings + 1)[:, None]
+    phi = np.linspace(0.0, math.tau, 2 * rings, endpoint=False)[None, :]
+    verts = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi),
+                      np.cos(theta) * np.ones_like(phi)], axis=-1).reshape(-1, 3)
+    verts = verts * radius + np.asarray(center)
+
+    i, j = np.meshgrid(np.arange(rings), np.arange(2 * rings), indexing='ij')
+    a = i * 2 * rings + j
+    b = i * 2 * rings + (j + 1) % (2 * rings)
+    c, d = a + 2 * rings, b + 2 * rings
+    tris = np.concatenate([np.stack([a, b, d], axis=-1), np.stack([a, d, c], axis=-1)], axis=-1)
+    return verts.astype(np.float32), tris.reshape(-1, 3)
+
+
+def look_at_matrix(origin, target):
+    ''' Camera to world matrix looking down -z at target with z up '''
+    origin, target = np.asarray(origin, dtype=np.float64), np.asarray(target, dtype=np.float64)
+    w = origin - target
+    w /= np.linalg.norm(w)
+    u = np.cross([0.0, 0.0, 1.0], w)
+    u /= np.linalg.norm(u)
+    v = np.cross(w, u)
+    matrix = np.eye(4, dtype=np.float32)
+    matrix[:3, 0], matrix[:3, 1], matrix[:3, 2], matrix[:3, 3] = u, v, w, origin
+    return matrix
+
+
+# scenes
+
+
+def cornell_box(sphere_rings=32):
+    ''' Cornell box with an area light and a sphere '''
+    white = StandInMaterial('white', [0.8, 0.8, 0.8, 1.0])
+    red = StandInMaterial('red', [0.8, 0.1, 0.1, 1.0])
+    green = StandInMaterial('green', [0.1, 0.8, 0.1, 1.0])
+    light = StandInMaterial('light', [0.0, 0.0, 0.0, 1.0], [1.0, 1.0, 1.0, 1.0], 10.0)
+
+    parts = [
+        ('floor', quad([-1, -1, 0], [2, 0, 0], [0, 2, 0]), white),
+        ('ceiling', quad([-1, -1, 2], [0, 2, 0], [2, 0, 0]), white),
+        ('back', quad([-1, 1, 0], [2, 0, 0], [0, 0, 2]), white),
+        ('left', quad([-1, -1, 0], [0, 2, 0], [0, 0, 2]), red),
+        ('right', quad([1, -1, 0], [0, 0, 2], [0, 2, 0]), green),
+        ('light', quad([-0.25, -0.25, 1.99], [0, 0.5, 0], [0.5, 0, 0]), light),
+        ('sphere', uv_sphere(sphere_rings, 0.4, (0.2, 0.2, 0.4)), white),
+    ]
+    objects = [StandInObject(name, StandInMesh(name, *geometry), [material])
+               for name, geometry, material in parts]
+    camera = StandInCamera(look_at_matrix([0.0, -3.5, 1.0], [0.0, 0.0, 1.0]))
+    return StandInDepsgraph(objects, [StandInInstance(obj) for obj in objects], camera)
+
+
+def scatter(count=2000, sphere_rings=8, seed=0):
+    ''' Many randomly placed and scaled instances of one sphere under a large light '''
+    rng = np.random.default_rng(seed)
+    white = StandInMaterial('white', [0.8, 0.8, 0.8, 1.0])
+    light = StandInMaterial('light', [0.0, 0.0, 0.0, 1.0], [1.0, 1.0, 1.0, 1.0], 2.0)
+
+    sphere = StandInObject('sphere', StandInMesh('sphere', *uv_sphere(sphere_rings, 0.3)), [white])
+    lamp = StandInObject('lamp', StandInMesh('lamp', *quad([-50, -50, 20], [0, 100, 0], [100, 0, 0])), [light])
+    floor = StandInObject('floor', StandInMesh('floor', *quad([-50, -50, 0], [100, 0, 0], [0, 100, 0])), [white])
+
+    instances = [StandInInstance(lamp), StandInInstance(floor)]
+    for i in range(count):
+        matrix = np.eye(4, dtype=np.float32)
+        matrix[:3, :3] *= rng.uniform(0.5, 2.0)
+        matrix[:3, 3] = [rng.uniform(-20, 20), rng.uniform(-20, 20), rng.uniform(0.5, 5)]
+        instances.append(StandInInstance(sphere, matrix))
+
+    camera = StandInCamera(look_at_matrix([0.0, -40.0, 10.0], [0.0, 0.0, 1.0]))
+    return StandInDepsgraph([sphere, lamp, floor], instances, camera)
+
+
+def big_mesh(triangles=1000000, seed=0):
+    ''' A single bumpy sphere with about the given number of triangles, on a floor under a light '''
+    rings = max(int(math.sqrt(triangles / 4.0)), 2)
+    verts, tris = uv_sphere(rings, 1.0, (0.0, 0.0, 1.2))
+    rng = np.random.default_rng(seed)
+    verts = verts + rng.normal(scale=0.2 / rings, size=verts.shape).astype(np.float32)
+
+    white = StandInMaterial('white', [0.8, 0.8, 0.8, 1.0])
+    light = StandInMaterial('light', [0.0, 0.0, 0.0, 1.0], [1.0, 1.0, 1.0, 1.0], 5.0)
+    objects = [
+        StandInObject('mesh', StandInMesh('mesh', verts, tris), [white]),
+        StandInObject('floor', StandInMesh('floor', *quad([-5, -5, 0], [10, 0, 0], [0, 10, 0])), [white]),
+        StandInObject('light', StandInMesh('light', *quad([-1, -1, 4], [0, 2, 0], [2, 0, 0])), [light]),
+    ]
+    camera = StandInCamera(look_at_matrix([0.0, -4.0, 1.5], [0.0, 0.0, 1.2]))
+    return StandInDepsgraph(objects, [StandInInstance(obj) for obj in objects], camera)
+
+
+def many_objects(count=1000, sphere_rings=4, shared=False, seed=0):
+    ''' Many separate objects, each with its own small mesh or all linked duplicates of one mesh '''
+    rng = np.random.default_rng(seed)
+    white = StandInMaterial('white', [0.8, 0.8, 0.8, 1.0])
+    verts, tris = uv_sphere(sphere_rings, 0.3)
+    shared_mesh = StandInMesh('sphere', verts, tris)
+
+    objects = []
+    for i in range(count):
+        matrix = np.eye(4, dtype=np.float32)
+        matrix[:3, 3] = rng.uniform(-20, 20, 3)
+        name = 'object.{:06d}'.format(i)
+        mesh = shared_mesh if shared else StandInMesh(name, verts, tris)
+        objects.append(StandInObject(name, mesh, [white], matrix))
+
+    camera = StandInCamera(look_at_matrix([0.0, -40.0, 10.0], [0.0, 0.0, 0.0]))
+    return StandInDepsgraph(objects, [StandInInstance(obj) for obj in objects], camera)
+
+
+SCENES = {
+    'cornell_box': cornell_box,
+    'scatter': scatter,
+    'big_mesh': big_mesh,
+    'many_objects': many_objects,
+}
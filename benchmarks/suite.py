@@ -0,0 +1,101 @@
+''' Benchmark suite for regression tracking. Exports the stand-in Cornell box, a scatter of many instances and a
+    mesh of a million triangles, and renders each on the Taichi CPU backend with fixed seeds. Writes the export,
+    setup (allocating and copying the scene to fields), kernel compile, load (the rest of the first pass: tracing
+    the kernels, loading them from the offline cache and running the pass) and render seconds, rays/s (one ray per
+    pixel still rendering each pass, shadow rays aren't counted) and samples/s of each scene as JSON.
+    With --baseline, also prints how rays/s changed from an earlier run's JSON. Taichi's offline cache keeps
+    compiled kernels between runs, so compile seconds are close to 0 when they're loaded from it, and only
+    comparable between runs with --no-offline-cache.
+
+    usage: python -m benchmarks.suite [-o OUTPUT] [--baseline JSON] [--scenes NAME [NAME ...]] [--resolution N]
+                                      [--samples N] [--bounces N] [--mode {MEGAKERNEL,WAVEFRONT}]
+                                      [--no-offline-cache]
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import taichi as ti
+
+from export.scene import Scene
+from render import stats
+from . import common, scenes
+
+
+def run_scene(name, resolution, samples, bounces, mode, offline_cache=True):
+    ''' Exports and renders a scene to completion, returns a dict of its timings and counts '''
+    depsgraph = scenes.SCENES[name]()
+    t = time.time()
+    scene = Scene(depsgraph, (resolution, resolution))
+    export_seconds = time.time() - t
+
+    rays, completed, seconds = common.render_to_completion(scene, resolution, samples, bounces, render_mode=mode,
+                                                           seed=0, offline_cache=offline_cache)
+    return {
+        'triangles': int(scene.meshes.tri_count),
+        'instances': int(scene.instances.instance_count),
+        'light_triangles': int(scene.lights.light_count),
+        'export_seconds': export_seconds,
+        'setup_seconds': stats.seconds['upload'],
+        # the first pass compiles the kernels, or loads them from the offline cache
+        'compile_seconds': stats.seconds['compile'],
+        'load_seconds': stats.seconds['load'],
+        'render_seconds': seconds,
+        'rays': rays,
+        'samples': completed,
+        'rays_per_second': rays / seconds,
+        'samples_per_second': completed / seconds,
+    }
+
+
+def compare(results, baseline):
+    ''' Prints the change in rays/s of each scene from the baseline results '''
+    for name, result in results['scenes'].items():
+        if name in baseline['scenes']:
+            ratio = result['rays_per_second'] / baseline['scenes'][name]['rays_per_second']
+            print('{:12} rays / s {:12.0f} baseline {:12.0f} {:+7.1f}%'.format(
+                name, result['rays_per_second'], baseline['scenes'][name]['rays_per_second'], (ratio - 1) * 100),
+                file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help="JSON file to write, defaults to printing it")
+    parser.add_argument('--baseline', help="JSON of an earlier run to compare to")
+    parser.add_argument('--scenes', nargs='+', choices=common.RENDER_SCENES, default=list(common.RENDER_SCENES))
+    parser.add_argument('--resolution', type=int, default=64)
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--bounces', type=int, default=4)
+    parser.add_argument('--mode', choices=['MEGAKERNEL', 'WAVEFRONT'], default='MEGAKERNEL')
+    parser.add_argument('--no-offline-cache', action='store_true', help="compile every kernel from scratch")
+    args = parser.parse_args()
+
+    results = {
+        'settings': {'resolution': args.resolution, 'samples': args.samples, 'bounces': args.bounces,
+                     'mode': args.mode, 'arch': 'cpu', 'offline_cache': not args.no_offline_cache},
+        'system': {'python': platform.python_version(), 'taichi': '.'.join(map(str, ti.__version__)),
+                   'platform': platform.platform(), 'processor': platform.processor(), 'cores': os.cpu_count()},
+        'scenes': {},
+    }
+    for name in args.scenes:
+        results['scenes'][name] = run_scene(name, args.resolution, args.samples, args.bounces,
+                                            args.mode, not args.no_offline_cache)
+        print('{:12} {:10.0f} rays / s'.format(name, results['scenes'][name]['rays_per_second']), file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
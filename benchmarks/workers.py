@@ -0,0 +1,58 @@
+''' Measures splitting the samples of a render over local worker processes, on a bundle of the Cornell box.
+    For each worker count reports the wall seconds (including starting the workers and compiling), the seconds
+    of the slowest worker's rendering after compiling, samples/s, the speedup and scaling efficiency
+    (speedup / workers) of the rendering over one worker, and the largest difference of the merged image from the
+    image of one worker. The workers share the CPU cores, so efficiency can't go above what the cores allow.
+
+    usage: python -m benchmarks.workers [--resolution N] [--samples N] [--bounces N] [--workers N [N ...]]
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from export.scene import Scene
+from render import workers
+from . import scenes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--bounces', type=int, default=4)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    print('{} cores'.format(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as bundle:
+        Scene(scenes.cornell_box(), (args.resolution, args.resolution)).save(bundle)
+        pixels = args.samples * args.resolution * args.resolution
+
+        # one worker renders in this process, so the workers are compared to no overhead
+        t = time.time()
+        baseline = [workers.render_samples(bundle, None, 0, args.samples, args.bounces, arch='cpu')]
+        baseline_wall = time.time() - t
+        single = workers.merge(baseline)
+        single_seconds = baseline[0]['seconds']
+
+        print('{:>8} {:>10} {:>10} {:>12} {:>8} {:>10} {:>10}'.format(
+            'workers', 'wall', 'render', 'samples / s', 'speedup', 'efficiency', 'max diff'))
+        for count in args.workers:
+            if count == 1:
+                accumulations, wall = baseline, baseline_wall
+            else:
+                t = time.time()
+                accumulations = workers.render_split(bundle, None, args.samples, args.bounces, count)
+                wall = time.time() - t
+            seconds = max(a['seconds'] for a in accumulations)
+            speedup = single_seconds / seconds
+            print('{:8} {:9.2f}s {:9.3f}s {:12.0f} {:8.2f} {:10.2f} {:10.2g}'.format(
+                count, wall, seconds, pixels / seconds, speedup, speedup / count,
+                np.abs(workers.merge(accumulations) - single).max()))
+
+
+if __name__ == '__main__':
+    main()
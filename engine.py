@@ -1,11 +1,23 @@
 import bpy
 import bgl
 from .render.render import *
+from .render import stats
+from .render import viewport
+from .render import warmup
 from .export.scene import Scene
-import numpy as np
+from .export.camera import Camera
+from .export.cache import ExportCache
+from .properties import get_preferences
+import json
+import threading
 import time
 
 
+# held by a final (or preview) render from setting up the render data until it's done, the viewport and the
+# kernel warm up wait for it to be released instead of setting taichi up again in the middle of the render
+final_render = threading.Lock()
+
+
 class CustomRenderEngine(bpy.types.RenderEngine):
     # These three members are used by blender to set up the
     # RenderEngine; define its internal name, visible name and capabilities.
@@ -18,81 +30,232 @@ class CustomRenderEngine(bpy.types.RenderEngine):
     # render.
     def __init__(self):
         self.scene_data = None
+        self.render_settings = None
         self.draw_data = None
+        # renders the viewport on a thread, and the (matrix, angle, projection) of the view it was given
+        self.viewport = None
+        self.view_camera = None
+        # version of the viewport image in the texture
+        self.drawn_version = 0
+        # if this engine holds final_render
+        self.rendering = False
+        # timer polling for a warm up or final render to release the render data, kept to unregister it
+        self.release_timer = None
 
     # When the render engine instance is destroy, this is called. Clean up any
     # render engine data here, for example stopping running render threads.
     def __del__(self):
-        pass
+        if self.viewport is not None:
+            self.viewport.stop()
+        if self.release_timer is not None and bpy.app.timers.is_registered(self.release_timer):
+            bpy.app.timers.unregister(self.release_timer)
+        self.release_render()
 
     def update(self, data=None, depsgraph=None):
+        scene = depsgraph.scene
+        final_render.acquire()
+        self.rendering = True
+        try:
+            self.sync_scene(depsgraph, get_resolution(scene), scene.cycles.samples)
+        except Exception:
+            self.release_render()
+            raise
+
+    def release_render(self):
+        ''' Lets the viewport and the kernel warm up use the render data again '''
+        if self.rendering:
+            self.rendering = False
+            final_render.release()
+
+    def sync_scene(self, depsgraph, resolution, num_samples, for_viewport=False):
+        ''' Exports the scene and sets up the render, or uploads just what changed if the settings are the same '''
         t = time.time()
+        # the render data can't change while the viewport thread renders or the kernels warm up,
+        # final renders wait for the warm up on their own thread, the viewport doesn't sync until it's done
+        viewport.stop_current()
+        warmup.wait()
         scene = depsgraph.scene
-        scale = scene.render.resolution_percentage / 100.0
-        self.resolution = (int(scene.render.resolution_x * scale),
-                           int(scene.render.resolution_y * scale))
-        self.num_samples = scene.cycles.samples
-        self.max_bounces = scene.cycles.max_bounces
-
-        exporter = Scene(depsgraph, self.resolution)
-
-        setup_render(exporter, self.resolution[0], self.resolution[1], self.num_samples, self.max_bounces)
-        print("Total export", time.time() - t)
+        settings = get_render_settings(scene, resolution, num_samples, for_viewport)
+        backend = get_backend_settings()
+        self.resolution = resolution
+        self.num_samples = num_samples
+        self.max_bounces = settings['max_depth']
+        self.denoising = settings['denoising']
+        self.denoise_iterations = scene.bpr.denoise_iterations
+        self.use_stats = scene.bpr.use_render_stats
+        self.stats_file = bpy.path.abspath(scene.bpr.stats_file)
+
+        # apply just the changes to the existing scene if the render settings are the same
+        render_settings = (sorted(settings.items()), sorted(backend.items()), self.use_stats)
+        if self.scene_data is not None and render_settings == self.render_settings and \
+                self.scene_data.sync(depsgraph):
+            # stats of the next render start from the sync
+            stats.reset()
+            stats.add_time('export', time.time() - t)
+            uploaded = update_render(self.scene_data)
+            print("Total sync", time.time() - t, "uploaded {:.1f} KB".format(uploaded / 1024))
+            return
+
+        cache = get_export_cache()
+        self.scene_data = Scene(depsgraph, self.resolution, cache=cache)
+        export_seconds = time.time() - t
+        self.render_settings = render_settings
+        if scene.bpr.bundle_directory and not for_viewport:
+            self.scene_data.save(bpy.path.abspath(scene.bpr.bundle_directory))
+
+        # the counters are compiled into the kernels when stats are on
+        stats.ENABLED = self.use_stats
+        setup_render(self.scene_data, **settings, **backend)
+        stats.add_time('export', export_seconds)
+        print("Total export", time.time() - t, self.scene_data.meshes.stats(), self.scene_data.lights.stats(),
+              cache.stats() if cache is not None else "")
 
     # This is the method called by Blender for both final renders (F12) and
     # small preview for materials, world and lights.
     def render(self, depsgraph):
+        try:
+            self.render_tiles()
+        finally:
+            self.release_render()
+
+    def render_tiles(self):
+        ''' Renders the set up scene a tile at a time into the render result '''
         t = time.time()
 
-        # gather extra passes TODO handle other AOVs other than just RGBA
-        aux_passes = []
+        # gather the extra passes and allocate the output once for every tile
         result = self.begin_result(0, 0, self.resolution[0], self.resolution[1])
-        for _pass in result.layers[0].passes:
-            if _pass.name != 'Combined':
-                aux_passes.append(np.ones((self.resolution[0], self.resolution[1], _pass.channels),
-                                          dtype=np.float32).flatten())
+        setup_output([(_pass.name, _pass.channels) for _pass in result.layers[0].passes if _pass.name != 'Combined'])
         self.end_result(result)
 
-        samples_to_do = self.num_samples * self.resolution[0] * self.resolution[1]
-        completed_samples = 0
-        iterations = 0
-        last_update = time.time()
-
-        while completed_samples < samples_to_do:
+        # render the image a tile at a time, the whole image is one tile if tiles are off
+        tiles = get_tiles()
+        # the outputs of the finished tiles, kept to write again with the denoised image
+        tile_outputs = []
+        for tile_index, (x, y, width, height) in enumerate(tiles):
             if self.test_break():
                 break
-            samples_done = render_pass()
-            completed_samples += samples_done
-            self.update_progress(completed_samples / samples_to_do)
-            iterations += 1
-
-            # only update if more iterations are done than max_bounces
-            if time.time() - last_update > 1 and iterations > self.max_bounces:
-                result = self.begin_result(0, 0, self.resolution[0], self.resolution[1])
-                result.layers[0].passes.foreach_set('rect', np.concatenate([get_buffer().flatten()] + aux_passes))
-                self.end_result(result)
-                last_update = time.time()
+            set_tile(x, y, width, height)
+
+            pixels = width * height
+            samples_to_do = self.num_samples * pixels
+            completed_samples = 0
+            iterations = 0
+            last_update = time.time()
+
+            # render until every pixel of the tile has all its samples or converged
+            while get_finished_pixels() < pixels:
+                if self.test_break():
+                    break
+                samples_done = render_pass()
+                completed_samples += samples_done
+                tile_progress = max(completed_samples / samples_to_do, get_finished_pixels() / pixels)
+                self.update_progress((tile_index + tile_progress) / len(tiles))
+                iterations += 1
+
+                # only update if more iterations are done than max_bounces
+                if time.time() - last_update > 1 and iterations > self.max_bounces:
+                    self.write_tile(x, y, width, height)
+                    last_update = time.time()
+
+            self.write_tile(x, y, width, height)
+            if self.denoising and get_finished_pixels() == pixels:
+                store_denoise_tile()
+                tile_outputs.append(get_output().copy())
+
+        # filter the whole image once every tile is done and write the tiles again with it as the combined pass
+        if self.denoising and len(tile_outputs) == len(tiles):
+            t_denoise = time.time()
+            denoise_image(self.denoise_iterations)
+            for (x, y, width, height), output in zip(tiles, tile_outputs):
+                output[:width * height * 4] = get_denoised_tile(x, y, width, height)
+                self.write_tile(x, y, width, height, output)
+            print("Denoise", time.time() - t_denoise)
+
+        print("Total render", time.time() - t, "compiled kernels {:.2f}s, loaded {:.2f}s, rendered {:.2f}s".format(
+            stats.seconds['compile'], stats.seconds['load'], stats.seconds['kernel']))
+        if self.use_stats:
+            if self.stats_file:
+                stats.save(self.stats_file)
+            else:
+                print(json.dumps(stats.get_stats(), indent=2))
+        # self.renderer.save()
 
-        result = self.begin_result(0, 0, self.resolution[0], self.resolution[1])
-        result.layers[0].passes.foreach_set('rect', np.concatenate([get_buffer().flatten()] + aux_passes))
+    def write_tile(self, x, y, width, height, output=None):
+        ''' Writes the tile being rendered, or the given output of a tile, to the render result '''
+        result = self.begin_result(x, y, width, height)
+        result.layers[0].passes.foreach_set('rect', get_output() if output is None else output)
         self.end_result(result)
 
-        print("Total render", time.time() - t)
-        # self.renderer.save()
+    def update_render_passes(self, scene=None, renderlayer=None):
+        ''' Registers the passes the render kernels write that are turned on for the view layer '''
+        self.register_pass(scene, renderlayer, "Combined", 4, "RGBA", 'COLOR')
+        if renderlayer.use_pass_z:
+            self.register_pass(scene, renderlayer, "Depth", 1, "Z", 'VALUE')
+        if renderlayer.use_pass_normal:
+            self.register_pass(scene, renderlayer, "Normal", 3, "XYZ", 'VECTOR')
+        if renderlayer.use_pass_diffuse_color:
+            self.register_pass(scene, renderlayer, "DiffCol", 3, "RGB", 'COLOR')
+        if renderlayer.use_pass_object_index:
+            self.register_pass(scene, renderlayer, "IndexOB", 1, "X", 'VALUE')
+        if renderlayer.use_pass_material_index:
+            self.register_pass(scene, renderlayer, "IndexMA", 1, "X", 'VALUE')
+        if renderlayer.use_pass_emit:
+            self.register_pass(scene, renderlayer, "Emit", 3, "RGB", 'COLOR')
 
     # For viewport renders, this method gets called once at the start and
     # whenever the scene or 3D viewport changes. This method is where data
     # should be read from Blender in the same thread. Typically a render
     # thread will be started to do the work while keeping Blender responsive.
     def view_update(self, context, depsgraph):
-        self.update(depsgraph=depsgraph)
+        if warmup.running() or not final_render.acquire(blocking=False):
+            # set up again once the warm up or final render is done, without holding up Blender
+            self.redraw_when_released()
+            return
+        try:
+            self.sync_view(context, depsgraph)
+        finally:
+            final_render.release()
+
+    def redraw_when_released(self):
+        ''' Draws the viewport again once the warm up or final render is done with the render data,
+            a timer checks for it rather than redrawing the whole time
+        '''
+        if self.release_timer is None:
+            self.release_timer = self.check_released
+            bpy.app.timers.register(self.release_timer, first_interval=0.1)
+
+    def check_released(self):
+        if warmup.running() or final_render.locked():
+            return 0.1
+        self.release_timer = None
+        self.tag_redraw()
+        # don't run the timer again
+        return None
+
+    def sync_view(self, context, depsgraph):
+        ''' Sets up the render of the viewport and starts its thread '''
+        scene = depsgraph.scene
         dimensions = context.region.width, context.region.height
-        self.resolution = dimensions
-        self.renderer.set_resolution(*dimensions)
-        # this angle needs to be fixed
-        self.cam_matrix = context.region_data.view_matrix.inverted()
-        self.renderer.set_camera_from_matrix(self.cam_matrix, 72.0)
-        self.rect = do_render(16, self.renderer)
+        if self.viewport is not viewport.current:
+            # another render set up the render data since, so set it up again
+            self.render_settings = None
+        self.sync_scene(depsgraph, dimensions, scene.cycles.preview_samples or scene.cycles.samples,
+                        for_viewport=True)
+
+        if self.viewport is None or (self.viewport.width, self.viewport.height) != dimensions:
+            self.viewport = viewport.ViewportRenderer(*dimensions)
+            self.drawn_version = 0
+        # the scene's camera was exported, give the thread the view's camera to start with
+        self.view_camera = None
+        self.update_view_camera(context, scene)
+        self.viewport.start()
+
+    def update_view_camera(self, context, scene):
+        ''' Hands the camera of the view to the viewport thread if the view moved '''
+        view_camera = get_view_camera(context)
+        if view_camera != self.view_camera:
+            self.view_camera = view_camera
+            self.viewport.set_camera(Camera(None, self.viewport.width, self.viewport.height, *view_camera))
 
     # For viewport renders, this method is called whenever Blender redraws
     # the 3D viewport. The renderer is expected to quickly draw the render
@@ -103,12 +266,39 @@ class CustomRenderEngine(bpy.types.RenderEngine):
         region = context.region
         scene = depsgraph.scene
 
-        if context.region_data.view_matrix.inverted() != self.cam_matrix:
-            self.view_update(context, depsgraph)
-
         # Get viewport dimensions
         dimensions = region.width, region.height
 
+        # resizing the region or another render using the render data sets up the render again,
+        # moving the view only hands the thread the new camera
+        # (a warm up or final render has the render data until it's done, keep drawing the last image till then)
+        if warmup.running() or final_render.locked():
+            self.redraw_when_released()
+        elif self.viewport is None or self.viewport is not viewport.current or \
+                dimensions != (self.viewport.width, self.viewport.height):
+            self.view_update(context, depsgraph)
+        else:
+            self.update_view_camera(context, scene)
+        if self.viewport is None:
+            return
+
+        # draw the latest image the thread finished
+        image, version = self.viewport.get_image()
+        if self.viewport.latency is not None:
+            # only with render stats on, the viewport draws on every camera move
+            if self.use_stats:
+                print("Viewport camera update to first pixels", self.viewport.latency)
+            stats.add_latency(self.viewport.latency)
+            self.viewport.latency = None
+        if image is not None:
+            self.draw_image(scene, dimensions, image, version)
+
+        # draw again until the thread stops and its last image is drawn
+        if self.viewport.needs_redraw(self.drawn_version):
+            self.tag_redraw()
+
+    def draw_image(self, scene, dimensions, image, version):
+        ''' Draws a viewport image, uploading it to the texture if it's a new version '''
         # Bind shader that converts from scene linear to display space,
         bgl.glEnable(bgl.GL_BLEND)
         bgl.glBlendFunc(bgl.GL_ONE, bgl.GL_ONE_MINUS_SRC_ALPHA)
@@ -116,7 +306,10 @@ class CustomRenderEngine(bpy.types.RenderEngine):
 
         if not self.draw_data or self.draw_data.dimensions != dimensions:
             self.draw_data = CustomDrawData(dimensions)
-        self.draw_data.set_texture(self.rect, self.resolution)
+            self.drawn_version = 0
+        if version != self.drawn_version:
+            self.draw_data.set_texture(image, dimensions)
+            self.drawn_version = version
 
         self.draw_data.draw()
 
@@ -217,7 +410,6 @@ class CustomDrawData:
 def get_panels():
     exclude_panels = {
         'VIEWLAYER_PT_filter',
-        'VIEWLAYER_PT_layer_passes',
     }
 
     panels = []
@@ -236,8 +428,16 @@ def register():
     for panel in get_panels():
         panel.COMPAT_ENGINES.add('BPR')
 
+    # warm up once the addon is registered and the file's scene is loaded, then for every file loaded
+    bpy.app.timers.register(warm_up_kernels, first_interval=1.0)
+    bpy.app.handlers.load_post.append(warm_up_on_load)
+
 
 def unregister():
+    if warm_up_on_load in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(warm_up_on_load)
+    if bpy.app.timers.is_registered(warm_up_kernels):
+        bpy.app.timers.unregister(warm_up_kernels)
     bpy.utils.unregister_class(CustomRenderEngine)
 
     for panel in get_panels():
@@ -245,9 +445,115 @@ def unregister():
             panel.COMPAT_ENGINES.remove('BPR')
 
 
-def do_render(num_samples, renderer):
-    n = 0
-    while n < num_samples:
-        renderer.render_pass()
-        n += 1
-    return renderer.get_buffer() / n
+def get_view_camera(context):
+    ''' The (matrix, angle, projection) of the camera the viewport looks through
+        The region's projection has the view's perspective or orthographic lens, the region's aspect ratio
+        and in camera view the zoom and offset of the camera's frame, so the render lines up with the viewport
+    '''
+    region_data = context.region_data
+    return tuple(map(tuple, region_data.view_matrix.inverted())), None, tuple(map(tuple, region_data.window_matrix))
+
+
+def get_resolution(scene):
+    ''' The (width, height) of a final render of the scene '''
+    scale = scene.render.resolution_percentage / 100.0
+    return int(scene.render.resolution_x * scale), int(scene.render.resolution_y * scale)
+
+
+def get_render_settings(scene, resolution, num_samples, for_viewport=False):
+    ''' The setup_render arguments for rendering the scene,
+        the viewport renders the whole region as one tile without denoising
+    '''
+    bpr = scene.bpr
+    return {
+        'width': resolution[0],
+        'height': resolution[1],
+        'samples': num_samples,
+        'max_depth': scene.cycles.max_bounces,
+        'render_mode': bpr.render_mode,
+        'noise_threshold': bpr.noise_threshold if bpr.use_adaptive_sampling else 0.0,
+        'min_samples': bpr.min_samples,
+        'tile_size': bpr.tile_size if bpr.use_tiles and not for_viewport else 0,
+        'light_sampling': bpr.use_light_sampling,
+        'sampler_type': bpr.sampler,
+        'roulette_depth': bpr.roulette_depth if bpr.use_russian_roulette else 0,
+        'denoising': bpr.use_denoising and not for_viewport,
+        'pixel_block': bpr.pixel_block_size if bpr.use_pixel_blocks else 0,
+    }
+
+
+def get_backend_settings():
+    ''' The setup_render arguments for the backend chosen in the preferences '''
+    preferences = get_preferences()
+    return {
+        'arch': ARCHS[preferences.backend],
+        'cpu_threads': preferences.cpu_threads,
+        'offline_cache': preferences.use_kernel_cache,
+        'offline_cache_directory': bpy.path.abspath(preferences.kernel_cache_directory),
+    }
+
+
+def get_export_cache():
+    ''' The export cache set in the preferences, None if it's off '''
+    preferences = get_preferences()
+    if not preferences.use_export_cache:
+        return None
+    return ExportCache(bpy.path.abspath(preferences.cache_directory) or None, preferences.cache_size * 1024 * 1024)
+
+
+def warm_up_kernels():
+    ''' Exports the scene and compiles the kernels of its final render in the background, so the render loads them
+        from the kernel cache instead of compiling them
+    '''
+    preferences = get_preferences()
+    scene = bpy.context.scene
+    if not (preferences.use_kernel_cache and preferences.use_warm_up) or scene is None or \
+            scene.render.engine != 'BPR' or scene.camera is None:
+        return None
+    if not final_render.acquire(blocking=False):
+        # try again once the render is done
+        return 1.0
+    try:
+        start_warm_up(scene, preferences)
+    finally:
+        final_render.release()
+    # don't run the timer again
+    return None
+
+
+def start_warm_up(scene, preferences):
+    ''' Exports the scene and starts compiling its kernels, the export runs on the main thread where Blender's data
+        can be read, so scenes too big to export without holding up Blender are skipped
+    '''
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    faces = count_evaluated_faces(depsgraph, preferences.warm_up_max_faces)
+    if faces > preferences.warm_up_max_faces:
+        print("Kernel warm up skipped, the scene has over {} faces".format(preferences.warm_up_max_faces))
+        return
+    resolution = get_resolution(scene)
+    exported_scene = Scene(depsgraph, resolution, cache=get_export_cache())
+    stats.ENABLED = scene.bpr.use_render_stats
+    warmup.start(exported_scene, **get_render_settings(scene, resolution, scene.cycles.samples),
+                 **get_backend_settings())
+
+
+def count_evaluated_faces(depsgraph, limit):
+    ''' Faces of every mesh instance after modifiers, counting stops once it's over limit '''
+    faces = 0
+    # the evaluated mesh of each object, counted once however many times it's instanced
+    object_faces = {}
+    for instance in depsgraph.object_instances:
+        obj = instance.object
+        if obj.type != 'MESH':
+            continue
+        if obj.name_full not in object_faces:
+            object_faces[obj.name_full] = len(obj.data.polygons)
+        faces += object_faces[obj.name_full]
+        if faces > limit:
+            break
+    return faces
+
+
+@bpy.app.handlers.persistent
+def warm_up_on_load(dummy):
+    bpy.app.timers.register(warm_up_kernels, first_interval=1.0)
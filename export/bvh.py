@@ -0,0 +1,426 @@
+import numpy as np
+
+
+# build parameters
+NUM_BINS = 16
+MAX_LEAF_SIZE = 4
+TRAVERSAL_COST = 1.0
+INTERSECT_COST = 1.0
+
+
+class BVH:
+    ''' A flattened bounding volume hierarchy over a list of primitive bounds
+        Interior nodes store the index of their left child in child_or_first
+        (the right child is always the next node) and a prim_count of 0.
+        Leaves store the first index into prim_indices and the number of prims.
+    '''
+    def __init__(self, box_min, box_max, child_or_first, prim_count, prim_indices):
+        self.box_min = box_min
+        self.box_max = box_max
+        self.child_or_first = child_or_first
+        self.prim_count = prim_count
+        self.prim_indices = prim_indices
+        self.node_count = len(prim_count)
+
+
+def get_triangle_bounds(verts, tris):
+    ''' Returns min, max arrays of the bounding box of each triangle '''
+    tri_verts = verts[tris]
+    return tri_verts.min(axis=1), tri_verts.max(axis=1)
+
+
+def surface_area(box_min, box_max):
+    ''' Surface area of boxes, (empty boxes have an area of 0) '''
+    d = np.maximum(box_max - box_min, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+def segment_ids(starts, counts):
+    ''' For ranges of prim_indices returns the positions in all ranges and which range each is in '''
+    seg = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    positions = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(offsets, counts)
+    return seg, positions, offsets
+
+
+def reduce_at(ufunc, initial, keys, values, num_keys):
+    ''' Reduces rows of values into num_keys rows by key, one column at a time (fast path of ufunc.at) '''
+    out = np.full((values.shape[1], num_keys), initial, dtype=np.float32)
+    for i in range(values.shape[1]):
+        ufunc.at(out[i], keys, values[:, i])
+    return out.T
+
+
+def bin_splits(prim_min, prim_max, centroids, seg, num_segs, counts, node_area, num_bins):
+    ''' Binned SAH split search over all 3 axes for a group of nodes at once
+        Returns the cost of the best split of each node and if each prim goes right of it
+    '''
+    c_min = reduce_at(np.minimum, np.inf, seg, centroids, num_segs)
+    c_max = reduce_at(np.maximum, -np.inf, seg, centroids, num_segs)
+    extent = c_max - c_min
+
+    # bin each primitive along each axis, axes with no extent all go in bin 0
+    scale = np.where(extent > 0.0, num_bins / np.where(extent > 0.0, extent, 1.0), 0.0)
+    bins = np.minimum(((centroids - c_min[seg]) * scale[seg]).astype(np.int64), num_bins - 1)
+    keys = ((seg[:, None] * 3 + np.arange(3)) * num_bins + bins).ravel()
+
+    # per node, per axis, per bin counts and bounds
+    num_keys = num_segs * 3 * num_bins
+    bin_counts = np.bincount(keys, minlength=num_keys).reshape(num_segs, 3, num_bins)
+    bin_min = reduce_at(np.minimum, np.inf, keys, np.repeat(prim_min, 3, axis=0), num_keys)
+    bin_max = reduce_at(np.maximum, -np.inf, keys, np.repeat(prim_max, 3, axis=0), num_keys)
+    bin_min = bin_min.reshape(num_segs, 3, num_bins, 3)
+    bin_max = bin_max.reshape(num_segs, 3, num_bins, 3)
+
+    # sweep from the left and right to get the cost of splitting after every bin
+    left_counts = np.cumsum(bin_counts, axis=2)[:, :, :-1]
+    right_counts = counts[:, None, None] - left_counts
+    left_area = surface_area(np.minimum.accumulate(bin_min, axis=2),
+                             np.maximum.accumulate(bin_max, axis=2))[:, :, :-1]
+    right_area = surface_area(np.minimum.accumulate(bin_min[:, :, ::-1], axis=2),
+                              np.maximum.accumulate(bin_max[:, :, ::-1], axis=2))[:, :, ::-1][:, :, 1:]
+    cost = left_counts * left_area + right_counts * right_area
+    cost[(left_counts == 0) | (right_counts == 0)] = np.inf
+    cost[extent <= 0.0] = np.inf
+
+    best = np.argmin(cost.reshape(num_segs, -1), axis=1)
+    axis, split = np.divmod(best, num_bins - 1)
+    best_cost = TRAVERSAL_COST + INTERSECT_COST * cost.reshape(num_segs, -1)[np.arange(num_segs), best] \
+        / np.maximum(node_area, 1e-30)
+    go_right = bins[np.arange(len(seg)), axis[seg]] > split[seg]
+    return best_cost, go_right
+
+
+def find_splits(prim_min, prim_max, centroids, seg, counts, node_area):
+    ''' Finds the SAH split of every node on a level, small nodes are binned with fewer bins
+        Returns the cost of the best split of each node and if each prim goes right of it
+    '''
+    num_segs = len(counts)
+    cost = np.full(num_segs, np.inf)
+    go_right = np.zeros(len(seg), dtype=bool)
+
+    num_bins = np.clip(2 ** np.ceil(np.log2(np.maximum(counts, 1))), 2, NUM_BINS).astype(np.int64)
+    for group_bins in np.unique(num_bins[counts > 1]):
+        group = np.flatnonzero(num_bins == group_bins)
+        seg_map = np.full(num_segs, -1)
+        seg_map[group] = np.arange(len(group))
+        in_group = seg_map[seg] >= 0
+
+        group_cost, group_right = bin_splits(prim_min[in_group], prim_max[in_group], centroids[in_group],
+                                             seg_map[seg[in_group]], len(group), counts[group],
+                                             node_area[group], int(group_bins))
+        cost[group] = group_cost
+        go_right[in_group] = group_right
+    return cost, go_right
+
+
+def build_bvh(prim_min, prim_max):
+    ''' Builds a BVH with a binned surface area heuristic over arrays of primitive bounds
+        The tree is built a level at a time, with all the nodes on a level binned at once
+    '''
+    prim_min = np.asarray(prim_min, dtype=np.float32).reshape(-1, 3)
+    prim_max = np.asarray(prim_max, dtype=np.float32).reshape(-1, 3)
+    centroids = (prim_min + prim_max) * 0.5
+    prim_indices = np.arange(len(prim_min), dtype=np.uint32)
+
+    box_min, box_max, child_or_first, prim_count = [], [], [], []
+    node_count = 1
+
+    # nodes on the level being built and their ranges of prim_indices
+    nodes = np.array([0])
+    starts = np.array([0])
+    counts = np.array([len(prim_indices)])
+
+    while len(nodes) > 0:
+        num_segs = len(nodes)
+        seg, positions, offsets = segment_ids(starts, counts)
+        prims = prim_indices[positions]
+
+        # node bounds
+        level_min = np.zeros((num_segs, 3), dtype=np.float32)
+        level_max = np.zeros((num_segs, 3), dtype=np.float32)
+        not_empty = counts > 0
+        if np.any(not_empty):
+            level_min[not_empty] = np.minimum.reduceat(prim_min[prims], offsets[not_empty])
+            level_max[not_empty] = np.maximum.reduceat(prim_max[prims], offsets[not_empty])
+
+        cost, split_right = find_splits(prim_min[prims], prim_max[prims], centroids[prims],
+                                        seg, counts, surface_area(level_min, level_max))
+
+        # leaves are small nodes that are cheaper than splitting, big nodes always split
+        has_split = np.isfinite(cost)
+        is_leaf = (counts <= MAX_LEAF_SIZE) & (~has_split | (cost >= INTERSECT_COST * counts))
+        is_leaf |= counts <= 1
+
+        # prims go left if they are in a bin on or before the split
+        # (nodes with all centroids in the same place just split down the middle)
+        rank = positions - np.repeat(starts, counts)
+        go_right = np.where(has_split[seg], split_right, rank >= (counts // 2)[seg])
+        go_right &= ~is_leaf[seg]
+
+        # partition each node's range so left prims come first
+        go_left = ~go_right
+        left_before = np.cumsum(go_left) - go_left
+        left_before -= np.repeat(left_before[offsets[counts > 0]], counts[counts > 0])
+        left_counts = np.bincount(seg, weights=go_left, minlength=num_segs).astype(np.int64)
+        start_of = np.repeat(starts, counts)
+        prim_indices[np.where(go_left, start_of + left_before,
+                              start_of + left_counts[seg] + rank - left_before)] = prims
+
+        # children are allocated next to each other after all current nodes
+        num_split = np.count_nonzero(~is_leaf)
+        lefts = node_count + 2 * np.arange(num_split)
+        node_count += 2 * num_split
+
+        level_child = np.where(is_leaf, starts, 0)
+        level_child[~is_leaf] = lefts
+        box_min.append((nodes, level_min))
+        box_max.append((nodes, level_max))
+        child_or_first.append((nodes, level_child))
+        prim_count.append((nodes, np.where(is_leaf, counts, 0)))
+
+        split_starts, split_counts, split_lefts = starts[~is_leaf], counts[~is_leaf], left_counts[~is_leaf]
+        nodes = np.stack([lefts, lefts + 1], axis=1).ravel()
+        starts = np.stack([split_starts, split_starts + split_lefts], axis=1).ravel()
+        counts = np.stack([split_lefts, split_counts - split_lefts], axis=1).ravel()
+
+    def flatten(levels, shape, dtype):
+        out = np.zeros((node_count,) + shape, dtype=dtype)
+        for level_nodes, values in levels:
+            out[level_nodes] = values
+        return out
+
+    return BVH(flatten(box_min, (3,), np.float32),
+               flatten(box_max, (3,), np.float32),
+               flatten(child_or_first, (), np.uint32),
+               flatten(prim_count, (), np.uint32),
+               prim_indices)
+
+
+def build_mesh_bvh(verts, tris):
+    ''' Builds a BVH over the triangles of a mesh (tris index into verts) '''
+    tri_min, tri_max = get_triangle_bounds(verts, tris)
+    return build_bvh(tri_min, tri_max)
+
+
+def refit_bvh(bvh, prim_min, prim_max):
+    ''' Returns a BVH with the same tree as bvh and its node bounds recomputed for moved primitives
+        The leaves are bound first and then each level of interior nodes from the bottom up
+    '''
+    box_min = np.zeros_like(bvh.box_min)
+    box_max = np.zeros_like(bvh.box_max)
+    if len(bvh.prim_indices) == 0:
+        return BVH(box_min, box_max, bvh.child_or_first, bvh.prim_count, bvh.prim_indices)
+
+    leaves = np.flatnonzero(bvh.prim_count > 0)
+    seg, positions, offsets = segment_ids(bvh.child_or_first[leaves].astype(np.int64),
+                                          bvh.prim_count[leaves].astype(np.int64))
+    prims = bvh.prim_indices[positions]
+    box_min[leaves] = np.minimum.reduceat(prim_min[prims], offsets)
+    box_max[leaves] = np.maximum.reduceat(prim_max[prims], offsets)
+
+    # interior nodes of each level from the root down
+    levels = []
+    nodes = np.array([0])
+    while len(nodes) > 0:
+        interior = nodes[bvh.prim_count[nodes] == 0]
+        levels.append(interior)
+        left = bvh.child_or_first[interior].astype(np.int64)
+        nodes = np.concatenate([left, left + 1])
+
+    for interior in reversed(levels):
+        left = bvh.child_or_first[interior].astype(np.int64)
+        box_min[interior] = np.minimum(box_min[left], box_min[left + 1])
+        box_max[interior] = np.maximum(box_max[left], box_max[left + 1])
+    return BVH(box_min, box_max, bvh.child_or_first, bvh.prim_count, bvh.prim_indices)
+
+
+
+# traversal stacks are sized in steps of this many entries, so a tree rebuilt a little deeper on sync still fits
+STACK_STEP = 16
+
+
+def round_stack_size(size):
+    ''' Rounds a traversal stack size up to the next step '''
+    return max(-(-size // STACK_STEP), 1) * STACK_STEP
+
+
+def bvh_stack_size(child_or_first, prim_count, roots):
+    ''' The most entries the traversal stack of binary BVHs can hold, for the given root nodes
+        The root is pushed and each interior node is popped and pushes its 2 children, so a node's children
+        can find every sibling of the nodes above them still on the stack
+    '''
+    nodes = np.asarray(roots, dtype=np.int64)
+    pending = np.zeros(len(nodes), dtype=np.int64)
+    size = 1 if len(nodes) > 0 else 0
+    while len(nodes) > 0:
+        interior = prim_count[nodes] == 0
+        nodes, pending = nodes[interior], pending[interior]
+        if len(nodes) == 0:
+            break
+        size = max(size, int(pending.max()) + 2)
+        left = child_or_first[nodes].astype(np.int64)
+        nodes = np.concatenate([left, left + 1])
+        pending = np.concatenate([pending + 1, pending + 1])
+    return size
+
+
+# compressed wide BVH parameters
+WIDTH = 4
+EMPTY_CHILD = 255
+MIN_EXPONENT = -100
+
+
+class WideBVH:
+    ''' A compressed 4 wide BVH made by collapsing a binary BVH
+        Each node stores its box origin and a power of 2 scale exponent per axis,
+        with the child boxes quantized to 8 bits inside that.
+        Interior children are stored at child_base + child_offset,
+        leaf children have child_count tris at tri_base + child_offset in prim_indices
+        (child_count is 0 for interior and EMPTY_CHILD for unused slots).
+    '''
+    def __init__(self, origin, exponent, child_base, tri_base, q_min, q_max,
+                 child_offset, child_count, prim_indices):
+        self.origin = origin
+        self.exponent = exponent
+        self.child_base = child_base
+        self.tri_base = tri_base
+        self.q_min = q_min
+        self.q_max = q_max
+        self.child_offset = child_offset
+        self.child_count = child_count
+        self.prim_indices = prim_indices
+        self.node_count = len(child_base)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.origin, self.exponent, self.child_base, self.tri_base,
+                                      self.q_min, self.q_max, self.child_offset, self.child_count))
+
+
+def wide_stack_size(child_base, child_offset, child_count, roots):
+    ''' The most entries the traversal stack of compressed wide BVHs can hold, for the given root nodes
+        Each node visited pushes its interior children, leaf children are tested right away
+    '''
+    nodes = np.asarray(roots, dtype=np.int64)
+    pending = np.zeros(len(nodes), dtype=np.int64)
+    size = 1 if len(nodes) > 0 else 0
+    while len(nodes) > 0:
+        interior = child_count[nodes] == 0
+        counts = interior.sum(axis=1)
+        size = max(size, int((pending + counts).max()))
+        children = child_base[nodes].astype(np.int64)[:, None] + child_offset[nodes]
+        nodes = children[interior]
+        pending = np.repeat(pending + counts - 1, counts)
+    return size
+
+
+def collapse_children(child_or_first, prim_count, area, nodes):
+    ''' Pulls grandchildren of binary nodes up (largest area first) until they have WIDTH children
+        Returns the (nodes, WIDTH) children of each node, -1 for unused slots, leaves are their own only child
+    '''
+    children = np.full((len(nodes), WIDTH), -1, dtype=np.int64)
+    interior = prim_count[nodes] == 0
+    children[~interior, 0] = nodes[~interior]
+    children[interior, 0] = child_or_first[nodes[interior]]
+    children[interior, 1] = children[interior, 0] + 1
+
+    slots = np.arange(WIDTH)
+    rows = np.arange(len(nodes))
+    for count in range(2, WIDTH):
+        # the interior child with the largest area of each node, the first one of equal areas
+        used = children >= 0
+        c = np.where(used, children, 0)
+        candidate = used & (prim_count[c] == 0)
+        pick = np.argmax(np.where(candidate, area[c], -np.inf), axis=1)
+        expand = candidate[rows, pick]
+        if not np.any(expand):
+            break
+        # replace it with its children, shifting the children after it along a slot
+        picked = c[rows, pick]
+        left = child_or_first[picked]
+        shifted = children[:, np.maximum(slots - 1, 0)]
+        expanded = np.where(slots < pick[:, None], children,
+                            np.where(slots == pick[:, None], left[:, None],
+                                     np.where(slots == pick[:, None] + 1, left[:, None] + 1, shifted)))
+        children = np.where(expand[:, None], expanded, children)
+    return children
+
+
+def quantize_boxes(parent_min, parent_max, child_min, child_max):
+    ''' Quantizes child boxes to 8 bits relative to the parent box, rounded outwards
+        Returns the parent scale exponents and the quantized child min, max
+    '''
+    extent = (parent_max - parent_min).astype(np.float64)
+    exponent = np.where(extent > 0.0, np.ceil(np.log2(np.maximum(extent, 1e-38) / 255.0)), MIN_EXPONENT)
+    exponent = np.clip(exponent, MIN_EXPONENT, 127).astype(np.int8)
+    scale = np.ldexp(np.float32(1.0), exponent.astype(np.int32)).astype(np.float32)[:, None, :]
+    origin = parent_min[:, None, :]
+
+    q_min = np.clip(np.floor((child_min - origin) / scale), 0, 255)
+    q_max = np.clip(np.ceil((child_max - origin) / scale), 0, 255)
+    # step out one more where float rounding of the decode would shrink the box
+    q_min = np.where(origin + q_min.astype(np.float32) * scale > child_min, np.maximum(q_min - 1, 0), q_min)
+    q_max = np.where(origin + q_max.astype(np.float32) * scale < child_max, np.minimum(q_max + 1, 255), q_max)
+    return exponent, q_min.astype(np.uint8), q_max.astype(np.uint8)
+
+
+def compress_bvh(bvh):
+    ''' Collapses a binary BVH into a compressed WideBVH
+        The wide nodes are made a level at a time, in the same breadth first order as a queue would
+    '''
+    child_or_first = bvh.child_or_first.astype(np.int64)
+    prim_count = bvh.prim_count.astype(np.int64)
+    area = surface_area(bvh.box_min, bvh.box_max)
+
+    # binary node each wide node is made from, its binary children and where the children go
+    wide_nodes, children = [], []
+    child_base, tri_base, child_offset, child_count = [], [], [], []
+    prim_indices = []
+    node_total = tri_total = 0
+
+    nodes = np.array([0])
+    while len(nodes) > 0:
+        level_children = collapse_children(child_or_first, prim_count, area, nodes)
+        used = level_children >= 0
+        c = np.where(used, level_children, 0)
+        is_interior = used & (prim_count[c] == 0)
+        is_leaf = used & (prim_count[c] > 0)
+        counts = np.where(is_leaf, prim_count[c], 0)
+
+        # interior children are allocated after the whole level, in order
+        node_total += len(nodes)
+        interior_counts = is_interior.sum(axis=1)
+        child_base.append(node_total + np.cumsum(interior_counts) - interior_counts)
+        interior_offsets = np.cumsum(is_interior, axis=1) - is_interior
+
+        # leaf tris of a wide node are stored together so offsets fit in 8 bits
+        tri_counts = counts.sum(axis=1)
+        tri_base.append(tri_total + np.cumsum(tri_counts) - tri_counts)
+        leaf_offsets = np.cumsum(counts, axis=1) - counts
+        _, positions, _ = segment_ids(child_or_first[c[is_leaf]], counts[is_leaf])
+        prim_indices.append(bvh.prim_indices[positions])
+
+        child_offset.append(np.where(is_interior, interior_offsets, np.where(is_leaf, leaf_offsets, 0)))
+        child_count.append(np.where(used, counts, EMPTY_CHILD))
+        wide_nodes.append(nodes)
+        children.append(level_children)
+        tri_total += int(tri_counts.sum())
+        nodes = c[is_interior]
+
+    nodes = np.concatenate(wide_nodes)
+    children = np.concatenate(children)
+    parent_min, parent_max = bvh.box_min[nodes], bvh.box_max[nodes]
+    # empty slots get an inverted box so they never get hit
+    empty = children < 0
+    child_min = np.where(empty[:, :, None], parent_max[:, None, :], bvh.box_min[children])
+    child_max = np.where(empty[:, :, None], parent_min[:, None, :], bvh.box_max[children])
+    exponent, q_min, q_max = quantize_boxes(parent_min, parent_max, child_min, child_max)
+    q_min[empty] = 255
+    q_max[empty] = 0
+
+    return WideBVH(parent_min.astype(np.float32), exponent,
+                   np.concatenate(child_base).astype(np.uint32), np.concatenate(tri_base).astype(np.uint32),
+                   q_min, q_max,
+                   np.concatenate(child_offset).astype(np.uint8),
+                   np.concatenate(child_count).astype(np.uint8),
+                   np.concatenate(prim_indices).astype(np.uint32))
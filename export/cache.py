@@ -0,0 +1,93 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+# bump when the format of cached data changes
+CACHE_VERSION = 1
+
+
+def default_directory():
+    return os.path.join(tempfile.gettempdir(), 'bpr_export_cache')
+
+
+class ExportCache:
+    ''' An on disk cache of per mesh export data, keyed by a hash of the mesh content and build parameters
+        Each entry is a directory of .npy files which are memory mapped back on load.
+        When the cache is over max_size bytes evict() removes the least recently used entries,
+        it walks every entry so is called once per export rather than on each store.
+    '''
+    def __init__(self, directory=None, max_size=1024 * 1024 * 1024):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, arrays, params):
+        ''' Hash of a list of numpy arrays and a tuple of build parameters '''
+        h = hashlib.sha1(repr((CACHE_VERSION,) + tuple(params)).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            h.update(repr((array.dtype.str, array.shape)).encode())
+            h.update(array.data)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        ''' Returns a dict of the memory mapped arrays of an entry or None if not cached '''
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+
+        try:
+            arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                      for name in os.listdir(path) if name.endswith('.npy')}
+        except (OSError, ValueError):
+            # a broken entry, remove it and export again
+            shutil.rmtree(path, ignore_errors=True)
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return arrays
+
+    def store(self, key, arrays):
+        ''' Saves a dict of arrays as an entry '''
+        path = self.entry_path(key)
+        temp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, name + '.npy'), np.ascontiguousarray(array))
+
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            # another render already stored this entry
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def evict(self):
+        ''' Removes least recently used entries until the cache fits in max_size '''
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        return "Export cache hits {}, misses {}".format(self.hits, self.misses)
@@ -4,35 +4,79 @@ import math
 
 class Camera:
     ''' Camera class '''
-    def __init__(self, blender_cam, width, height, matrix=None, angle=None):
+    def __init__(self, blender_cam, width, height, matrix=None, angle=None, projection=None):
         # create the camera vectors from the data
-        # note that we can override the camera matrix for viewport rendering
+        # note that we can override the camera matrix for viewport rendering,
+        # and give the projection of a viewport region instead of an angle to match what it shows
         aspect_ratio = width / height
         t0, t1 = 0.0, 1.0
         focus_dist = 10.0
         aperture = 0.0
 
-        theta = blender_cam.data.angle / aspect_ratio if angle is None else angle / aspect_ratio
-        h = math.tan(theta/2.0)
-
         cam_mat = blender_cam.matrix_world if matrix is None else matrix
+        # kept to export the camera again at another resolution
+        self.matrix = np.array(cam_mat, dtype=np.float32)
+        self.projection = None if projection is None else np.array(projection, dtype=np.float64)
         look_from = np.array([cam_mat[0][3], cam_mat[1][3], cam_mat[2][3]])
         self.u = np.array([cam_mat[0][0], cam_mat[1][0], cam_mat[2][0]])
         self.v = np.array([cam_mat[0][1], cam_mat[1][1], cam_mat[2][1]])
         w = np.array([cam_mat[0][2], cam_mat[1][2], cam_mat[2][2]])
+        # the depth pass is the distance from the camera along the view axis, which is -w
+        self.position = look_from
+        self.forward = -w / np.linalg.norm(w)
+
+        # rays start at origin + s * origin_horizontal + t * origin_vertical for s, t across the image,
+        # the origin only moves across the image for orthographic views
+        self.origin_horizontal = np.zeros(3)
+        self.origin_vertical = np.zeros(3)
+        if self.projection is not None:
+            self.angle = None
+            self.set_projection(look_from, w, focus_dist)
+        else:
+            theta = blender_cam.data.angle / aspect_ratio if angle is None else angle / aspect_ratio
+            h = math.tan(theta/2.0)
+            self.angle = blender_cam.data.angle if angle is None else angle
 
-        # camera position and orientation
-        viewport_height = 2.0 * h
-        viewport_width = aspect_ratio * viewport_height
+            # camera position and orientation
+            viewport_height = 2.0 * h
+            viewport_width = aspect_ratio * viewport_height
 
-        self.origin = look_from
-        self.horizontal = focus_dist * viewport_width * self.u
-        self.vertical = focus_dist * viewport_height * self.v
-        self.lower_left_corner = self.origin - self.horizontal/2.0 - \
-            self.vertical/2.0 - focus_dist * w
+            self.origin = look_from
+            self.horizontal = focus_dist * viewport_width * self.u
+            self.vertical = focus_dist * viewport_height * self.v
+            self.lower_left_corner = self.origin - self.horizontal/2.0 - \
+                self.vertical/2.0 - focus_dist * w
 
         self.lens_radius = aperture / 2.0
         self.t0, self.t1 = t0, t1
 
+    def set_projection(self, look_from, w, focus_dist):
+        ''' Sets the rays from the projection of a viewport region, which has the region's aspect ratio and
+            the zoom and offset of a camera view's frame in it
+        '''
+        to_world = self.matrix.astype(np.float64) @ np.linalg.inv(self.projection)
+
+        def unproject(x, y, z):
+            p = to_world @ np.array([x, y, z, 1.0])
+            return p[:3] / p[3]
+
+        # lower left, lower right and upper left corners of the region on the near clip plane
+        near = [unproject(x, y, -1.0) for x, y in ((-1.0, -1.0), (1.0, -1.0), (-1.0, 1.0))]
+        if self.projection[3][3] == 0.0:
+            # perspective, the rays start at the eye and go through the image plane moved to focus_dist
+            scale = focus_dist / np.dot(look_from - near[0], w)
+            self.origin = look_from
+            self.lower_left_corner = look_from + (near[0] - look_from) * scale
+            self.horizontal = (near[1] - near[0]) * scale
+            self.vertical = (near[2] - near[0]) * scale
+        else:
+            # orthographic, parallel rays start on the near clip plane (which is behind the view's eye point)
+            self.origin = near[0]
+            self.origin_horizontal = near[1] - near[0]
+            self.origin_vertical = near[2] - near[0]
+            self.lower_left_corner = near[0] - focus_dist * w
+            self.horizontal = np.zeros(3)
+            self.vertical = np.zeros(3)
+
     def get_data(self):
         return self.u, self.v, self.origin, self.horizontal, self.vertical, self.lower_left_corner
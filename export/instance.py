@@ -1,40 +1,169 @@
 import numpy as np
-from numpy.linalg import inv
+from .bvh import BVH, build_bvh, bvh_stack_size, round_stack_size
 
 
-def export_instance(inst):
-    ''' Exports Instance data from a blender depsgraph instance '''
-    bound_box = np.array(inst.object.bound_box, dtype=np.float32)
-    mat = np.array(inst.matrix_world, dtype=np.float32).reshape(4, 4)
-    bb_vertices = [np.array([v[0], v[1], v[2], 1.0]) for v in bound_box]
-    world_bb_vertices = np.array([(mat @ v)[:3] for v in bb_vertices], dtype=np.float32)
+# matrices with a determinant this small relative to the lengths of their axes aren't inverted
+SINGULAR_TOLERANCE = 1e-6
+# instances that can't be hit get an empty box, its min above its max so it doesn't grow the boxes around it
+EMPTY_BOX_MIN = np.finfo(np.float32).max
+EMPTY_BOX_MAX = -np.finfo(np.float32).max
+
+
+def get_world_bounds(bound_boxes, matrices):
+    ''' Returns the world space min, max of (N, 8, 3) local bound box corners transformed by (N, 4, 4) matrices '''
+    corners = np.concatenate([bound_boxes, np.ones(bound_boxes.shape[:-1] + (1,))], axis=-1)
+    world_corners = (corners @ np.swapaxes(matrices, 1, 2))[..., :3].astype(np.float32)
+    return world_corners.min(axis=1), world_corners.max(axis=1)
+
+
+def invertible_transforms(matrices):
+    ''' Returns a mask of the (N, 4, 4) matrices that can be inverted,
+        scaling an object to 0 on an axis flattens it and leaves it without a world to object matrix
+    '''
+    m = matrices[:, :3, :3].astype(np.float64)
+    axis_lengths = np.linalg.norm(m, axis=1)
+    invertible = np.abs(np.linalg.det(m)) > SINGULAR_TOLERANCE * np.prod(axis_lengths, axis=1)
+    affine = np.all(matrices[:, 3] == [0.0, 0.0, 0.0, 1.0], axis=1)
+    invertible[~affine] &= np.linalg.det(matrices[~affine].astype(np.float64)) != 0.0
+    return invertible
+
+
+def invert_transforms(matrices):
+    ''' Returns the inverses of (N, 4, 4) matrices, 0 for the ones that can't be inverted
+        Affine matrices (bottom row 0, 0, 0, 1) are inverted directly as a 3x3 matrix and a translation,
+        anything else goes through the general inverse
+    '''
+    inverses = np.zeros_like(matrices)
+    invertible = invertible_transforms(matrices)
+    is_affine = np.all(matrices[:, 3] == [0.0, 0.0, 0.0, 1.0], axis=1)
+    affine, general = invertible & is_affine, invertible & ~is_affine
+
+    # inverse of the 3x3 part from its cofactors, in double precision
+    m = matrices[affine, :3, :3].astype(np.float64)
+    cofactors = np.cross(m[:, [1, 2, 0]], m[:, [2, 0, 1]])
+    determinant = np.einsum('ij,ij->i', m[:, 0], cofactors[:, 0])
+    linear = np.swapaxes(cofactors, 1, 2) / determinant[:, None, None]
+    translation = -np.einsum('nij,nj->ni', linear, matrices[affine, :3, 3])
+
+    inverses[affine, :3, :3] = linear
+    inverses[affine, :3, 3] = translation
+    inverses[affine, 3, 3] = 1.0
+    if np.any(general):
+        inverses[general] = np.linalg.inv(matrices[general])
+    return inverses
+
+
+def export_instances(bound_boxes, matrices):
+    ''' Exports the bounds and transforms of many instances at once
+        from (N, 8, 3) local bound boxes and (N, 4, 4) object to world matrices
+    '''
+    matrices = np.asarray(matrices, dtype=np.float32).reshape(-1, 4, 4)
+    bound_boxes = np.asarray(bound_boxes, dtype=np.float32).reshape(-1, 8, 3)
+    box_min, box_max = get_world_bounds(bound_boxes, matrices)
+    # instances scaled flat keep their place (and index) with a box no ray hits
+    singular = ~invertible_transforms(matrices)
+    box_min[singular] = EMPTY_BOX_MIN
+    box_max[singular] = EMPTY_BOX_MAX
+    return box_min, box_max, invert_transforms(matrices), matrices
+
+
+def changed_ranges(old, new):
+    ''' Returns the (start, end) runs of rows of new that differ from old, rows past the end of old count as changed '''
+    count = min(len(old), len(new))
+    changed = np.ones(len(new), dtype=bool)
+    changed[:count] = np.any((old[:count] != new[:count]).reshape(count, -1), axis=1)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], changed, [0]]).astype(np.int8)))
+    return list(zip(edges[0::2], edges[1::2]))
 
-    box_min = world_bb_vertices.min(axis=0)
-    box_max = world_bb_vertices.max(axis=0)
-    world_to_obj = inv(mat)
 
-    return box_min, box_max, world_to_obj, mat
+def export_instance(inst):
+    ''' Exports Instance data from a blender depsgraph instance '''
+    box_min, box_max, world_to_obj, obj_to_world = export_instances([inst.object.bound_box], [inst.matrix_world])
+    return box_min[0], box_max[0], world_to_obj[0], obj_to_world[0]
 
 
 class InstanceCache:
-    ''' Instance cache keeps track of the instances exported and their data '''
+    ''' Instance cache keeps track of the instances exported and their data
+        Instances are gathered in add() and exported together in commit()
+    '''
     def __init__(self):
         self.instance_count = 0
+        # entries the render's traversal stack has, enough for the top level BVH
+        self.stack_size = 0
+
+        # local bound boxes are shared by all instances of an object
+        self.bound_boxes = []
+        self.bound_box_index = {}  # a dict of blender object name: index into bound_boxes
+
+        self.box_indices = []
+        self.matrices = []
+        self.mesh_id = []
+        self.pass_index = []  # object pass index for the object index pass
+
+        # (array name, first row, rows) of data updated since the last sync
+        self.changes = []
 
     def add(self, inst, mesh_id):
         # add a new instance to the cache
-        box_min, box_max, world_to_obj, obj_to_world = export_instance(inst)
-        if self.instance_count == 0:
-            self.box_min = np.array([box_min], dtype=np.float32)
-            self.box_max = np.array([box_max], dtype=np.float32)
-            self.world_to_obj = np.array([world_to_obj], dtype=np.float32)
-            self.obj_to_world = np.array([obj_to_world], dtype=np.float32)
-            self.mesh_id = np.array([mesh_id], dtype=np.uint8)
-        else:
-            self.box_min = np.concatenate([self.box_min, [box_min]])
-            self.box_max = np.concatenate([self.box_max, [box_max]])
-            self.world_to_obj = np.concatenate([self.world_to_obj, [world_to_obj]])
-            self.obj_to_world = np.concatenate([self.obj_to_world, [obj_to_world]])
-            self.mesh_id = np.concatenate([self.mesh_id, np.array([mesh_id], dtype=np.uint8)])
+        name = inst.object.name_full
+        if name not in self.bound_box_index:
+            self.bound_box_index[name] = len(self.bound_boxes)
+            self.bound_boxes.append(np.array(inst.object.bound_box, dtype=np.float32))
+
+        self.box_indices.append(self.bound_box_index[name])
+        self.matrices.append(np.array(inst.matrix_world, dtype=np.float32))
+        self.mesh_id.append(mesh_id)
+        self.pass_index.append(inst.object.pass_index)
 
         self.instance_count += 1
+
+    def commit(self):
+        ''' export the instances and build the top level BVH over their bounding boxes '''
+        bound_boxes = np.array(self.bound_boxes, dtype=np.float32).reshape(-1, 8, 3)
+        box_indices = np.array(self.box_indices, dtype=np.int64)
+        self.box_min, self.box_max, self.world_to_obj, self.obj_to_world = \
+            export_instances(bound_boxes[box_indices], self.matrices)
+        self.mesh_id = np.array(self.mesh_id, dtype=np.uint32)
+        self.pass_index = np.array(self.pass_index, dtype=np.uint32)
+
+        self.tlas = build_bvh(self.box_min, self.box_max)
+        self.stack_size = round_stack_size(self.get_tlas_stack_size())
+
+    def get_tlas_stack_size(self):
+        ''' The most entries the traversal stack of the top level BVH can hold '''
+        return bvh_stack_size(self.tlas.child_or_first, self.tlas.prim_count, [0] if self.instance_count > 0 else [])
+
+    def get_arrays(self):
+        ''' Returns a dict of the exported arrays by name '''
+        arrays = {name: getattr(self, name)
+                  for name in ('box_min', 'box_max', 'world_to_obj', 'obj_to_world', 'mesh_id', 'pass_index')}
+        arrays.update({'tlas_' + name: getattr(self.tlas, name)
+                       for name in ('box_min', 'box_max', 'child_or_first', 'prim_count', 'prim_indices')})
+        return arrays
+
+    def set_arrays(self, arrays):
+        ''' Takes the exported arrays of get_arrays, as loaded from a scene bundle '''
+        for name in ('box_min', 'box_max', 'world_to_obj', 'obj_to_world', 'mesh_id', 'pass_index'):
+            setattr(self, name, arrays[name])
+        self.tlas = BVH(*(arrays['tlas_' + name]
+                          for name in ('box_min', 'box_max', 'child_or_first', 'prim_count', 'prim_indices')))
+        self.instance_count = len(self.mesh_id)
+        self.stack_size = round_stack_size(self.get_tlas_stack_size())
+
+    def update(self, instances):
+        ''' Take over the data of a newly exported InstanceCache of the same instances
+            keeping the rows that changed, returns False if the number of instances changed
+            or the new top level BVH needs a deeper traversal stack than the kernels were compiled with
+        '''
+        if instances.instance_count != self.instance_count or instances.get_tlas_stack_size() > self.stack_size:
+            return False
+
+        old_arrays = self.get_arrays()
+        for name, array in instances.get_arrays().items():
+            for start, end in changed_ranges(old_arrays[name], array):
+                self.changes.append((name, int(start), array[start:end]))
+
+        self.box_min, self.box_max = instances.box_min, instances.box_max
+        self.world_to_obj, self.obj_to_world = instances.world_to_obj, instances.obj_to_world
+        self.mesh_id, self.pass_index, self.tlas = instances.mesh_id, instances.pass_index, instances.tlas
+        return True
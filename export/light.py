@@ -0,0 +1,103 @@
+import numpy as np
+from .instance import changed_ranges
+
+
+def luminance(color):
+    return 0.2126 * color[..., 0] + 0.7152 * color[..., 1] + 0.0722 * color[..., 2]
+
+
+def build_alias_table(weights):
+    ''' Builds Vose's alias table to pick index i with probability weights[i] / sum(weights)
+        returns the probability of keeping each index and the index to take otherwise
+    '''
+    count = len(weights)
+    scaled = weights * (count / weights.sum())
+    prob = np.ones(count, dtype=np.float32)
+    alias = np.arange(count, dtype=np.uint32)
+
+    small = list(np.nonzero(scaled < 1.0)[0])
+    large = list(np.nonzero(scaled >= 1.0)[0])
+    while small and large:
+        s, l = small.pop(), large[-1]
+        prob[s] = scaled[s]
+        alias[s] = l
+        # the large index gives the rest of the small one's column
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(large.pop())
+    return prob, alias
+
+
+class LightCache:
+    ''' The emissive triangles of every instance in world space and an alias table to sample them by power
+        Lights are exported from the committed meshes, instances and materials in commit()
+    '''
+    def __init__(self):
+        self.light_count = 0
+        self.total_power = np.zeros(1, dtype=np.float32)
+
+        # (array name, first row, rows) of data updated since the last sync
+        self.changes = []
+
+    def commit(self, meshes, instances, materials):
+        ''' export the emissive triangles of the instances and build the alias table '''
+        emission = np.asarray(materials.emission_color, dtype=np.float32)
+        is_emissive = luminance(emission) > 0.0
+        emissive_tris = np.nonzero(is_emissive[meshes.mat_indices])[0] if meshes.tri_count > 0 else \
+            np.zeros(0, dtype=np.int64)
+
+        # the emissive triangles of each instance's mesh
+        mesh_id = instances.mesh_id.astype(np.int64)
+        first = np.searchsorted(emissive_tris, meshes.start_indices[mesh_id])
+        last = np.searchsorted(emissive_tris, meshes.end_indices[mesh_id])
+        counts = last - first
+        instance_index = np.repeat(np.arange(len(mesh_id)), counts)
+        # position of each light in its instance's run of emissive triangles
+        run_start = np.cumsum(counts) - counts
+        tri_index = emissive_tris[np.repeat(first - run_start, counts) + np.arange(counts.sum())]
+
+        # triangle corners in world space
+        corners = meshes.verts[meshes.tris[tri_index].astype(np.int64)]
+        matrices = instances.obj_to_world[instance_index]
+        corners = np.einsum('nij,nkj->nki', matrices[:, :3, :3], corners) + matrices[:, None, :3, 3]
+        self.v0, self.v1, self.v2 = (np.ascontiguousarray(corners[:, k], dtype=np.float32) for k in range(3))
+        self.mat_id = meshes.mat_indices[tri_index].astype(np.uint32)
+
+        # pick triangles by area times emitted luminance
+        area = 0.5 * np.linalg.norm(np.cross(self.v1 - self.v0, self.v2 - self.v0), axis=1)
+        power = area * luminance(emission[self.mat_id])
+        self.light_count = len(tri_index)
+        self.total_power = np.array([power.sum()], dtype=np.float32)
+        if self.light_count > 0 and self.total_power[0] > 0.0:
+            self.alias_prob, self.alias = build_alias_table(power.astype(np.float64))
+        else:
+            self.alias_prob, self.alias = np.ones(self.light_count, dtype=np.float32), \
+                np.arange(self.light_count, dtype=np.uint32)
+
+    def get_arrays(self):
+        ''' Returns a dict of the exported arrays by name '''
+        return {name: getattr(self, name)
+                for name in ('v0', 'v1', 'v2', 'mat_id', 'alias_prob', 'alias', 'total_power')}
+
+    def set_arrays(self, arrays):
+        ''' Takes the exported arrays of get_arrays, as loaded from a scene bundle '''
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.light_count = len(self.mat_id)
+
+    def update(self, lights):
+        ''' Take over the data of a newly exported LightCache keeping the rows that changed,
+            returns False if the number of lights changed
+        '''
+        if lights.light_count != self.light_count:
+            return False
+
+        old_arrays = self.get_arrays()
+        for name, array in lights.get_arrays().items():
+            for start, end in changed_ranges(old_arrays[name], array):
+                self.changes.append((name, int(start), array[start:end]))
+            setattr(self, name, array)
+        return True
+
+    def stats(self):
+        return "Light triangles {}".format(self.light_count)
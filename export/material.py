@@ -8,6 +8,9 @@ class MaterialCache:
     def __init__(self):
         self.materials = []  # a list of materials index = id
 
+        # (array name, first row, rows) of data updated in place since the last sync
+        self.changes = []
+
     def add(self, blender_material):
         if blender_material not in self.materials:
             self.materials.append(blender_material)
@@ -18,9 +21,39 @@ class MaterialCache:
             # fix if there is no materials
             self.color = np.array([[1.0, 0.0, 1.0, 1.0]], dtype=np.float32)
             self.emission_color = np.array([[1.0, 0.0, 1.0, 1.0]], dtype=np.float32)
+            self.pass_index = np.zeros(1, dtype=np.uint32)
         else:
             self.color = np.array([get_color(mat) for mat in self.materials], dtype=np.float32)
             self.emission_color = np.array([get_emission_color(mat) for mat in self.materials], dtype=np.float32)
+            self.pass_index = np.array([get_pass_index(mat) for mat in self.materials], dtype=np.uint32)
+
+    def get_arrays(self):
+        ''' Returns a dict of the exported arrays by name '''
+        return {name: getattr(self, name) for name in ('color', 'emission_color', 'pass_index')}
+
+    def set_arrays(self, arrays):
+        ''' Takes the exported arrays of get_arrays, as loaded from a scene bundle,
+            there are no blender materials so the list of materials is just their count
+        '''
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.materials = [None] * len(self.color)
+
+    def update(self, blender_material):
+        ''' Export a changed material again, materials not in the cache are not used so are skipped '''
+        matches = [i for i, mat in enumerate(self.materials)
+                   if mat is not None and mat.name_full == blender_material.name_full]
+        if matches == []:
+            return
+
+        i = matches[0]
+        self.materials[i] = blender_material
+        self.color[i] = get_color(blender_material)
+        self.emission_color[i] = get_emission_color(blender_material)
+        self.pass_index[i] = get_pass_index(blender_material)
+        self.changes.append(('color', i, self.color[i:i + 1]))
+        self.changes.append(('emission_color', i, self.emission_color[i:i + 1]))
+        self.changes.append(('pass_index', i, self.pass_index[i:i + 1]))
 
     def get_index(self, blender_material):
         self.add(blender_material)
@@ -34,6 +67,10 @@ def get_color(material):
         return list(material.diffuse_color)
 
 
+def get_pass_index(material):
+    return 0 if material is None else material.pass_index
+
+
 def get_emission_color(material):
     col = [0.0, 0.0, 0.0, 0.0]
 
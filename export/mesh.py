@@ -1,4 +1,6 @@
 import numpy as np
+from .bvh import BVH, build_mesh_bvh, compress_bvh, get_triangle_bounds, refit_bvh, NUM_BINS, MAX_LEAF_SIZE, \
+    bvh_stack_size, wide_stack_size, round_stack_size
 
 
 def get_mesh_tris(blender_mesh, offset):
@@ -29,75 +31,333 @@ def get_mesh_verts(blender_mesh):
     return data.reshape((num_verts, 3))
 
 
-def get_material_indices(blender_mesh, material_indices):
-    ''' Gets a numpy array of face material indices '''
+def get_material_slots(blender_mesh):
+    ''' Gets a numpy array of the material slot of each triangle '''
     num_indices = len(blender_mesh.loop_triangles)
     data = np.zeros(num_indices, dtype=np.uint32)
     blender_mesh.loop_triangles.foreach_get('material_index', data)
-    # convert internal indices to lookup vals
-    return np.array(material_indices, dtype=np.uint32)[data]
+    return data
 
 
-def export_mesh(blender_obj, triangle_offset, vertex_offset, material_indices):
-    ''' Gets numpy arrays of the mesh data '''
+def get_material_indices(mat_slots, material_indices):
+    ''' Converts triangle material slots to material lookup vals '''
+    return np.array(material_indices, dtype=np.uint32)[mat_slots]
+
+
+def get_mesh_topology(blender_mesh):
+    ''' Returns numpy arrays of the polygon loops, sizes and material slots
+        (used with the vertices to hash the mesh without triangulating it)
+    '''
+    loops = np.zeros(len(blender_mesh.loops), dtype=np.int32)
+    blender_mesh.loops.foreach_get('vertex_index', loops)
+    loop_totals = np.zeros(len(blender_mesh.polygons), dtype=np.int32)
+    blender_mesh.polygons.foreach_get('loop_total', loop_totals)
+    poly_materials = np.zeros(len(blender_mesh.polygons), dtype=np.int32)
+    blender_mesh.polygons.foreach_get('material_index', poly_materials)
+    return [loops, loop_totals, poly_materials]
+
+
+def build_bvh_arrays(verts, tris, bvh_layout):
+    ''' Builds the BVH of a mesh in a layout,
+        'LINEAR' (no BVH), 'BVH2' (binary) or 'BVH4' (compressed 4 wide)
+        Returns a dict of the BVH arrays indexing the mesh's own nodes and tris
+    '''
+    if bvh_layout == 'LINEAR':
+        return {}
+
+    bvh = build_mesh_bvh(verts, tris)
+    if bvh_layout == 'BVH2':
+        return {
+            'bvh_box_min': bvh.box_min,
+            'bvh_box_max': bvh.box_max,
+            'bvh_child_or_first': bvh.child_or_first,
+            'bvh_prim_count': bvh.prim_count,
+            'bvh_tri_indices': bvh.prim_indices
+        }
+
+    wide = compress_bvh(bvh)
+    return {
+        'wide_origin': wide.origin,
+        'wide_exponent': wide.exponent,
+        'wide_child_base': wide.child_base,
+        'wide_tri_base': wide.tri_base,
+        'wide_q_min': wide.q_min,
+        'wide_q_max': wide.q_max,
+        'wide_child_offset': wide.child_offset,
+        'wide_child_count': wide.child_count,
+        'bvh_tri_indices': wide.prim_indices
+    }
+
+
+def offset_bvh_arrays(bvh_arrays, node_offset, tri_offset):
+    ''' Returns the node count of a mesh BVH and its arrays offset into the global arrays '''
+    arrays = dict(bvh_arrays)
+    node_offset, tri_offset = np.uint32(node_offset), np.uint32(tri_offset)
+    if 'bvh_prim_count' in arrays:
+        is_leaf = arrays['bvh_prim_count'] > 0
+        arrays['bvh_child_or_first'] = arrays['bvh_child_or_first'] + np.where(is_leaf, tri_offset, node_offset)
+        node_count = len(arrays['bvh_prim_count'])
+    elif 'wide_child_base' in arrays:
+        arrays['wide_child_base'] = arrays['wide_child_base'] + node_offset
+        arrays['wide_tri_base'] = arrays['wide_tri_base'] + tri_offset
+        node_count = len(arrays['wide_child_base'])
+    else:
+        node_count = 0
+
+    if 'bvh_tri_indices' in arrays:
+        arrays['bvh_tri_indices'] = arrays['bvh_tri_indices'] + tri_offset
+    return node_count, arrays
+
+
+def get_stack_size(bvh_arrays, roots, node_offset=0):
+    ''' The most entries the traversal stack can hold for the BVHs in a dict of BVH arrays from the given roots,
+        with the nodes indexed from node_offset on (as in the arrays of one mesh offset into the scene's)
+    '''
+    if 'bvh_prim_count' in bvh_arrays:
+        return bvh_stack_size(bvh_arrays['bvh_child_or_first'].astype(np.int64) - node_offset,
+                              bvh_arrays['bvh_prim_count'], roots)
+    if 'wide_child_base' in bvh_arrays:
+        return wide_stack_size(bvh_arrays['wide_child_base'].astype(np.int64) - node_offset,
+                               bvh_arrays['wide_child_offset'], bvh_arrays['wide_child_count'], roots)
+    return 0
+
+
+def export_mesh_data(blender_obj, bvh_layout, cache=None):
+    ''' Gets numpy arrays of the mesh data in object space,
+        verts, tris, the material slot of each tri and the BVH arrays
+        If there is an export cache they are loaded from there when the mesh was exported before
+    '''
     blender_mesh = blender_obj.data
+
+    key = None
+    if cache is not None:
+        key = cache.key([get_mesh_verts(blender_mesh)] + get_mesh_topology(blender_mesh),
+                        (bvh_layout, NUM_BINS, MAX_LEAF_SIZE))
+        data = cache.load(key)
+        if data is not None:
+            return data
+
     blender_mesh.calc_loop_triangles()
+    data = {
+        'verts': get_mesh_verts(blender_mesh),
+        'tris': get_mesh_tris(blender_mesh, 0),
+        'mat_slots': get_material_slots(blender_mesh)
+    }
+    data.update(build_bvh_arrays(data['verts'], data['tris'], bvh_layout))
+
+    if cache is not None:
+        cache.store(key, data)
+    return data
 
-    vertices = get_mesh_verts(blender_mesh)
-    tris = get_mesh_tris(blender_mesh, vertex_offset)
-    mat_indices = get_material_indices(blender_mesh, material_indices)
+
+def export_mesh(blender_obj, triangle_offset, vertex_offset, material_indices, bvh_layout, node_offset, cache=None):
+    ''' Gets numpy arrays of the mesh data '''
+    data = export_mesh_data(blender_obj, bvh_layout, cache)
+
+    vertices = np.asarray(data['verts'])
+    tris = data['tris'] + np.uint32(vertex_offset)
+    mat_indices = get_material_indices(data['mat_slots'], material_indices)
+    bvh_arrays = {name: array for name, array in data.items() if name.startswith(('bvh_', 'wide_'))}
+    node_count, bvh_arrays = offset_bvh_arrays(bvh_arrays, node_offset, triangle_offset)
     # normals = get_mesh_normals(blender_mesh, triangle_offset)
     mesh_struct = (triangle_offset, (triangle_offset + len(tris)))
 
-    return mesh_struct, tris, vertices, mat_indices  # , normals
+    return mesh_struct, tris, vertices, mat_indices, node_count, bvh_arrays  # , normals
+
+
+def get_mesh_key(obj, material_indices):
+    ''' Objects with the same mesh datablock and materials share their exported mesh,
+        unless they have modifiers which make the evaluated mesh their own
+    '''
+    if len(obj.modifiers) > 0:
+        return obj.name_full
+    return (obj.data.name_full, tuple(material_indices))
 
 
 class MeshCache:
-    ''' Caches all the mesh data and a list of structs describing meshes '''
-    def __init__(self):
-        self.data = {}  # a dict of blender object: mesh_struct
+    ''' Caches all the mesh data and a list of structs describing meshes
+        Meshes are exported in add() and the arrays of all meshes are put together in commit()
+    '''
+    def __init__(self, bvh_layout='BVH2', cache=None):
+        self.data = {}  # a dict of blender object name: mesh index
+        self.mesh_keys = {}  # a dict of mesh key: mesh index
+        self.keys = []  # the mesh key of each mesh
+        self.bvh_layout = bvh_layout
+        self.cache = cache  # optional ExportCache of exported meshes
 
+        # triangles exported and the triangles of all objects if meshes weren't shared
         self.tri_count = 0
+        self.object_tri_count = 0
         self.vert_count = 0
         self.mesh_count = 0
+        self.node_count = 0
+        # entries the render's traversal stack has, enough for every mesh BVH
+        self.stack_size = 0
 
-    def add(self, obj, materials):
-        ''' Add an object mesh to the cache '''
-        if obj.name_full in self.data.keys():
-            return
+        # per mesh arrays to concatenate on commit
+        self.chunks = {
+            'tris': [np.zeros((0, 3), dtype=np.uint32)],
+            'verts': [np.zeros((0, 3), dtype=np.float32)],
+            'mat_indices': [np.zeros(0, dtype=np.uint32)],
+        }
+        self.start_indices = []
+        self.end_indices = []
+        self.bvh_roots = []
+        # names of the concatenated arrays after commit
+        self.array_names = []
+        # the vertex and BVH node rows of each mesh in the arrays
+        self.vert_ranges = []
+        self.node_ranges = []
 
+        # (array name, first row, rows) of data updated in place since the last sync
+        self.changes = []
+
+    def get_material_indices(self, obj, materials):
+        ''' Returns the material index of each material slot of an object '''
         material_indices = [materials.get_index(slot.material) for slot in obj.material_slots]
         if material_indices == []:
             # if no materials assigned set all to material 0
             material_indices = [0]
-        mesh_struct, mesh_tris, mesh_verts, mesh_mat_indices = export_mesh(obj,
-                                                                           self.tri_count,
-                                                                           self.vert_count,
-                                                                           material_indices)
+        return material_indices
+
+    def add(self, obj, materials):
+        ''' Add an object mesh to the cache '''
+        if obj.name_full in self.data.keys():
+            return
+
+        material_indices = self.get_material_indices(obj, materials)
+        key = get_mesh_key(obj, material_indices)
+        if key in self.mesh_keys:
+            # share the mesh already exported
+            mesh_index = self.mesh_keys[key]
+            self.data[obj.name_full] = mesh_index
+            self.object_tri_count += self.end_indices[mesh_index] - self.start_indices[mesh_index]
+            return
+
+        mesh_struct, mesh_tris, mesh_verts, mesh_mat_indices, node_count, bvh_arrays = \
+            export_mesh(obj, self.tri_count, self.vert_count, material_indices,
+                        self.bvh_layout, self.node_count, self.cache)
         start_index, end_index = mesh_struct
 
-        # copy the exported mesh data to the arrays
-        if self.mesh_count == 0:
-            self.tris = mesh_tris
-            self.verts = mesh_verts
-            self.mat_indices = mesh_mat_indices
-            self.start_indices = np.array([start_index], dtype=np.uint32)
-            self.end_indices = np.array([end_index], dtype=np.uint32)
-            # self.normals = normals
-        else:
-            self.tris = np.concatenate([self.tris, mesh_tris])
-            self.verts = np.concatenate([self.verts, mesh_verts])
-            self.mat_indices = np.concatenate([self.mat_indices, mesh_mat_indices])
-            self.start_indices = np.concatenate([self.start_indices, np.array([start_index], dtype=np.uint32)])
-            self.end_indices = np.concatenate([self.end_indices, np.array([end_index], dtype=np.uint32)])
-            # self.normals = np.concatenate([self.normals, normals])
+        # keep the exported mesh data until commit
+        self.chunks['tris'].append(mesh_tris)
+        self.chunks['verts'].append(mesh_verts)
+        self.chunks['mat_indices'].append(mesh_mat_indices)
+        # self.chunks['normals'].append(normals)
+        for name, array in bvh_arrays.items():
+            self.chunks.setdefault(name, []).append(array)
+        self.start_indices.append(start_index)
+        self.end_indices.append(end_index)
+        self.bvh_roots.append(self.node_count)
+        self.vert_ranges.append((self.vert_count, self.vert_count + len(mesh_verts)))
+        self.node_ranges.append((self.node_count, self.node_count + node_count))
 
         self.tri_count += mesh_tris.shape[0]
+        self.object_tri_count += mesh_tris.shape[0]
         self.vert_count += mesh_verts.shape[0]
+        self.node_count += node_count
         self.data[obj.name_full] = self.mesh_count
+        self.mesh_keys[key] = self.mesh_count
+        self.keys.append(key)
         self.mesh_count += 1
 
+    def commit(self):
+        ''' Concatenate the exported meshes into single arrays '''
+        for name, arrays in self.chunks.items():
+            setattr(self, name, np.concatenate(arrays))
+        self.array_names = list(self.chunks)
+        self.chunks = {}
+
+        self.start_indices = np.array(self.start_indices, dtype=np.uint32)
+        self.end_indices = np.array(self.end_indices, dtype=np.uint32)
+        self.bvh_roots = np.array(self.bvh_roots, dtype=np.uint32)
+        self.stack_size = round_stack_size(get_stack_size(self.get_arrays(), self.get_nonempty_roots()))
+
+        # trim the export cache once now all the meshes are stored
+        if self.cache is not None:
+            self.cache.evict()
+
+    def update(self, obj, materials):
+        ''' Export a changed object mesh again and write it over its old data in place
+            returns False if the mesh has a different number of triangles or vertices or is no longer
+            shared with the same objects, then the whole scene needs exporting again
+            (or for BVH4 if the new BVH has more nodes than the old one or needs a deeper traversal stack)
+        '''
+        mesh_index = self.data[obj.name_full]
+        material_indices = self.get_material_indices(obj, materials)
+        if get_mesh_key(obj, material_indices) != self.keys[mesh_index]:
+            return False
+
+        start_index, end_index = int(self.start_indices[mesh_index]), int(self.end_indices[mesh_index])
+        vert_start, vert_end = self.vert_ranges[mesh_index]
+        node_start, node_end = self.node_ranges[mesh_index]
+
+        # edits are one-off versions of a mesh, caching them would push out the meshes of full exports
+        mesh_struct, mesh_tris, mesh_verts, mesh_mat_indices, node_count, bvh_arrays = \
+            export_mesh(obj, start_index, vert_start, material_indices, self.bvh_layout, node_start)
+        if len(mesh_tris) != end_index - start_index or len(mesh_verts) != vert_end - vert_start:
+            return False
+        # the kernels were compiled with a traversal stack for the exported trees
+        if node_count > node_end - node_start or \
+                get_stack_size(bvh_arrays, [0] if end_index > start_index else [], node_start) > self.stack_size:
+            if self.bvh_layout != 'BVH2':
+                return False
+            # the new BVH needs more nodes than there is room for, or a deeper stack, refit the old one instead
+            bvh_arrays = self.refit_mesh_bvh(mesh_index, mesh_verts, mesh_tris - np.uint32(vert_start))
+
+        # a smaller BVH leaves unused nodes at the end of the mesh's node rows
+        arrays = {'tris': (start_index, mesh_tris), 'verts': (vert_start, mesh_verts),
+                  'mat_indices': (start_index, mesh_mat_indices)}
+        for name, array in bvh_arrays.items():
+            arrays[name] = (start_index if name == 'bvh_tri_indices' else node_start, array)
+
+        for name, (start, rows) in arrays.items():
+            getattr(self, name)[start:start + len(rows)] = rows
+            self.changes.append((name, start, getattr(self, name)[start:start + len(rows)]))
+        return True
+
+    def refit_mesh_bvh(self, mesh_index, verts, tris):
+        ''' Returns the BVH arrays of a mesh's current BVH refit to new vertices (tris index into verts) '''
+        start_index, end_index = int(self.start_indices[mesh_index]), int(self.end_indices[mesh_index])
+        node_start, node_end = self.node_ranges[mesh_index]
+
+        # convert the BVH back to indexing the mesh's own nodes and tris
+        prim_count = self.bvh_prim_count[node_start:node_end]
+        child_or_first = self.bvh_child_or_first[node_start:node_end] - \
+            np.where(prim_count > 0, start_index, node_start).astype(np.uint32)
+        prim_indices = self.bvh_tri_indices[start_index:end_index] - np.uint32(start_index)
+        bvh = BVH(self.bvh_box_min[node_start:node_end], self.bvh_box_max[node_start:node_end],
+                  child_or_first, prim_count, prim_indices)
+
+        tri_min, tri_max = get_triangle_bounds(verts, tris)
+        bvh = refit_bvh(bvh, tri_min, tri_max)
+        return {'bvh_box_min': bvh.box_min, 'bvh_box_max': bvh.box_max}
+
+    def get_arrays(self):
+        ''' Returns a dict of the exported arrays by name '''
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        arrays.update({name: getattr(self, name) for name in ('start_indices', 'end_indices', 'bvh_roots')})
+        return arrays
+
+    def set_arrays(self, arrays):
+        ''' Takes the exported arrays of get_arrays, as loaded from a scene bundle '''
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.array_names = [name for name in arrays if name not in ('start_indices', 'end_indices', 'bvh_roots')]
+        self.tri_count = self.object_tri_count = len(self.tris)
+        self.vert_count = len(self.verts)
+        self.mesh_count = len(self.start_indices)
+        self.node_count = len(arrays.get('bvh_prim_count', arrays.get('wide_child_base', ())))
+        self.stack_size = round_stack_size(get_stack_size(arrays, self.get_nonempty_roots()))
+
+    def get_nonempty_roots(self):
+        ''' The BVH roots of the meshes with triangles, rays skip the others '''
+        return self.bvh_roots[self.end_indices > self.start_indices]
+
     def get_mesh(self, obj, materials):
         if obj.name_full not in self.data.keys():
             self.add(obj, materials)
         return self.data[obj.name_full]
+
+    def stats(self):
+        return "Mesh triangles {}, {} without sharing meshes".format(self.tri_count, self.object_tri_count)
@@ -1,15 +1,25 @@
+import json
+import os
+import numpy as np
 from .mesh import MeshCache
 from .instance import InstanceCache
 from .material import MaterialCache
+from .light import LightCache
 from .camera import Camera
 
 
+# bump when the format of scene bundles changes
+BUNDLE_VERSION = 2
+
+
 class Scene:
-    ''' Scene data of meshes, instances, and materials'''
-    def __init__(self, depsgraph, resolution):
+    ''' Scene data of meshes, instances, materials and the emissive triangles of the instances '''
+    def __init__(self, depsgraph, resolution, bvh_layout='BVH2', cache=None):
         # Scene data contains a mapping of blender objects to numpy data
         # this is used for syncing data
-        self.meshes = MeshCache()
+        # cache is an optional ExportCache to save and load mesh data from
+        self.resolution = tuple(resolution)
+        self.meshes = MeshCache(bvh_layout, cache)
         self.instances = InstanceCache()
         self.materials = MaterialCache()
         self.camera = Camera(depsgraph.scene.camera, resolution[0], resolution[1])
@@ -24,11 +34,131 @@ class Scene:
             if instance.object.type == 'MESH':
                 self.instances.add(instance, self.meshes.get_mesh(instance.object, self.materials))
 
-        # commit materials
+        # commit meshes, instances and materials
+        self.meshes.commit()
+        self.instances.commit()
         self.materials.commit()
 
+        # lights are found in the committed data
+        self.lights = LightCache()
+        self.lights.commit(self.meshes, self.instances, self.materials)
+
+    def sync(self, depsgraph):
+        ''' Applies the depsgraph updates to the exported data in place, only exporting what changed
+            The changes lists of the meshes, instances, materials and lights hold the rows to upload,
+            the camera is exported again as it is cheap to.
+            Returns False if the updates can't be applied in place and the scene needs exporting again
+        '''
+        self.meshes.changes = []
+        self.instances.changes = []
+        self.materials.changes = []
+        self.lights.changes = []
+        material_count = len(self.materials.materials)
+        updated_meshes = set()
+        sync_instances = False
+
+        for update in depsgraph.updates:
+            datablock = update.id
+            if datablock.id_type == 'OBJECT':
+                camera = depsgraph.scene.camera
+                if camera is not None and datablock.name_full == camera.name_full:
+                    # exported again below, moving the camera doesn't change the scene data
+                    continue
+                if datablock.type == 'MESH' and update.is_updated_geometry:
+                    if datablock.name_full not in self.meshes.data:
+                        return False
+                    # objects sharing a mesh all get updated, only export it once
+                    mesh_index = self.meshes.data[datablock.name_full]
+                    if mesh_index not in updated_meshes:
+                        if not self.meshes.update(datablock, self.materials):
+                            return False
+                        updated_meshes.add(mesh_index)
+                # the bounds of the instances of an edited mesh change with it
+                sync_instances = sync_instances or update.is_updated_transform or update.is_updated_geometry
+            elif datablock.id_type == 'MATERIAL':
+                self.materials.update(datablock)
+            elif datablock.id_type in ('SCENE', 'COLLECTION'):
+                # objects might have been added or removed
+                sync_instances = True
+
+        if len(self.materials.materials) != material_count:
+            return False
+
+        if sync_instances:
+            instances = InstanceCache()
+            for instance in depsgraph.object_instances:
+                if instance.object.type == 'MESH':
+                    if instance.object.name_full not in self.meshes.data:
+                        return False
+                    instances.add(instance, self.meshes.data[instance.object.name_full])
+            instances.commit()
+            if not self.instances.update(instances):
+                return False
+
+        # find the emissive triangles again if anything they come from changed
+        if self.meshes.changes or self.instances.changes or self.materials.changes:
+            lights = LightCache()
+            lights.commit(self.meshes, self.instances, self.materials)
+            if not self.lights.update(lights):
+                return False
+
+        self.camera = Camera(depsgraph.scene.camera, self.resolution[0], self.resolution[1])
+        return True
+
+    def get_parts(self):
+        ''' The exported data to write to a scene bundle by name '''
+        return {'meshes': self.meshes, 'instances': self.instances, 'materials': self.materials,
+                'lights': self.lights}
+
+    def save(self, directory):
+        ''' Writes the exported scene as a scene bundle, a directory with a .npy file of each array and a
+            scene.json of the rest, that Scene.load memory maps back to render without Blender
+            scene.json lists the arrays of each part, so arrays left by an earlier bundle in the directory aren't loaded
+        '''
+        os.makedirs(directory, exist_ok=True)
+        arrays = {}
+        for part, data in self.get_parts().items():
+            arrays[part] = []
+            for name, array in data.get_arrays().items():
+                np.save(os.path.join(directory, '{}.{}.npy'.format(part, name)), np.ascontiguousarray(array))
+                arrays[part].append(name)
+
+        info = {
+            'version': BUNDLE_VERSION,
+            'resolution': list(self.resolution),
+            'bvh_layout': self.meshes.bvh_layout,
+            'camera_matrix': self.camera.matrix.tolist(),
+            'camera_angle': self.camera.angle,
+            'arrays': arrays,
+        }
+        with open(os.path.join(directory, 'scene.json'), 'w') as f:
+            json.dump(info, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, resolution=None):
+        ''' Loads a scene bundle written by save(), the camera is exported again at resolution if given '''
+        with open(os.path.join(directory, 'scene.json')) as f:
+            info = json.load(f)
+        if info['version'] != BUNDLE_VERSION:
+            raise ValueError("Scene bundle version {} is not {}".format(info['version'], BUNDLE_VERSION))
+
+        scene = cls.__new__(cls)
+        scene.resolution = tuple(resolution or info['resolution'])
+        scene.meshes = MeshCache(info['bvh_layout'])
+        scene.instances = InstanceCache()
+        scene.materials = MaterialCache()
+        scene.lights = LightCache()
+        scene.camera = Camera(None, scene.resolution[0], scene.resolution[1],
+                              np.array(info['camera_matrix'], dtype=np.float32), info['camera_angle'])
+
+        for part, data in scene.get_parts().items():
+            data.set_arrays({name: np.load(os.path.join(directory, '{}.{}.npy'.format(part, name)), mmap_mode='r')
+                             for name in info['arrays'][part]})
+        return scene
+
     def free(self):
         ''' clear any memory '''
         self.meshes = MeshCache()
         self.instances = InstanceCache()
         self.materials = MaterialCache()
+        self.lights = LightCache()
@@ -0,0 +1,183 @@
+import bpy
+
+
+# Addon and scene properties for this addon
+
+
+class BPRPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    use_export_cache: bpy.props.BoolProperty(
+        name="Export Cache",
+        description="Save exported meshes and their BVHs to disk and load them back if the mesh is unchanged",
+        default=True)
+    cache_directory: bpy.props.StringProperty(
+        name="Cache Directory",
+        description="Directory for the export cache (uses a temp directory if empty)",
+        subtype='DIR_PATH',
+        default="")
+    cache_size: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Least recently used meshes are removed from the cache when it is larger than this",
+        default=2048,
+        min=1)
+    backend: bpy.props.EnumProperty(
+        name="Backend",
+        description="Device Taichi compiles and runs the render kernels on",
+        items=[('gpu', "GPU", "The first GPU backend Taichi finds (CUDA, Vulkan or Metal), the CPU if none work"),
+               ('cpu', "CPU", "The CPU"),
+               ('cuda', "CUDA", "NVIDIA GPUs"),
+               ('vulkan', "Vulkan", "GPUs with Vulkan drivers"),
+               ('metal', "Metal", "Apple GPUs")],
+        default='gpu')
+    cpu_threads: bpy.props.IntProperty(
+        name="CPU Threads",
+        description="Threads the kernels run on with the CPU backend (0 uses every core)",
+        default=0,
+        min=0)
+    use_kernel_cache: bpy.props.BoolProperty(
+        name="Kernel Cache",
+        description="Save compiled kernels to disk and load them back for renders with the same settings",
+        default=True)
+    kernel_cache_directory: bpy.props.StringProperty(
+        name="Kernel Cache Directory",
+        description="Directory for compiled kernels (uses Taichi's default directory if empty)",
+        subtype='DIR_PATH',
+        default="")
+    use_warm_up: bpy.props.BoolProperty(
+        name="Warm Up Kernels",
+        description="Compile the kernels of the scene's final render in the background when the addon is enabled "
+                    "or a file is loaded, so the render loads them from the kernel cache",
+        default=True)
+    warm_up_max_faces: bpy.props.IntProperty(
+        name="Warm Up Max Faces",
+        description="Scenes with more faces than this after modifiers and instancing aren't warmed up, "
+                    "as exporting them holds up Blender",
+        default=500000,
+        min=0)
+
+    def draw(self, context):
+        self.layout.prop(self, 'use_export_cache')
+        col = self.layout.column()
+        col.enabled = self.use_export_cache
+        col.prop(self, 'cache_directory')
+        col.prop(self, 'cache_size')
+
+        self.layout.prop(self, 'backend')
+        self.layout.prop(self, 'cpu_threads')
+        self.layout.prop(self, 'use_kernel_cache')
+        col = self.layout.column()
+        col.enabled = self.use_kernel_cache
+        col.prop(self, 'kernel_cache_directory')
+        col.prop(self, 'use_warm_up')
+        sub = col.column()
+        sub.enabled = self.use_warm_up
+        sub.prop(self, 'warm_up_max_faces')
+
+
+class BPRRenderSettings(bpy.types.PropertyGroup):
+    render_mode: bpy.props.EnumProperty(
+        name="Render Mode",
+        description="How the render kernels trace rays",
+        items=[('MEGAKERNEL', "Megakernel", "Trace a bounce for every pixel in a single kernel"),
+               ('WAVEFRONT', "Wavefront",
+                "Queue the rays still rendering and find hits, shade and accumulate them in separate kernels")],
+        default='MEGAKERNEL')
+    sampler: bpy.props.EnumProperty(
+        name="Sampler",
+        description="Random numbers used for the pixel, material and light samples of paths",
+        items=[('SOBOL', "Sobol", "Owen scrambled Sobol points, the error falls faster as samples are added"),
+               ('RANDOM', "Random", "Independent random numbers")],
+        default='SOBOL')
+    use_light_sampling: bpy.props.BoolProperty(
+        name="Light Sampling",
+        description="Sample a point on the emissive triangles at each bounce, combined with hitting them by chance "
+                    "by multiple importance sampling",
+        default=True)
+    use_russian_roulette: bpy.props.BoolProperty(
+        name="Russian Roulette",
+        description="Randomly stop paths that carry little light, weighting the ones that continue to make up for them",
+        default=True)
+    roulette_depth: bpy.props.IntProperty(
+        name="Roulette Start Bounce",
+        description="Bounces every path makes before Russian roulette can stop it",
+        default=3,
+        min=1)
+    use_adaptive_sampling: bpy.props.BoolProperty(
+        name="Adaptive Sampling",
+        description="Stop sampling pixels once their noise is below the threshold",
+        default=False)
+    noise_threshold: bpy.props.FloatProperty(
+        name="Noise Threshold",
+        description="Relative error of a pixel's mean below which it stops sampling",
+        default=0.01,
+        min=0.0001,
+        max=1.0,
+        precision=4)
+    min_samples: bpy.props.IntProperty(
+        name="Min Samples",
+        description="Samples every pixel takes before it can stop",
+        default=16,
+        min=2)
+    use_denoising: bpy.props.BoolProperty(
+        name="Denoising",
+        description="Filter the noise of the final render, guided by the albedo and normal of the first hits",
+        default=False)
+    denoise_iterations: bpy.props.IntProperty(
+        name="Filter Passes",
+        description="Passes of the A-trous wavelet filter, each doubles the size of the filter",
+        default=3,
+        min=1,
+        max=10)
+    use_tiles: bpy.props.BoolProperty(
+        name="Tiles",
+        description="Render the image a tile at a time, so the per pixel render state only takes the memory of one tile",
+        default=False)
+    tile_size: bpy.props.IntProperty(
+        name="Tile Size",
+        description="Width and height in pixels of the tiles",
+        default=256,
+        min=8)
+    use_pixel_blocks: bpy.props.BoolProperty(
+        name="Pixel Blocks",
+        description="Lay the per pixel render state out in square blocks of pixels, so each CPU thread traces "
+                    "the coherent rays of neighbouring pixels",
+        default=False)
+    pixel_block_size: bpy.props.IntProperty(
+        name="Pixel Block Size",
+        description="Width and height in pixels of the blocks",
+        default=8,
+        min=2,
+        max=64)
+    bundle_directory: bpy.props.StringProperty(
+        name="Scene Bundle",
+        description="Also write the exported scene to this directory, to render it without Blender "
+                    "with python -m render (nothing is written if empty)",
+        subtype='DIR_PATH',
+        default="")
+    use_render_stats: bpy.props.BoolProperty(
+        name="Render Stats",
+        description="Count the rays, box and triangle tests and how paths stopped in the render kernels, "
+                    "and time each phase of the render (the kernels are slower with the counters)",
+        default=False)
+    stats_file: bpy.props.StringProperty(
+        name="Stats File",
+        description="JSON file to write the stats of each render to (printed if empty)",
+        subtype='FILE_PATH',
+        default="")
+
+
+def get_preferences():
+    return bpy.context.preferences.addons[__package__].preferences
+
+
+def register():
+    bpy.utils.register_class(BPRPreferences)
+    bpy.utils.register_class(BPRRenderSettings)
+    bpy.types.Scene.bpr = bpy.props.PointerProperty(type=BPRRenderSettings)
+
+
+def unregister():
+    del bpy.types.Scene.bpr
+    bpy.utils.unregister_class(BPRRenderSettings)
+    bpy.utils.unregister_class(BPRPreferences)
@@ -0,0 +1,122 @@
+''' Renders a scene bundle written by export.scene.Scene.save without Blender, to a .exr, .png or .npy image.
+    The samples can be split over local worker processes with --workers, or over machines by rendering a range
+    of the samples with --first-sample to an .npz of the raw sample sums, then passing the .npz files of every
+    range instead of the bundle to merge them. Run from the repo directory.
+
+    usage: python -m render BUNDLE [-o OUTPUT] [--arch {cpu,gpu,cuda,vulkan,metal}] [--samples N]
+                            [--resolution WIDTH HEIGHT] [--bounces N] [--tile-size N] [--denoise]
+                            [--workers N] [--first-sample N] [--seed N] [--stats JSON]
+           python -m render ACCUMULATION.npz [ACCUMULATION.npz ...] [-o OUTPUT]
+'''
+import argparse
+import time
+
+import numpy as np
+import taichi as ti
+
+try:
+    from ..export.scene import Scene
+except ImportError:
+    # run from the repo directory, where render and export are top level packages
+    from export.scene import Scene
+from . import render
+from . import stats
+from .image import write_image
+from .workers import render_samples, render_split, add, merge, save_accumulation, load_accumulation
+
+
+def render_scene(scene, samples, bounces, tile_size=0, denoising=False, arch=ti.gpu, seed=0, first_sample=0):
+    ''' Renders an exported scene a tile at a time, returns the (height, width, RGBA) image '''
+    width, height = scene.resolution
+    render.setup_render(scene, width, height, samples, bounces, tile_size=tile_size, denoising=denoising,
+                        seed=seed, first_sample=first_sample, arch=arch)
+    render.setup_output([])
+
+    image = np.zeros((height, width, 4), dtype=np.float32)
+    tiles = render.get_tiles()
+    for tile_index, (x, y, tile_width, tile_height) in enumerate(tiles):
+        render.set_tile(x, y, tile_width, tile_height)
+        while render.get_finished_pixels() < tile_width * tile_height:
+            render.render_pass()
+        image[y:y + tile_height, x:x + tile_width] = render.get_output().reshape(tile_height, tile_width, 4)
+        if denoising:
+            render.store_denoise_tile()
+        print("Tile {}/{}".format(tile_index + 1, len(tiles)))
+
+    if denoising:
+        render.denoise_image()
+        for x, y, tile_width, tile_height in tiles:
+            image[y:y + tile_height, x:x + tile_width] = \
+                render.get_denoised_tile(x, y, tile_width, tile_height).reshape(tile_height, tile_width, 4)
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="scene bundle directory, or .npz sample sums to merge")
+    parser.add_argument('-o', '--output', default='render.exr',
+                        help="image to write, .exr, .png or .npy, or .npz for the sample sums")
+    parser.add_argument('--arch', choices=list(render.ARCHS), default='gpu')
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--resolution', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help="defaults to the resolution the scene was exported at")
+    parser.add_argument('--bounces', type=int, default=8)
+    parser.add_argument('--tile-size', type=int, default=0, help="render in tiles of this size, 0 for no tiles")
+    parser.add_argument('--denoise', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help="processes to split the samples over")
+    parser.add_argument('--first-sample', type=int, default=0,
+                        help="render the samples of each pixel from this one on, for ranges of samples to merge")
+    parser.add_argument('--seed', type=int, default=0, help="scrambles the sample sequences of the pixels")
+    parser.add_argument('--stats', help="count the rays, box and triangle tests and how paths stopped, "
+                                        "and write them with the seconds of each phase of the render to this JSON")
+    args = parser.parse_args()
+
+    if all(path.endswith('.npz') for path in args.inputs):
+        write_image(args.output, merge([load_accumulation(path) for path in args.inputs]))
+        print("Merged {} into {}".format(len(args.inputs), args.output))
+        return
+    bundle = args.inputs[0]
+
+    t = time.time()
+    if args.output.endswith('.npz') or args.workers > 1:
+        if args.denoise:
+            parser.error("--denoise can't be used with split samples")
+        if args.stats:
+            # the counters are in the workers' processes
+            parser.error("--stats can't be used with split samples")
+        if args.workers > 1:
+            accumulations = render_split(bundle, args.resolution, args.samples, args.bounces, args.workers,
+                                         args.seed, args.tile_size, args.arch, args.first_sample)
+        else:
+            accumulations = [render_samples(bundle, args.resolution, args.first_sample, args.samples,
+                                            args.bounces, args.seed, args.tile_size, 0, args.arch)]
+        print("Rendered {} samples on {} workers in {:.2f}s".format(args.samples, len(accumulations),
+                                                                   time.time() - t))
+        if args.output.endswith('.npz'):
+            save_accumulation(args.output, add(accumulations))
+        else:
+            write_image(args.output, merge(accumulations))
+        print("Wrote", args.output)
+        return
+
+    scene = Scene.load(bundle, args.resolution)
+    load_seconds = time.time() - t
+    print("Loaded {} in {:.2f}s, {}, {}".format(bundle, load_seconds, scene.meshes.stats(), scene.lights.stats()))
+
+    stats.ENABLED = args.stats is not None
+    t = time.time()
+    image = render_scene(scene, args.samples, args.bounces, args.tile_size, args.denoise, render.ARCHS[args.arch],
+                         args.seed, args.first_sample)
+    print("Rendered {}x{} at {} samples in {:.2f}s".format(scene.resolution[0], scene.resolution[1], args.samples,
+                                                          time.time() - t))
+    write_image(args.output, image)
+    print("Wrote", args.output)
+    if args.stats:
+        # loading the bundle stands in for exporting the scene
+        stats.add_time('export', load_seconds)
+        stats.save(args.stats)
+        print("Wrote", args.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import taichi as ti
+import numpy as np
+from .vector import *
+from . import stats
+
+
+# BVH Node Struct
+# interior nodes have prim_count 0 and child_or_first is the left child (right child follows it)
+# leaves have child_or_first as the first index into the primitive index list
+BVHNode = ti.types.struct(box_min=Vector, box_max=Vector, child_or_first=ti.u32, prim_count=ti.u32)
+
+# Compressed 4 wide BVH Node Struct
+# child boxes are 8 bit offsets from origin in steps of 2^exponent on each axis
+# interior children are at child_base + child_offset, leaves have child_count tris
+# at tri_base + child_offset, child_count is 0 for interior and EMPTY_CHILD for unused
+WIDTH = 4
+EMPTY_CHILD = 255
+WideBVHNode = ti.types.struct(origin=Vector, exponent=ti.types.vector(3, ti.i8),
+                              child_base=ti.u32, tri_base=ti.u32,
+                              q_min=ti.types.matrix(WIDTH, 3, ti.u8), q_max=ti.types.matrix(WIDTH, 3, ti.u8),
+                              child_offset=ti.types.vector(WIDTH, ti.u8), child_count=ti.types.vector(WIDTH, ti.u8))
+
+# size of the traversal stack of nodes left to visit, set from the exported trees before the kernels compile
+STACK_SIZE = 64
+
+# stack of nodes left to visit with their entry t
+TraversalStack = ti.types.struct(nodes=ti.types.vector(STACK_SIZE, ti.i32), t=ti.types.vector(STACK_SIZE, ti.f32),
+                                 size=ti.i32)
+
+
+def set_stack_size(size):
+    ''' Sizes the traversal stack to hold the most nodes a traversal of the exported trees can leave on it '''
+    global STACK_SIZE, TraversalStack
+    STACK_SIZE = max(size, 1)
+    TraversalStack = ti.types.struct(nodes=ti.types.vector(STACK_SIZE, ti.i32),
+                                     t=ti.types.vector(STACK_SIZE, ti.f32), size=ti.i32)
+
+# scale the far slab distance up a little so float rounding never culls a box the ray
+# grazes (1 + 2 * gamma(3) from PBRT)
+ROBUST_SCALE = 1.0 + 2.0 * (3.0 * 2.0**-24) / (1.0 - 3.0 * 2.0**-24)
+
+
+def setup_nodes(nodes, box_min, box_max, child_or_first, prim_count):
+    ''' Uploads the flattened numpy node arrays to a field of BVHNodes,
+        which can have room for more nodes than there are
+    '''
+    count = len(prim_count)
+    if count > 0:
+        padding = [(0, nodes.shape[0] - count)]
+        nodes.box_min.from_numpy(np.pad(box_min, padding + [(0, 0)]))
+        nodes.box_max.from_numpy(np.pad(box_max, padding + [(0, 0)]))
+        nodes.child_or_first.from_numpy(np.pad(child_or_first, padding))
+        nodes.prim_count.from_numpy(np.pad(prim_count, padding))
+
+
+def setup_wide_nodes(nodes, origin, exponent, child_base, tri_base, q_min, q_max, child_offset, child_count):
+    ''' Uploads the flattened numpy node arrays to a field of WideBVHNodes '''
+    if len(child_base) > 0:
+        nodes.origin.from_numpy(origin)
+        nodes.exponent.from_numpy(exponent)
+        nodes.child_base.from_numpy(child_base)
+        nodes.tri_base.from_numpy(tri_base)
+        nodes.q_min.from_numpy(q_min)
+        nodes.q_max.from_numpy(q_max)
+        nodes.child_offset.from_numpy(child_offset)
+        nodes.child_count.from_numpy(child_count)
+
+
+@ti.func
+def decode_scale(exponent):
+    ''' Returns 2^exponent for each axis by building the float bits directly '''
+    scale = Vector(0.0)
+    for i in ti.static(range(3)):
+        scale[i] = ti.bit_cast((ti.cast(exponent[i], ti.i32) + 127) << 23, ti.f32)
+    return scale
+
+
+@ti.func
+def decode_child_box(node, c, scale):
+    ''' Returns the min, max of child c of a wide node '''
+    box_min = Vector(0.0)
+    box_max = Vector(0.0)
+    for i in ti.static(range(3)):
+        box_min[i] = node.origin[i] + ti.cast(node.q_min[c, i], ti.f32) * scale[i]
+        box_max[i] = node.origin[i] + ti.cast(node.q_max[c, i], ti.f32) * scale[i]
+    return box_min, box_max
+
+
+@ti.func
+def hit_aabb(box_min, box_max, r, t_min, t_max):
+    ''' Returns if a ray hits a bounding box between t_min and t_max and the entry t,
+        empty boxes (min above max on an axis) are never hit
+    '''
+    stats.count(stats.AABB_TESTS)
+    intersect = True
+    ray_direction, ray_origin = r.dir, r.orig
+
+    for i in ti.static(range(3)):
+        if ray_direction[i] == 0:
+            if ray_origin[i] < box_min[i] or ray_origin[i] > box_max[i]:
+                intersect = False
+        else:
+            i1 = (box_min[i] - ray_origin[i]) / ray_direction[i]
+            i2 = (box_max[i] - ray_origin[i]) / ray_direction[i]
+            # near and far slab by the direction rather than ordering them, so an empty box ends before it starts
+            near = ti.select(ray_direction[i] > 0, i1, i2)
+            far = ti.select(ray_direction[i] > 0, i2, i1)
+
+            t_max = ti.min(far * ROBUST_SCALE, t_max)
+            t_min = ti.max(near, t_min)
+
+    if t_min > t_max:
+        intersect = False
+    return intersect, t_min
+
+
+@ti.func
+def empty_stack():
+    return TraversalStack(nodes=ti.Vector([0] * STACK_SIZE, ti.i32), t=ti.Vector([0.0] * STACK_SIZE, ti.f32), size=0)
+
+
+@ti.func
+def push(stack: ti.template(), node_index, t):
+    ''' Pushes a node to visit and its entry t, the stack is sized for the exported trees so it never fills
+        (which asserts when taichi runs in debug mode)
+    '''
+    assert stack.size < STACK_SIZE, "BVH traversal stack overflow"
+    stack.nodes[stack.size] = node_index
+    stack.t[stack.size] = t
+    stack.size += 1
+
+
+@ti.func
+def pop(stack: ti.template()):
+    ''' Returns the node last pushed and its entry t '''
+    stack.size -= 1
+    return stack.nodes[stack.size], stack.t[stack.size]
+
+
+@ti.func
+def push_children(nodes: ti.template(), node, r, t_min, t_max, stack: ti.template()):
+    ''' Pushes the children of an interior binary BVH node the ray hits, the nearest last so it is visited first '''
+    left = ti.cast(node.child_or_first, ti.i32)
+    right = left + 1
+    left_node, right_node = nodes[left], nodes[right]
+    hit_left, t_left = hit_aabb(left_node.box_min, left_node.box_max, r, t_min, t_max)
+    hit_right, t_right = hit_aabb(right_node.box_min, right_node.box_max, r, t_min, t_max)
+
+    if hit_left and hit_right:
+        near, far = left, right
+        t_near, t_far = t_left, t_right
+        if t_right < t_left:
+            near, far = right, left
+            t_near, t_far = t_right, t_left
+        push(stack, far, t_far)
+        push(stack, near, t_near)
+    elif hit_left:
+        push(stack, left, t_left)
+    elif hit_right:
+        push(stack, right, t_right)
@@ -1,34 +1,66 @@
 import taichi as ti
 from .vector import *
 from .ray import Ray
+from .sync import place_fields, destroy_tree
 import math
 
 
-# data fields
-origin = Vector(0.0)
-lower_left_corner = Vector(0.0)
-horizontal = Vector(0.0)
-vertical = Vector(0.0)
-u = Vector(0.0)
-v = Vector(0.0)
+# Camera Struct
+# the vectors are kept in a field rather than compiled into the kernels,
+# so moving the camera only uploads them again
+camera = ti.types.struct(origin=Vector, origin_horizontal=Vector, origin_vertical=Vector,
+                         lower_left_corner=Vector, horizontal=Vector, vertical=Vector, u=Vector, v=Vector,
+                         position=Vector, forward=Vector)
+
+# data fields and the SNodeTree they are placed in
+camera_data = None
+tree = None
 
 
 def setup_data(exported_camera):
-    global origin, lower_left_corner, horizontal, vertical, u, v
-    origin = Vector(exported_camera.origin)
-    lower_left_corner = Vector(exported_camera.lower_left_corner)
-    horizontal = Vector(exported_camera.horizontal)
-    vertical = Vector(exported_camera.vertical)
-    u = Vector(exported_camera.u)
-    v = Vector(exported_camera.v)
+    global camera_data, tree
+    camera_data = camera.field()
+    tree = place_fields(((), camera_data))
+    update_data(exported_camera)
+
+
+def update_data(exported_camera):
+    ''' Uploads the vectors of an exported camera '''
+    camera_data.origin[None] = Vector(exported_camera.origin)
+    camera_data.origin_horizontal[None] = Vector(exported_camera.origin_horizontal)
+    camera_data.origin_vertical[None] = Vector(exported_camera.origin_vertical)
+    camera_data.lower_left_corner[None] = Vector(exported_camera.lower_left_corner)
+    camera_data.horizontal[None] = Vector(exported_camera.horizontal)
+    camera_data.vertical[None] = Vector(exported_camera.vertical)
+    camera_data.u[None] = Vector(exported_camera.u)
+    camera_data.v[None] = Vector(exported_camera.v)
+    camera_data.position[None] = Vector(exported_camera.position)
+    camera_data.forward[None] = Vector(exported_camera.forward)
+
+
+def clear_data():
+    global camera_data, tree
+    destroy_tree(tree)
+    tree = None
+    camera_data = None
 
 
 @ti.func
-def get_ray(s, t):
+def get_ray(s, t, time):
     ''' Computes random sample based on st of image space '''
+    c = camera_data[None]
     rd = ti.Vector([0.0, 0.0])
-    offset = u * rd.x + v * rd.y
+    offset = c.u * rd.x + c.v * rd.y
+    # the origin only moves across the image for orthographic cameras
+    origin = c.origin + s*c.origin_horizontal + t*c.origin_vertical
     return Ray(orig=(origin + offset),
-               dir=(lower_left_corner + s*horizontal
-                    + t*vertical - origin - offset),
-               time=ti.random())
+               dir=(c.lower_left_corner + s*c.horizontal
+                    + t*c.vertical - c.origin - offset),
+               time=time)
+
+
+@ti.func
+def get_depth(p):
+    ''' The depth of a point as in Blender's Z pass, its distance from the camera along the view axis '''
+    c = camera_data[None]
+    return (p - c.position).dot(c.forward)
@@ -0,0 +1,129 @@
+import taichi as ti
+from .vector import *
+from .sync import place_fields, destroy_tree
+
+
+# Edge avoiding A-trous wavelet filter (Dammertz et al. 2010) of the finished image, with the luminance edge
+# stopping scaled by the pixels' noise as in SVGF (Schied et al. 2017). The light reflected at the first hit is
+# divided by its albedo so texture isn't blurred, light emitted there isn't filtered so lights keep their edges,
+# and neighbours only count as much as their light, normal and albedo are close to the pixel's
+
+# B3 spline weights of the 5x5 kernel, spread out by twice the step each iteration
+KERNEL = [1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0]
+# widths of the edge stopping functions, luminance in standard deviations of the pixel's noise
+SIGMA_LUMINANCE = 4.0
+SIGMA_NORMAL = 0.3
+SIGMA_ALBEDO = 0.1
+# albedos below this are treated as this so the light can be divided by them
+ALBEDO_EPSILON = 0.01
+
+# the SNodeTree the image fields are placed in
+tree = None
+
+
+def setup_data(width, height):
+    ''' Creates the full image fields the tiles are copied to and filtered in '''
+    global color, albedo, normal, emission, irradiance, variance, image, tree
+    # image RGBA, replaced by the filtered image, and the first hit's albedo, normal and emission
+    color = ti.Vector.field(n=4, dtype=ti.f32)
+    albedo = Vector.field()
+    normal = Vector.field()
+    emission = Vector.field()
+    # light divided by albedo and the variance of its luminance, filtered back and forth between the two halves
+    irradiance = Vector.field()
+    variance = ti.field(dtype=ti.f32)
+    tree = place_fields(((width, height), color, albedo, normal, emission), ((2, width, height), irradiance, variance))
+    # filtered image as a numpy array
+    image = None
+
+
+def clear_data():
+    global color, albedo, normal, emission, irradiance, variance, image, tree
+    destroy_tree(tree)
+    color = albedo = normal = emission = irradiance = variance = image = tree = None
+
+
+@ti.func
+def get_albedo(i, j):
+    ''' Albedo to divide a pixel's light by, pixels without one (the background) are filtered as is '''
+    a = albedo[i, j]
+    if ti.max(a.x, a.y, a.z) < ALBEDO_EPSILON:
+        a = Vector(1.0)
+    return ti.max(a, ALBEDO_EPSILON)
+
+
+@ti.kernel
+def demodulate():
+    for i, j in color:
+        a = get_albedo(i, j)
+        irradiance[0, i, j] = ti.max(color[i, j].xyz - emission[i, j], 0.0) / a
+        variance[0, i, j] /= luminance(a) ** 2
+
+
+@ti.func
+def blurred_variance(src, i, j):
+    ''' Variance of a pixel blurred with its neighbours by a 3x3 gaussian, as the estimate of one pixel is noisy '''
+    width, height = color.shape
+    total = 0.0
+    weights = 0.0
+    for dx, dy in ti.static(ti.ndrange(3, 3)):
+        x = i + dx - 1
+        y = j + dy - 1
+        if 0 <= x < width and 0 <= y < height:
+            weight = ti.static([0.25, 0.5, 0.25][dx] * [0.25, 0.5, 0.25][dy])
+            total += variance[src, x, y] * weight
+            weights += weight
+    return total / weights
+
+
+@ti.kernel
+def filter_pass(src: ti.i32, step: ti.i32):
+    ''' Filters the irradiance and variance in half src to the other half with the kernel spread out by step pixels '''
+    width, height = color.shape
+    for i, j in color:
+        center = irradiance[src, i, j]
+        center_luminance = luminance(center)
+        center_normal = normal[i, j]
+        center_albedo = albedo[i, j]
+        luminance_scale = 1.0 / (SIGMA_LUMINANCE * ti.sqrt(blurred_variance(src, i, j)) + 1e-4)
+        total = Vector(0.0)
+        total_variance = 0.0
+        weights = 0.0
+        for dx, dy in ti.static(ti.ndrange(5, 5)):
+            x = i + (dx - 2) * step
+            y = j + (dy - 2) * step
+            if 0 <= x < width and 0 <= y < height:
+                value = irradiance[src, x, y]
+                weight = ti.static(KERNEL[dx] * KERNEL[dy]) * ti.exp(
+                    - ti.abs(luminance(value) - center_luminance) * luminance_scale
+                    - (normal[x, y] - center_normal).norm_sqr() * ti.static(1.0 / SIGMA_NORMAL ** 2)
+                    - (albedo[x, y] - center_albedo).norm_sqr() * ti.static(1.0 / SIGMA_ALBEDO ** 2))
+                total += value * weight
+                total_variance += variance[src, x, y] * weight * weight
+                weights += weight
+        irradiance[1 - src, i, j] = total / weights
+        variance[1 - src, i, j] = total_variance / (weights * weights)
+
+
+@ti.kernel
+def remodulate(src: ti.i32):
+    for i, j in color:
+        light = irradiance[src, i, j] * get_albedo(i, j) + emission[i, j]
+        color[i, j] = Vector4(light.x, light.y, light.z, color[i, j].w)
+
+
+def denoise(iterations):
+    ''' Filters the color field in place '''
+    global image
+    demodulate()
+    src = 0
+    for k in range(iterations):
+        filter_pass(src, 1 << k)
+        src = 1 - src
+    remodulate(src)
+    image = color.to_numpy()
+
+
+def get_tile(x, y, width, height):
+    ''' The filtered RGBA of a tile as rows of pixels '''
+    return image[x:x + width, y:y + height].swapaxes(0, 1).reshape(-1)
@@ -2,14 +2,14 @@ import taichi as ti
 from .vector import *
 
 
-# struct for recording ray hits
-HitRecord = ti.types.struct(p=Point, normal=Vector, t=ti.f32, front_face=ti.i32)
+# struct for recording ray hits, with the index of the instance hit
+HitRecord = ti.types.struct(p=Point, normal=Vector, t=ti.f32, front_face=ti.i32, instance_id=ti.i32)
 
 
 @ti.func
 def empty_hit_record():
     ''' Constructs an empty hit record'''
-    return HitRecord(p=Point(0.0), normal=Vector(0.0), t=0.0, front_face=1)
+    return HitRecord(p=Point(0.0), normal=Vector(0.0), t=0.0, front_face=1, instance_id=0)
 
 
 @ti.func
@@ -0,0 +1,61 @@
+import struct
+import numpy as np
+import taichi as ti
+
+
+# Writes rendered images outside of Blender, as .npy, 8 bit sRGB .png or 32 bit float .exr
+
+
+def linear_to_srgb(color):
+    color = np.clip(color, 0.0, 1.0)
+    return np.where(color <= 0.0031308, color * 12.92, 1.055 * color ** (1.0 / 2.4) - 0.055)
+
+
+def write_exr(path, pixels):
+    ''' Writes an uncompressed scanline OpenEXR of (height, width, RGBA) float pixels, bottom row first '''
+    height, width = pixels.shape[:2]
+
+    def attribute(name, kind, value):
+        return name.encode() + b'\0' + kind.encode() + b'\0' + struct.pack('<i', len(value)) + value
+
+    # channels are stored in alphabetical order as 32 bit floats
+    channels = 'ABGR'
+    channel_list = b''.join(c.encode() + b'\0' + struct.pack('<iB3xii', 2, 0, 1, 1) for c in channels) + b'\0'
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+    header = struct.pack('<ii', 20000630, 2) + \
+        attribute('channels', 'chlist', channel_list) + \
+        attribute('compression', 'compression', b'\0') + \
+        attribute('dataWindow', 'box2i', window) + \
+        attribute('displayWindow', 'box2i', window) + \
+        attribute('lineOrder', 'lineOrder', b'\0') + \
+        attribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0)) + \
+        attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0)) + \
+        attribute('screenWindowWidth', 'float', struct.pack('<f', 1.0)) + b'\0'
+
+    # scanlines go from the top of the image, each is its y, size and then every pixel of each channel
+    rows = np.ascontiguousarray(pixels[::-1][:, :, [3, 2, 1, 0]].transpose(0, 2, 1), dtype='<f4')
+    line_size = 8 + rows[0].nbytes
+    first_line = len(header) + 8 * height
+    offsets = np.arange(height, dtype='<u8') * line_size + first_line
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(offsets.tobytes())
+        for y in range(height):
+            f.write(struct.pack('<ii', y, rows[y].nbytes))
+            f.write(rows[y].tobytes())
+
+
+def write_image(path, pixels):
+    ''' Writes (height, width, RGBA) linear float pixels, bottom row first as in Blender,
+        in the format of the path's extension
+    '''
+    if path.endswith('.npy'):
+        np.save(path, pixels)
+    elif path.endswith('.exr'):
+        write_exr(path, pixels)
+    elif path.endswith('.png'):
+        image = np.concatenate([linear_to_srgb(pixels[:, :, :3]), np.clip(pixels[:, :, 3:], 0.0, 1.0)], axis=2)
+        # taichi images are indexed by x then y from the bottom
+        ti.tools.imwrite(np.ascontiguousarray(image.swapaxes(0, 1), dtype=np.float32), path)
+    else:
+        raise ValueError("Unknown image format of {}, use .exr, .png or .npy".format(path))
@@ -3,6 +3,9 @@ import taichi as ti
 from .hit_record import empty_hit_record
 from .vector import *
 from .ray import *
+from .bvh import BVHNode, hit_aabb, setup_nodes, empty_stack, push, pop, push_children
+from .sync import upload_changes, place_fields, destroy_tree
+from . import stats
 from . import mesh
 
 # Taichi Object Instance Struct
@@ -10,55 +13,61 @@ from . import mesh
 # (no nested instances since blender flattens for render)
 instance = ti.types.struct(box_min=Vector, box_max=Vector,
                            world_to_obj=Matrix4, obj_to_world=Matrix4,
-                           mesh_id=ti.u8)
+                           mesh_id=ti.u32, pass_index=ti.u32)
 
 
 NUM_INSTANCES = 0
 
+# the SNodeTree the instance fields are placed in
+tree = None
+
 
 def setup_data(exported_instances):
     ''' Creates taichi data fields from numpy arrays exported from Blender '''
-    # setup the pixel buffer and inflight rays
-    global NUM_INSTANCES, instance_data
+    global NUM_INSTANCES, instance_data, tlas_nodes, tlas_instance_indices, fields, tree
     NUM_INSTANCES = exported_instances.instance_count
-    instance_data = instance.field(shape=NUM_INSTANCES)
-    
+    instance_data = instance.field()
+    # top level BVH over the instance bounding boxes
+    # with room for the most nodes a rebuild over the same instances can have
+    tlas = exported_instances.tlas
+    tlas_nodes = BVHNode.field()
+    tlas_instance_indices = ti.field(dtype=ti.u32)
+    tree = place_fields((NUM_INSTANCES, instance_data),
+                        (max(len(tlas.prim_count), 2 * NUM_INSTANCES - 1, 1), tlas_nodes),
+                        (max(NUM_INSTANCES, 1), tlas_instance_indices))
+
     instance_data.box_min.from_numpy(exported_instances.box_min)
     instance_data.box_max.from_numpy(exported_instances.box_max)
     instance_data.world_to_obj.from_numpy(exported_instances.world_to_obj)
     instance_data.obj_to_world.from_numpy(exported_instances.obj_to_world)
     instance_data.mesh_id.from_numpy(exported_instances.mesh_id)
+    instance_data.pass_index.from_numpy(exported_instances.pass_index)
 
+    setup_nodes(tlas_nodes, tlas.box_min, tlas.box_max, tlas.child_or_first, tlas.prim_count)
+    if NUM_INSTANCES > 0:
+        tlas_instance_indices.from_numpy(tlas.prim_indices)
 
-def clear_data():
-    global instance_data
-    instance_data = None
+    # the field each exported array is uploaded to
+    fields = {name: getattr(instance_data, name)
+              for name in ('box_min', 'box_max', 'world_to_obj', 'obj_to_world', 'mesh_id', 'pass_index')}
+    fields.update({'tlas_' + name: getattr(tlas_nodes, name)
+                   for name in ('box_min', 'box_max', 'child_or_first', 'prim_count')})
+    fields['tlas_prim_indices'] = tlas_instance_indices
 
 
-@ti.func
-def hit_aabb(inst, r, t_min, t_max):
-    ''' Returns if a ray hits a bounding box of an instance '''
-    intersect = True
-    min_aabb, max_aabb = inst.box_min, inst.box_max
-    ray_direction, ray_origin = r.dir, r.orig
-
-    for i in ti.static(range(3)):
-        if ray_direction[i] == 0:
-            if ray_origin[i] < min_aabb[i] or ray_origin[i] > max_aabb[i]:
-                intersect = False
-        else:
-            i1 = (min_aabb[i] - ray_origin[i]) / ray_direction[i]
-            i2 = (max_aabb[i] - ray_origin[i]) / ray_direction[i]
-
-            new_t_max = ti.max(i1, i2)
-            new_t_min = ti.min(i1, i2)
+def update_data(exported_instances):
+    ''' Uploads the changed rows of the exported instance arrays, returns the bytes uploaded '''
+    return upload_changes(fields, exported_instances.changes)
 
-            t_max = ti.min(new_t_max, t_max)
-            t_min = ti.max(new_t_min, t_min)
 
-    if t_min > t_max:
-        intersect = False
-    return intersect
+def clear_data():
+    global instance_data, tlas_nodes, tlas_instance_indices, fields, tree
+    destroy_tree(tree)
+    tree = None
+    instance_data = None
+    tlas_nodes = None
+    tlas_instance_indices = None
+    fields = None
 
 
 @ti.func
@@ -77,37 +86,97 @@ def convert_to_object_space(inst, r):
     return Ray(orig=orig, dir=dir.normalized(), time=r.time)
 
 
+@ti.func
+def hit_instance(i, r, t_min, t_max, any_hit: ti.template()):
+    # test hit an instance, returns the mesh hit converted back to world space
+    hit_mesh = False
+    rec = empty_hit_record()
+    material_id = 0
+
+    inst = instance_data[i]
+    hit_box, t_box = hit_aabb(inst.box_min, inst.box_max, r, t_min, t_max)
+    if hit_box:
+        # convert ray and t to object space
+        r_object = convert_to_object_space(inst, r)
+        p_min_obj = convert_space(inst.world_to_obj, at(r, t_min), True)
+        p_max_obj = convert_space(inst.world_to_obj, at(r, t_max), True)
+        t_min_obj = t_from_p(r_object, p_min_obj)
+        t_max_obj = t_from_p(r_object, p_max_obj)
+        # now get the mesh hit, shadow rays only need to know there is one
+        if ti.static(any_hit):
+            hit_mesh = mesh.occluded(inst.mesh_id, r_object, t_min_obj, t_max_obj)
+        else:
+            hit_mesh, rec, material_id = mesh.hit(inst.mesh_id, r_object, t_min_obj, t_max_obj)
+            # if hit convert back to world
+            if hit_mesh:
+                rec.p = convert_space(inst.obj_to_world, rec.p, True)
+                rec.normal = convert_space(inst.obj_to_world, rec.normal, False).normalized()
+                rec.instance_id = i
+
+    return hit_mesh, rec, material_id
+
+
+@ti.func
+def get_pass_index(i):
+    return instance_data[i].pass_index
+
+
 @ti.func
 def hit(r, t_min, t_max):
-    # test hit all instances and return the closest mesh that is hit
+    # return the closest mesh that is hit
+    stats.count(stats.RAYS)
+    return traverse(r, t_min, t_max, False)
+
+
+@ti.func
+def occluded(r, t_min, t_max):
+    # if anything is hit between t_min and t_max, for shadow rays
+    stats.count(stats.SHADOW_RAYS)
+    hit_anything, rec, material_id = traverse(r, t_min, t_max, True)
+    return hit_anything
+
+
+@ti.func
+def traverse(r, t_min, t_max, any_hit: ti.template()):
+    # traverse the instance BVH and return the closest mesh that is hit, or the first for any_hit
 
     hit_anything = False
     material_id = 0
     rec = empty_hit_record()
 
-    i = 0
-    while i < NUM_INSTANCES:
-        # first check the instance bbox for hits
-        inst = instance_data[i]
-        hit_box = hit_aabb(inst, r, t_min, t_max)
-        if hit_box:
-            # convert ray and t to object space
-            r_object = convert_to_object_space(inst, r)
-            p_min_obj = convert_space(inst.world_to_obj, at(r, t_min), True)
-            p_max_obj = convert_space(inst.world_to_obj, at(r, t_max), True)
-            t_min_obj = t_from_p(r_object, p_min_obj)
-            t_max_obj = t_from_p(r_object, p_max_obj)
-            # now get the mesh hit
-            hit_mesh, temp_rec, temp_material_id = mesh.hit(inst.mesh_id, r_object,
-                                                            t_min_obj, t_max_obj)
-            # if hit set to closest and convert back to world
-            if hit_mesh:
-                hit_anything = True
-                rec = temp_rec
-                rec.p = convert_space(inst.obj_to_world, rec.p, True)
-                rec.normal = convert_space(inst.obj_to_world, rec.normal, False).normalized()
-                t_max = t_from_p(r, rec.p)
-                material_id = temp_material_id
-        i += 1
+    stack = empty_stack()
+    if ti.static(NUM_INSTANCES > 0):
+        root = tlas_nodes[0]
+        hit_root, t_root = hit_aabb(root.box_min, root.box_max, r, t_min, t_max)
+        if hit_root:
+            push(stack, 0, t_root)
+
+    while stack.size > 0:
+        if ti.static(any_hit):
+            if hit_anything:
+                break
+        node_index, t_node = pop(stack)
+        # skip nodes that are further than the closest hit found since it was pushed
+        if t_node > t_max:
+            continue
+
+        node = tlas_nodes[node_index]
+        if node.prim_count > 0:
+            # leaf, test the instances
+            first = ti.cast(node.child_or_first, ti.i32)
+            for k in range(ti.cast(node.prim_count, ti.i32)):
+                i = ti.cast(tlas_instance_indices[first + k], ti.i32)
+                hit_mesh, temp_rec, temp_material_id = hit_instance(i, r, t_min, t_max, any_hit)
+                # if hit set to closest
+                if hit_mesh:
+                    hit_anything = True
+                    rec = temp_rec
+                    t_max = t_from_p(r, rec.p)
+                    material_id = temp_material_id
+                    if ti.static(any_hit):
+                        break
+        else:
+            # interior, push the children so the nearest is visited first
+            push_children(tlas_nodes, node, r, t_min, t_max, stack)
 
     return hit_anything, rec, material_id
@@ -3,33 +3,115 @@ from .vector import *
 from .ray import Ray
 from . import instance
 from . import material
+from . import light
+from . import sampler
+from . import stats
 
 INFINITY = 99999999.9
+# shadow rays stop this fraction of the distance short of the light so they don't hit the light itself
+SHADOW_EPSILON = 0.001
+
+# sample a point on the lights at each bounce and weight it against hitting the lights by sampling the material
+LIGHT_SAMPLING = True
+
+# paths continue with probability of their throughput after this many bounces, 0 turns Russian roulette off
+ROULETTE_DEPTH = 3
+
+
+@ti.func
+def trace_ray(r, throughput, radiance, bsdf_pdf, background, bounce, last_bounce, path_sample):
+    hit, rec, mat_id = closest_hit(r)
+    return shade(r, throughput, radiance, bsdf_pdf, background, hit, rec, mat_id, bounce, last_bounce, path_sample)
+
+
+@ti.func
+def closest_hit(r):
+    ''' Returns if ray r hits anything, the hit record and material id '''
+    return instance.hit(r, 0.001, INFINITY)
 
 
 @ti.func
-def trace_ray(r, throughput, background):
+def power_heuristic(pdf, other_pdf):
+    ''' Multiple importance sampling weight of a sample from a strategy with pdf against another strategy '''
+    return pdf * pdf / (pdf * pdf + other_pdf * other_pdf)
+
+
+@ti.func
+def sample_light(p, wo, normal, mat_id, time, u):
+    ''' Returns the light reflected to wo from a point sampled on the lights, if it isn't in shadow '''
+    contribution = Vector4(0.0)
+    light_p, light_normal, light_mat_id, area_pdf = light.sample(u)
+    to_light = light_p - p
+    distance = to_light.norm()
+    wi = to_light.normalized()
+    cos_light = ti.abs(light_normal.dot(wi))
+    if distance > 0.0 and normal.dot(wi) > 0.0 and cos_light > 0.0 and area_pdf > 0.0:
+        shadow_ray = Ray(orig=p, dir=wi, time=time)
+        if not instance.occluded(shadow_ray, 0.001, distance * (1.0 - SHADOW_EPSILON)):
+            # the pdf of the direction by solid angle
+            light_pdf = area_pdf * distance * distance / cos_light
+            weight = power_heuristic(light_pdf, material.pdf(mat_id, wi, normal))
+            contribution = material.eval(mat_id, wi, wo, normal) * material.get_emission_color(light_mat_id) * \
+                weight / light_pdf
+    return contribution
+
+
+@ti.func
+def shade(r, throughput, radiance, bsdf_pdf, background, hit, rec, mat_id, bounce, last_bounce, path_sample):
+    ''' Continues a path from the closest hit of ray r, bsdf_pdf is the pdf of r's direction (0 for camera rays)
+        returns the next ray, throughput, light gathered by the path, pdf of the next ray and if the path stopped
+        bounce counts from 0 at the camera ray's hit, lights aren't sampled on the last bounce as the material
+        sampled ray that would be weighted against it is not traced, path_sample gives the random numbers of the bounce
+    '''
     ray_stop = False
 
-    hit, rec, mat_id = instance.hit(r, 0.001, INFINITY)
     if hit:
-        emitted_color = material.get_emission(mat_id, r, rec) * throughput
-        if emitted_color.w > 0.0:
-            throughput *= emitted_color
+        emission = material.get_emission(mat_id, r, rec)
+        if emission.w > 0.0:
+            # lights found by sampling the material are weighted against sampling them directly
+            weight = 1.0
+            if ti.static(LIGHT_SAMPLING and light.LIGHT_COUNT > 0):
+                if bsdf_pdf > 0.0:
+                    distance = (rec.p - r.orig).norm()
+                    cos_light = ti.abs(rec.normal.dot(r.dir.normalized()))
+                    light_pdf = light.area_pdf(mat_id) * distance * distance / cos_light
+                    weight = power_heuristic(bsdf_pdf, light_pdf)
+            radiance += throughput * emission * weight
             ray_stop = True
+            stats.count(stats.STOPPED_LIGHT)
         else:
             wo = - r.dir.normalized()
             normal = rec.normal.normalized()
-            wi = material.sample(mat_id, wo, normal)
-            pdf = material.pdf(mat_id, wi, normal)
+            if ti.static(LIGHT_SAMPLING and light.LIGHT_COUNT > 0):
+                if not last_bounce:
+                    radiance += throughput * sample_light(rec.p, wo, normal, mat_id, r.time,
+                                                          sampler.get_4d(path_sample, sampler.LIGHT_DIMENSION))
 
-            throughput *= material.eval(mat_id, wi, wo, normal) / pdf
+            u = sampler.get_4d(path_sample, sampler.MATERIAL_DIMENSION)
+            wi = material.sample(mat_id, wo, normal, ti.Vector([u[0], u[1]]))
+            bsdf_pdf = material.pdf(mat_id, wi, normal)
+
+            if bsdf_pdf > 0.0:
+                throughput *= material.eval(mat_id, wi, wo, normal) / bsdf_pdf
+            else:
+                ray_stop = True
             # stop if throughput is small
             if throughput.x < 0.0001 and throughput.y < 0.0001 and throughput.z < 0.0001:
                 ray_stop = True
+            if ti.static(ROULETTE_DEPTH > 0):
+                # continue with the probability of the throughput and make up for the stopped paths
+                if bounce + 1 >= ROULETTE_DEPTH and not ray_stop:
+                    survive = ti.min(ti.max(throughput.x, throughput.y, throughput.z), 1.0)
+                    if u[2] >= survive:
+                        ray_stop = True
+                    else:
+                        throughput /= survive
+            if ray_stop:
+                stats.count(stats.STOPPED_THROUGHPUT)
             r = Ray(orig=rec.p, dir=wi, time=r.time)
     else:
-        throughput *= background
+        radiance += throughput * background
         ray_stop = True
+        stats.count(stats.STOPPED_MISS)
 
-    return r, throughput, ray_stop
+    return r, throughput, radiance, bsdf_pdf, ray_stop
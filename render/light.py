@@ -0,0 +1,81 @@
+import taichi as ti
+from .vector import *
+from .sync import upload_changes, place_fields, destroy_tree
+from . import material
+
+
+# Light Struct
+# a world space emissive triangle, its material and its column of the alias table
+light = ti.types.struct(v0=Point, v1=Point, v2=Point, mat_id=ti.u32, alias_prob=ti.f32, alias=ti.u32)
+
+
+LIGHT_COUNT = 0
+
+# the SNodeTree the light fields are placed in
+tree = None
+
+
+def setup_data(exported_lights):
+    ''' Creates taichi data fields from numpy arrays exported from Blender '''
+    global LIGHT_COUNT, light_data, total_power, fields, tree
+    LIGHT_COUNT = exported_lights.light_count
+    light_data = light.field()
+    # sum of the power of the lights, a field so it can change on sync
+    total_power = ti.field(dtype=ti.f32)
+    tree = place_fields((max(LIGHT_COUNT, 1), light_data), (1, total_power))
+
+    if LIGHT_COUNT > 0:
+        for name in ('v0', 'v1', 'v2', 'mat_id', 'alias_prob', 'alias'):
+            getattr(light_data, name).from_numpy(getattr(exported_lights, name))
+    total_power.from_numpy(exported_lights.total_power)
+
+    # the field each exported array is uploaded to
+    fields = {name: getattr(light_data, name) for name in ('v0', 'v1', 'v2', 'mat_id', 'alias_prob', 'alias')}
+    fields['total_power'] = total_power
+
+
+def update_data(exported_lights):
+    ''' Uploads the changed rows of the exported light arrays, returns the bytes uploaded '''
+    return upload_changes(fields, exported_lights.changes)
+
+
+def clear_data():
+    global light_data, total_power, fields, tree
+    destroy_tree(tree)
+    tree = None
+    light_data = None
+    total_power = None
+    fields = None
+
+
+@ti.func
+def pick(u):
+    ''' Picks a light with probability proportional to its power using the alias table and 2 numbers in [0, 1) '''
+    i = ti.min(ti.cast(u[0] * LIGHT_COUNT, ti.i32), LIGHT_COUNT - 1)
+    if u[1] >= light_data[i].alias_prob:
+        i = ti.cast(light_data[i].alias, ti.i32)
+    return i
+
+
+@ti.func
+def sample(u):
+    ''' Samples a point on a light picked by power from 4 numbers in [0, 1)
+        returns the point, the light's normal, its material and the pdf of the point by area
+    '''
+    l = light_data[pick(ti.Vector([u[2], u[3]]))]
+    # uniform point in the triangle
+    su = ti.sqrt(u[0])
+    b0, b1 = 1.0 - su, u[1] * su
+    p = b0 * l.v0 + b1 * l.v1 + (1.0 - b0 - b1) * l.v2
+
+    normal = (l.v1 - l.v0).cross(l.v2 - l.v0).normalized()
+    mat_id = ti.cast(l.mat_id, ti.i32)
+    return p, normal, mat_id, area_pdf(mat_id)
+
+
+@ti.func
+def area_pdf(mat_id):
+    ''' The pdf by area of sampling any point on lights of a material,
+        a light's pick probability is its power over the total so over its area this is just its luminance
+    '''
+    return luminance(material.get_emission_color(mat_id)) / total_power[0]
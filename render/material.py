@@ -1,33 +1,49 @@
 import taichi as ti
-from .vector import Vector4, random_in_hemi_sphere
+from .vector import Vector, Vector4, random_in_hemi_sphere, cosine_in_hemi_sphere
 from .ray import Ray
+from .sync import upload_changes, place_fields, destroy_tree
 import math
 
 
 INV_PI = 1.0 / math.pi
+INV_2PI = 0.5 / math.pi
 
+# sample directions by the cosine to the normal like the diffuse BSDF, otherwise uniformly over the hemisphere
+COSINE_SAMPLING = True
 
-# Taichi data node
-DATA = None
+
+# the SNodeTree the material fields are placed in
+tree = None
 
 
 def setup_data(exported_materials):
     ''' Creates taichi data fields from numpy arrays exported from Blender '''
     # setup the data fields
-    global DATA, color_data, emission_data
-    DATA = ti.root.dense(ti.i, len(exported_materials.materials))
+    global color_data, emission_data, pass_index_data, fields, tree
     # material data fields
     color_data = Vector4.field()
     emission_data = Vector4.field()
-    DATA.place(color_data, emission_data)
+    pass_index_data = ti.field(dtype=ti.u32)
+    tree = place_fields((len(exported_materials.materials), color_data, emission_data, pass_index_data))
 
     color_data.from_numpy(exported_materials.color)
     emission_data.from_numpy(exported_materials.emission_color)
+    pass_index_data.from_numpy(exported_materials.pass_index)
+
+    # the field each exported array is uploaded to
+    fields = {'color': color_data, 'emission_color': emission_data, 'pass_index': pass_index_data}
+
+
+def update_data(exported_materials):
+    ''' Uploads the changed rows of the exported material arrays, returns the bytes uploaded '''
+    return upload_changes(fields, exported_materials.changes)
 
 
 def clear_data():
-    global DATA
-    DATA = None
+    global fields, tree
+    destroy_tree(tree)
+    tree = None
+    fields = None
 
 
 @ti.func
@@ -35,24 +51,44 @@ def get_color(i):
     return color_data[i]
 
 
+@ti.func
+def get_pass_index(i):
+    return pass_index_data[i]
+
+
 @ti.func
 def eval(mat_id, wi, wo, normal):
     return get_color(mat_id) * INV_PI * normal.dot(wi.normalized())
 
 
 @ti.func
-def sample(mat_id, wo, normal):
-    return random_in_hemi_sphere(normal)
+def sample(mat_id, wo, normal, u):
+    wi = Vector(0.0)
+    if ti.static(COSINE_SAMPLING):
+        wi = cosine_in_hemi_sphere(normal, u)
+    else:
+        wi = random_in_hemi_sphere(normal, u)
+    return wi
 
 
 @ti.func
 def pdf(mat_id, wi, normal):
+    # the density sample() picks directions with
+    pdf = 0.0
     cosine = normal.dot(wi.normalized())
-    if cosine < 0.0:
-        cosine = 0
-    return cosine * INV_PI
+    if cosine >= 0.0:
+        if ti.static(COSINE_SAMPLING):
+            pdf = cosine * INV_PI
+        else:
+            pdf = INV_2PI
+    return pdf
+
+
+@ti.func
+def get_emission_color(i):
+    return emission_data[i]
 
 
 @ti.func
 def get_emission(mat_id, r, rec):
-    return emission_data[mat_id]
+    return get_emission_color(mat_id)
@@ -2,43 +2,101 @@ import taichi as ti
 from .vector import *
 from . import ray
 from .hit_record import empty_hit_record, set_face_normal
+from .bvh import BVHNode, WideBVHNode, WIDTH, EMPTY_CHILD, hit_aabb, setup_nodes, setup_wide_nodes, decode_scale, \
+    decode_child_box, empty_stack, push, pop, push_children
+from .sync import upload_changes, place_fields, destroy_tree
+from . import stats
 import sys
 
+INFINITY = 99999999.9
+
 # Mesh Struct
-# holds start, end index to list of triangles
-mesh = ti.types.struct(start_index=ti.u32, end_index=ti.u32)
+# holds start, end index to list of triangles and the root node of the mesh BVH
+mesh = ti.types.struct(start_index=ti.u32, end_index=ti.u32, bvh_root=ti.u32)
+
+# the acceleration structure exported meshes use
+# 'LINEAR' tests every triangle, 'BVH2' binary BVH, 'BVH4' compressed 4 wide BVH
+BVH_LAYOUT = 'BVH2'
+
+# the SNodeTree the mesh fields are placed in
+tree = None
 
 
 def setup_data(exported_meshes):
     ''' Creates taichi data fields from numpy arrays exported from Blender '''
-    # setup the pixel buffer and inflight rays
-    global tris, verts, mat_indices, meshes
+    global tris, verts, mat_indices, meshes, bvh_nodes, wide_nodes, bvh_tri_indices, BVH_LAYOUT, fields, tree
+    BVH_LAYOUT = exported_meshes.bvh_layout
+    verts = Point.field()
+    tris = ti.field(dtype=ti.u32)
+    mat_indices = ti.field(dtype=ti.u32)
+    meshes = mesh.field()
+    placements = [(exported_meshes.vert_count, verts), ((exported_meshes.tri_count, 3), tris),
+                  (exported_meshes.tri_count, mat_indices), (len(exported_meshes.start_indices), meshes)]
+    if BVH_LAYOUT == 'BVH2':
+        bvh_nodes = BVHNode.field()
+        placements.append((max(len(exported_meshes.bvh_prim_count), 1), bvh_nodes))
+    elif BVH_LAYOUT == 'BVH4':
+        wide_nodes = WideBVHNode.field()
+        placements.append((max(len(exported_meshes.wide_child_base), 1), wide_nodes))
+    if BVH_LAYOUT != 'LINEAR':
+        bvh_tri_indices = ti.field(dtype=ti.u32)
+        placements.append((max(exported_meshes.tri_count, 1), bvh_tri_indices))
+    tree = place_fields(*placements)
 
-    verts = Point.field(shape=exported_meshes.vert_count)
     verts.from_numpy(exported_meshes.verts)
-
-    tris = ti.field(dtype=ti.u32, shape=(exported_meshes.tri_count, 3))
     tris.from_numpy(exported_meshes.tris)
-
-    mat_indices = ti.field(dtype=ti.u8, shape=exported_meshes.tri_count)
     mat_indices.from_numpy(exported_meshes.mat_indices)
-
-    meshes = mesh.field(shape=len(exported_meshes.start_indices))
     meshes.start_index.from_numpy(exported_meshes.start_indices)
     meshes.end_index.from_numpy(exported_meshes.end_indices)
+    meshes.bvh_root.from_numpy(exported_meshes.bvh_roots)
+
+    if BVH_LAYOUT == 'BVH2':
+        setup_nodes(bvh_nodes, exported_meshes.bvh_box_min, exported_meshes.bvh_box_max,
+                    exported_meshes.bvh_child_or_first, exported_meshes.bvh_prim_count)
+    elif BVH_LAYOUT == 'BVH4':
+        setup_wide_nodes(wide_nodes, exported_meshes.wide_origin, exported_meshes.wide_exponent,
+                         exported_meshes.wide_child_base, exported_meshes.wide_tri_base,
+                         exported_meshes.wide_q_min, exported_meshes.wide_q_max,
+                         exported_meshes.wide_child_offset, exported_meshes.wide_child_count)
+    if BVH_LAYOUT != 'LINEAR' and exported_meshes.tri_count > 0:
+        bvh_tri_indices.from_numpy(exported_meshes.bvh_tri_indices)
+
+    # the field each exported array is uploaded to
+    fields = {'verts': verts, 'tris': tris, 'mat_indices': mat_indices}
+    if BVH_LAYOUT == 'BVH2':
+        fields.update({'bvh_' + name: getattr(bvh_nodes, name)
+                       for name in ('box_min', 'box_max', 'child_or_first', 'prim_count')})
+    elif BVH_LAYOUT == 'BVH4':
+        fields.update({'wide_' + name: getattr(wide_nodes, name)
+                       for name in ('origin', 'exponent', 'child_base', 'tri_base', 'q_min', 'q_max',
+                                    'child_offset', 'child_count')})
+    if BVH_LAYOUT != 'LINEAR':
+        fields['bvh_tri_indices'] = bvh_tri_indices
+
+
+def update_data(exported_meshes):
+    ''' Uploads the changed ranges of the exported mesh arrays, returns the bytes uploaded '''
+    return upload_changes(fields, exported_meshes.changes)
 
 
 def clear_data():
-    global tris, verts, mat_indices, meshes
+    global tris, verts, mat_indices, meshes, bvh_nodes, wide_nodes, bvh_tri_indices, fields, tree
+    destroy_tree(tree)
+    tree = None
     tris = None
     verts = None
     mat_indices = None
     meshes = None
+    bvh_nodes = None
+    wide_nodes = None
+    bvh_tri_indices = None
+    fields = None
 
 
 @ti.func
 def hit_triangle(v0, v1, v2, r, t_min, t_max):
     ''' Intersect a ray with a triangle '''
+    stats.count(stats.TRIANGLE_TESTS)
     hit = False
     rec = empty_hit_record()
 
@@ -64,31 +122,154 @@ def hit_triangle(v0, v1, v2, r, t_min, t_max):
     return hit, rec
 
 
+@ti.func
+def hit_tri(i, r, t_min, t_max, closest, rec):
+    # test a triangle and keep it if it is the closest hit
+    # (on equal t the later triangle wins like testing them in order)
+    v0_i, v1_i, v2_i = ti.cast(tris[i, 0], ti.i32), ti.cast(tris[i, 1], ti.i32), ti.cast(tris[i, 2], ti.i32)
+    hit_tri, temp_rec = hit_triangle(verts[v0_i],
+                                     verts[v1_i],
+                                     verts[v2_i],
+                                     r, t_min, t_max)
+
+    if hit_tri and (temp_rec.t < t_max or i > closest):
+        closest = i
+        rec = temp_rec
+        t_max = rec.t
+        set_face_normal(r, rec.normal, rec)
+    return closest, rec, t_max
+
+
+@ti.func
+def hit_leaf(first, count, r, t_min, t_max, closest, rec):
+    # test the triangles of a BVH leaf
+    for k in range(count):
+        i = ti.cast(bvh_tri_indices[first + k], ti.i32)
+        closest, rec, t_max = hit_tri(i, r, t_min, t_max, closest, rec)
+    return closest, rec, t_max
+
+
+@ti.func
+def hit_linear(m, r, t_min, t_max, closest, rec, any_hit: ti.template()):
+    # hit all tris in a mesh
+    i = ti.cast(m.start_index, ti.i32)
+    while i < ti.cast(m.end_index, ti.i32):
+        if ti.static(any_hit):
+            if closest >= 0:
+                break
+        closest, rec, t_max = hit_tri(i, r, t_min, t_max, closest, rec)
+        i += 1
+    return closest, rec
+
+
+@ti.func
+def visit_bvh2(node_index, r, t_min, t_max, closest, rec, stack: ti.template()):
+    # test the triangles of a binary BVH leaf or push the children of an interior node
+    node = bvh_nodes[node_index]
+    if node.prim_count > 0:
+        closest, rec, t_max = hit_leaf(ti.cast(node.child_or_first, ti.i32),
+                                       ti.cast(node.prim_count, ti.i32),
+                                       r, t_min, t_max, closest, rec)
+    else:
+        push_children(bvh_nodes, node, r, t_min, t_max, stack)
+    return closest, rec, t_max
+
+
+@ti.func
+def visit_bvh4(node_index, r, t_min, t_max, closest, rec, stack: ti.template()):
+    # test the leaf children of a compressed 4 wide node right away and push the interior ones that are hit
+    node = wide_nodes[node_index]
+    scale = decode_scale(node.exponent)
+
+    child_nodes = ti.Vector([-1] * WIDTH)
+    child_t = ti.Vector([-INFINITY] * WIDTH)
+    for c in ti.static(range(WIDTH)):
+        count = ti.cast(node.child_count[c], ti.i32)
+        if count != EMPTY_CHILD:
+            box_min, box_max = decode_child_box(node, c, scale)
+            hit_box, t_box = hit_aabb(box_min, box_max, r, t_min, t_max)
+            if hit_box:
+                if count == 0:
+                    child_nodes[c] = ti.cast(node.child_base + node.child_offset[c], ti.i32)
+                    child_t[c] = t_box
+                else:
+                    closest, rec, t_max = hit_leaf(ti.cast(node.tri_base + node.child_offset[c], ti.i32),
+                                                   count, r, t_min, t_max, closest, rec)
+
+    # sort the interior children far to near so the nearest is visited first
+    for a, b in ti.static([(0, 1), (2, 3), (0, 2), (1, 3), (1, 2)]):
+        if child_t[a] < child_t[b]:
+            child_t[a], child_t[b] = child_t[b], child_t[a]
+            child_nodes[a], child_nodes[b] = child_nodes[b], child_nodes[a]
+    for c in ti.static(range(WIDTH)):
+        if child_nodes[c] >= 0:
+            push(stack, child_nodes[c], child_t[c])
+    return closest, rec, t_max
+
+
+@ti.func
+def hit_bvh(m, r, t_min, t_max, closest, rec, any_hit: ti.template()):
+    # traverse the mesh BVH in the exported layout, stopping at the first hit for any_hit
+    stack = empty_stack()
+    root = ti.cast(m.bvh_root, ti.i32)
+    if ti.static(BVH_LAYOUT == 'BVH2'):
+        root_node = bvh_nodes[root]
+        hit_root, t_root = hit_aabb(root_node.box_min, root_node.box_max, r, t_min, t_max)
+        if hit_root:
+            push(stack, root, t_root)
+    else:
+        # wide nodes only hold the boxes of their children
+        push(stack, root, t_min)
+
+    while stack.size > 0:
+        if ti.static(any_hit):
+            if closest >= 0:
+                break
+        node_index, t_node = pop(stack)
+        # skip nodes that are further than the closest hit found since it was pushed
+        if t_node > t_max:
+            continue
+
+        if ti.static(BVH_LAYOUT == 'BVH2'):
+            closest, rec, t_max = visit_bvh2(node_index, r, t_min, t_max, closest, rec, stack)
+        else:
+            closest, rec, t_max = visit_bvh4(node_index, r, t_min, t_max, closest, rec, stack)
+
+    return closest, rec
+
+
 @ti.func
 def hit(mesh_index, r, t_min, t_max):
-    # hit all tris in a mesh and return the hit record and mesh material that is hit
+    # hit the tris in a mesh and return the hit record and mesh material that is hit
+    return traverse(mesh_index, r, t_min, t_max, False)
+
+
+@ti.func
+def occluded(mesh_index, r, t_min, t_max):
+    # if any tri of a mesh is hit between t_min and t_max, for shadow rays
+    hit_anything, rec, material_id = traverse(mesh_index, r, t_min, t_max, True)
+    return hit_anything
+
+
+@ti.func
+def traverse(mesh_index, r, t_min, t_max, any_hit: ti.template()):
+    # find the closest hit of the tris in a mesh, or the first hit found for any_hit
 
     hit_anything = False
     material_id = 0
     rec = empty_hit_record()
+    # index of the closest triangle hit
+    closest = -1
 
-    m = meshes[mesh_index]
-
-    i = m.start_index
-    while i < m.end_index:
-        v0_i, v1_i, v2_i = tris[i, 0], tris[i, 1], tris[i, 2]
-        hit_tri, temp_rec = hit_triangle(verts[v0_i],
-                                         verts[v1_i],
-                                         verts[v2_i],
-                                         r, t_min, t_max)
+    m = meshes[ti.cast(mesh_index, ti.i32)]
+    if m.end_index > m.start_index:
+        if ti.static(BVH_LAYOUT == 'LINEAR'):
+            closest, rec = hit_linear(m, r, t_min, t_max, closest, rec, any_hit)
+        else:
+            closest, rec = hit_bvh(m, r, t_min, t_max, closest, rec, any_hit)
 
-        if hit_tri:
-            hit_anything = True
-            material_id = mat_indices[i]
-            rec = temp_rec
-            t_max = rec.t
-            set_face_normal(r, rec.normal, rec)
-
-        i += 1
+    if closest >= 0:
+        hit_anything = True
+        material_id = ti.cast(mat_indices[closest], ti.i32)
 
     return hit_anything, rec, material_id
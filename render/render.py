@@ -1,19 +1,37 @@
 import taichi as ti
+from . import bvh
 from . import camera
 from . import integrator
 from . import instance
 from . import mesh
 from . import material
+from . import light
+from . import sampler
+from . import denoise
+from . import stats
 from .vector import *
 from .ray import Ray
+from .hit_record import HitRecord
+from .sync import place_fields, destroy_tree
 import numpy as np
+import time
 
 
-InFlightRay = ti.types.struct(depth=ti.i32, ray=Ray, throughput=Vector4)
+# a path being traced, with the light it gathered so far and the pdf of its ray's direction
+InFlightRay = ti.types.struct(depth=ti.i32, ray=Ray, throughput=Vector4, radiance=Vector4, bsdf_pdf=ti.f32)
 
+# closest hit of a queued ray in wavefront mode
+QueuedHit = ti.types.struct(hit=ti.i32, rec=HitRecord, mat_id=ti.i32)
 
-# Taichi data node
-DATA = None
+
+# the SNodeTrees the per pixel state of a tile and the rest of the render state are placed in
+pixel_tree = None
+state_tree = None
+# the ti.init arguments taichi was last started with
+init_arguments = None
+
+# the backends taichi can be started on by name
+ARCHS = {'cpu': ti.cpu, 'gpu': ti.gpu, 'cuda': ti.cuda, 'vulkan': ti.vulkan, 'metal': ti.metal}
 
 
 # render constants
@@ -21,50 +39,361 @@ NUM_SAMPLES = 64
 MAX_DEPTH = 8
 WIDTH = 512
 HEIGHT = 512
-_inited = False
 
+# 'MEGAKERNEL' traces every pixel in one kernel, 'WAVEFRONT' traces queues of active rays with a kernel per stage
+RENDER_MODE = 'MEGAKERNEL'
+
+# adaptive sampling stops pixels after MIN_SAMPLES when their relative error is below NOISE_THRESHOLD
+# (0 renders all samples of every pixel)
+NOISE_THRESHOLD = 0.0
+# the denoiser filters the whole image once every tile is done, using the pixels' variance
+DENOISING = False
+MIN_SAMPLES = 16
+
+# the per pixel state is kept for one tile of the image at a time
+TILE_WIDTH = 512
+TILE_HEIGHT = 512
+# the (x, y, width, height) of the tile being rendered
+TILE = (0, 0, 512, 512)
+# the per pixel state is laid out in square blocks of this many pixels per side (0 lays out whole columns),
+# the pixels of a block are next to each other in memory and the CPU backend traces them on the same thread
+PIXEL_BLOCK = 0
+
+# kinds of extra passes the render kernels write, unknown passes are filled with 1
+UNKNOWN_PASS, DEPTH_PASS, NORMAL_PASS, ALBEDO_PASS, OBJECT_INDEX_PASS, MATERIAL_INDEX_PASS, EMISSION_PASS = range(7)
+# the kind of each Blender pass name
+AOV_PASSES = {'Depth': DEPTH_PASS, 'Normal': NORMAL_PASS, 'DiffCol': ALBEDO_PASS,
+              'IndexOB': OBJECT_INDEX_PASS, 'IndexMA': MATERIAL_INDEX_PASS, 'Emit': EMISSION_PASS}
+# most extra passes the output can have
+MAX_PASSES = 64
+# depth of rays that don't hit anything
+MISS_DEPTH = 1e10
+
+# (name, channels) of the extra passes written after the combined pass in the output
+AUX_PASSES = []
+
+# if the kernels have run since setup_render, the first pass compiles them
+compiled = False
 
-def setup_render(exported_scene, width, height, samples, max_depth):
-    print('call setup')
-    global _inited
-    if not _inited:
-        ti.init(arch=ti.gpu)
-        _inited = True
 
-    ''' Creates taichi data fields from numpy arrays exported from Blender '''
+def setup_render(exported_scene, width, height, samples, max_depth, render_mode='MEGAKERNEL',
+                 noise_threshold=0.0, min_samples=16, tile_size=0, light_sampling=True, sampler_type='SOBOL',
+                 roulette_depth=3, denoising=False, seed=0, first_sample=0, cpu_threads=0, arch=ti.gpu,
+                 offline_cache=True, offline_cache_directory='', pixel_block=0):
+    ''' Creates taichi data fields from numpy arrays exported from Blender
+        Pixels take the samples from first_sample on of their sample sequence, which is scrambled by seed,
+        so renders of disjoint sample ranges can be added together. cpu_threads of 0 uses every core
+        The offline cache keeps compiled kernels on disk (in taichi's default directory if none is given),
+        they are loaded back for renders with the same settings of a scene with the same sizes of data
+        pixel_block lays the pixels out in blocks, so the rays of the pixels a thread traces together are
+        coherent and hit the same parts of the scene
+    '''
+    # taichi is only started again for another backend, the fields of the last scene are freed instead and kernels
+    # are compiled again for the new ones (or loaded from the offline cache)
+    # the random sampler's numbers differ for each sample range as well as each seed
+    global init_arguments
+    arguments = {'arch': arch, 'random_seed': seed + first_sample, 'offline_cache': offline_cache}
+    if cpu_threads > 0:
+        arguments['cpu_max_num_threads'] = cpu_threads
+    if offline_cache_directory:
+        arguments['offline_cache_file_path'] = offline_cache_directory
+    clear_data()
+    if arguments != init_arguments:
+        ti.init(**arguments)
+        init_arguments = arguments
+    stats.setup_data()
+    t = time.time()
+
+    bvh.set_stack_size(max(exported_scene.meshes.stack_size, exported_scene.instances.stack_size))
     camera.setup_data(exported_scene.camera)
     mesh.setup_data(exported_scene.meshes)
     material.setup_data(exported_scene.materials)
     instance.setup_data(exported_scene.instances)
-
-    # setup the pixel buffer and inflight rays
-    global DATA, pixel_buffer, sample_count, rays_in_flight
-    
-    if DATA is None:
-        # framebuffer RGBA
-        pixel_buffer = ti.Vector.field(n=4, dtype=ti.f32)
-        # sample counts for each pixel
-        sample_count = ti.field(dtype=ti.i32)
-        # rays in flight
-        rays_in_flight = InFlightRay.field()
-
-        DATA = ti.root.dense(ti.ij, (width, height))
-        DATA.place(pixel_buffer, sample_count, rays_in_flight)
-
-    pixel_buffer.from_numpy(np.zeros((width, height, 4), dtype=np.float32))
-    sample_count.from_numpy(np.zeros((width, height), dtype=np.int32))
-    rays_in_flight.depth.from_numpy(np.zeros((width, height), dtype=np.int32))
+    light.setup_data(exported_scene.lights)
+    integrator.LIGHT_SAMPLING = light_sampling
+    integrator.ROULETTE_DEPTH = roulette_depth
+    sampler.setup_data(sampler_type, seed)
 
     # constants
-    global NUM_SAMPLES, MAX_DEPTH, WIDTH, HEIGHT
+    global NUM_SAMPLES, MAX_DEPTH, WIDTH, HEIGHT, NOISE_THRESHOLD, MIN_SAMPLES, TILE_WIDTH, TILE_HEIGHT, DENOISING
+    global PIXEL_BLOCK
     NUM_SAMPLES = samples
     MAX_DEPTH = max_depth
     WIDTH = width
     HEIGHT = height
+    NOISE_THRESHOLD = noise_threshold
+    # the error estimate needs at least 2 samples
+    MIN_SAMPLES = max(min_samples, 2)
+    # a tile size of 0 renders the whole image as one tile
+    TILE_WIDTH = width if tile_size <= 0 else min(tile_size, width)
+    TILE_HEIGHT = height if tile_size <= 0 else min(tile_size, height)
+    DENOISING = denoising
+    PIXEL_BLOCK = max(pixel_block, 0)
+    if denoising:
+        denoise.setup_data(width, height)
+
+    # setup the pixel buffer and inflight rays for a tile
+    global pixel_tree, pixel_buffer, sample_count, rays_in_flight, sample_moment, converged, finished_pixels
+    global aov_depth, aov_normal, aov_albedo, aov_object, aov_material, aov_emission
+    # framebuffer RGBA
+    pixel_buffer = ti.Vector.field(n=4, dtype=ti.f32)
+    # sample counts for each pixel
+    sample_count = ti.field(dtype=ti.i32)
+    # rays in flight
+    rays_in_flight = InFlightRay.field()
+    # sum of the squared luminance of the samples and if the pixel stopped early for adaptive sampling
+    sample_moment = ti.field(dtype=ti.f32)
+    converged = ti.field(dtype=ti.i32)
+    # extra passes from the camera ray hits, normal, albedo and emission are summed over the samples
+    # depth and the indices come from the first sample, as averages of them would fall between objects
+    aov_depth = ti.field(dtype=ti.f32)
+    aov_normal = Vector.field()
+    aov_albedo = Vector.field()
+    aov_object = ti.field(dtype=ti.f32)
+    aov_material = ti.field(dtype=ti.f32)
+    aov_emission = Vector.field()
+
+    # number of pixels that have finished sampling
+    global finished_pixels
+    finished_pixels = ti.field(dtype=ti.i32)
+    # index in the pixels' sample sequences of their first sample
+    global sample_offset
+    sample_offset = ti.field(dtype=ti.i32)
+    # position in the image and size of the tile being rendered
+    global tile_origin, tile_extent
+    tile_origin = ti.Vector.field(2, dtype=ti.i32)
+    tile_extent = ti.Vector.field(2, dtype=ti.i32)
+    # pixels per side of the blocks of the tile traced as one pixel, for quick low resolution previews
+    global pixel_step
+    pixel_step = ti.field(dtype=ti.i32)
+    # the kind of each extra pass of the output, the channels and the channel it starts at
+    global pass_kind, pass_channels, pass_offset
+    pass_kind = ti.field(dtype=ti.i32)
+    pass_channels = ti.field(dtype=ti.i32)
+    pass_offset = ti.field(dtype=ti.i32)
+
+    # queues of pixels for wavefront mode
+    global RENDER_MODE, ray_queue, hit_queue, done_queue, queue_length, done_length, state_tree
+    RENDER_MODE = render_mode
+    placements = [((), finished_pixels, sample_offset, tile_origin, tile_extent, pixel_step),
+                  (MAX_PASSES, pass_kind, pass_channels, pass_offset)]
+    if RENDER_MODE == 'WAVEFRONT':
+        ray_queue = ti.field(dtype=ti.i32)
+        hit_queue = QueuedHit.field()
+        done_queue = ti.field(dtype=ti.i32)
+        queue_length = ti.field(dtype=ti.i32)
+        done_length = ti.field(dtype=ti.i32)
+        placements += [(TILE_WIDTH * TILE_HEIGHT, ray_queue, hit_queue, done_queue),
+                       ((), queue_length, done_length)]
+
+    state_tree = place_fields(*placements)
+
+    builder = ti.FieldsBuilder()
+    if PIXEL_BLOCK > 0:
+        # the blocks cover the tile, pixels past its edge are skipped like those of edge tiles
+        node = builder.dense(ti.ij, ((TILE_WIDTH + PIXEL_BLOCK - 1) // PIXEL_BLOCK,
+                                     (TILE_HEIGHT + PIXEL_BLOCK - 1) // PIXEL_BLOCK))
+        node = node.dense(ti.ij, (PIXEL_BLOCK, PIXEL_BLOCK))
+    else:
+        node = builder.dense(ti.ij, (TILE_WIDTH, TILE_HEIGHT))
+    node.place(pixel_buffer, sample_count, rays_in_flight, sample_moment, converged,
+               aov_depth, aov_normal, aov_albedo, aov_object, aov_material, aov_emission)
+    pixel_tree = builder.finalize()
+    sample_offset[None] = first_sample
+    pixel_step[None] = 1
+
+    set_tile(*get_tiles()[0])
+    global compiled
+    compiled = False
+    stats.add_time('upload', time.time() - t)
+
+
+def update_render(exported_scene):
+    ''' Uploads the changes of a synced scene to the existing fields and restarts the render
+        returns the number of bytes uploaded
+    '''
+    t = time.time()
+    camera.update_data(exported_scene.camera)
+    uploaded = mesh.update_data(exported_scene.meshes)
+    uploaded += instance.update_data(exported_scene.instances)
+    uploaded += material.update_data(exported_scene.materials)
+    uploaded += light.update_data(exported_scene.lights)
+    reset_accumulation()
+    stats.add_time('upload', time.time() - t)
+    return uploaded
+
+
+def update_camera(exported_camera):
+    ''' Uploads just a moved camera and restarts the render, leaving the scene data as it is '''
+    t = time.time()
+    camera.update_data(exported_camera)
+    reset_accumulation()
+    stats.add_time('upload', time.time() - t)
+
+
+def reset_accumulation():
+    ''' Clears the pixel buffer and starts every pixel on a new sample '''
+    pixel_buffer.fill(0.0)
+    sample_count.fill(0)
+    rays_in_flight.depth.fill(0)
+    sample_moment.fill(0.0)
+    converged.fill(0)
+    finished_pixels.fill(0)
+    aov_depth.fill(0.0)
+    aov_normal.fill(0.0)
+    aov_albedo.fill(0.0)
+    aov_object.fill(0.0)
+    aov_material.fill(0.0)
+    aov_emission.fill(0.0)
+
+
+def get_tiles():
+    ''' Returns the (x, y, width, height) of the tiles covering the image '''
+    return [(x, y, min(TILE_WIDTH, WIDTH - x), min(TILE_HEIGHT, HEIGHT - y))
+            for y in range(0, HEIGHT, TILE_HEIGHT) for x in range(0, WIDTH, TILE_WIDTH)]
+
+
+def set_tile(x, y, width, height):
+    ''' Starts rendering the tile of the image at x, y '''
+    global TILE
+    TILE = (x, y, width, height)
+    tile_origin[None] = [x, y]
+    tile_extent[None] = [width, height]
+    reset_accumulation()
+
+
+def set_pixel_step(step):
+    ''' Starts the render over tracing only the first pixel of each step x step block of pixels,
+        which resolves to the whole block, 1 renders every pixel
+    '''
+    pixel_step[None] = step
+    reset_accumulation()
+
+
+def get_finished_pixels():
+    ''' Returns the number of pixels of the tile that have all their samples or converged '''
+    return finished_pixels[None]
+
+
+@ti.func
+def is_in_tile(i, j):
+    ''' If a pixel is part of the tile, edge tiles don't use all the pixel buffer '''
+    return i < tile_extent[None].x and j < tile_extent[None].y
+
+
+@ti.func
+def is_rendering(i, j):
+    ''' If a pixel of the tile still needs samples '''
+    step = pixel_step[None]
+    return is_in_tile(i, j) and sample_count[i, j] < NUM_SAMPLES and converged[i, j] == 0 and \
+        i % step == 0 and j % step == 0
+
+
+@ti.func
+def pixel_error(i, j):
+    ''' Relative standard error of the mean luminance of a pixel '''
+    n = ti.cast(sample_count[i, j], ti.f32)
+    mean = luminance(pixel_buffer[i, j]) / n
+    variance = ti.max(sample_moment[i, j] / n - mean * mean, 0.0) * n / (n - 1.0)
+    return ti.sqrt(variance / n) / (mean + 0.001)
+
+
+@ti.func
+def add_sample(i, j, color):
+    ''' Adds the color of a finished path to a pixel and checks if the pixel is finished '''
+    pixel_buffer[i, j] += color
+    sample_count[i, j] += 1
+    n = sample_count[i, j]
+
+    if n == NUM_SAMPLES:
+        finished_pixels[None] += 1
+    if ti.static(NOISE_THRESHOLD > 0.0 or DENOISING):
+        sample_moment[i, j] += luminance(color) ** 2
+    if ti.static(NOISE_THRESHOLD > 0.0):
+        if n >= MIN_SAMPLES and n < NUM_SAMPLES and pixel_error(i, j) < NOISE_THRESHOLD:
+            converged[i, j] = 1
+            finished_pixels[None] += 1
+
+
+@ti.func
+def record_aovs(i, j, r, hit, rec, mat_id):
+    ''' Adds the closest hit of a camera ray to the extra passes '''
+    if hit:
+        aov_normal[i, j] += rec.normal
+        aov_albedo[i, j] += material.get_color(mat_id).xyz
+        aov_emission[i, j] += material.get_emission(mat_id, r, rec).xyz
+    if sample_count[i, j] == 0:
+        aov_depth[i, j] = MISS_DEPTH
+        aov_object[i, j] = 0.0
+        aov_material[i, j] = 0.0
+        if hit:
+            aov_depth[i, j] = camera.get_depth(rec.p)
+            aov_object[i, j] = ti.cast(instance.get_pass_index(rec.instance_id), ti.f32)
+            aov_material[i, j] = ti.cast(material.get_pass_index(mat_id), ti.f32)
+
+
+@ti.func
+def get_path_sample(i, j, dimension):
+    ''' The sampler state of the path a pixel of the tile is tracing, from the given dimension on '''
+    return sampler.PathSample(seed=sampler.pixel_seed(tile_origin[None].x + i, tile_origin[None].y + j),
+                              index=ti.cast(sample_offset[None] + sample_count[i, j], ti.u32), dimension=dimension)
+
+
+@ti.func
+def get_camera_ray(i, j):
+    ''' A new camera ray through a jittered point of a pixel of the tile, or of its block of pixels '''
+    u = sampler.get_4d(get_path_sample(i, j, ti.cast(0, ti.u32)), sampler.CAMERA_DIMENSION)
+    step = pixel_step[None]
+    s = (tile_origin[None].x + i + u[0] * step) / (WIDTH - 1)
+    t = (tile_origin[None].y + j + u[1] * step) / (HEIGHT - 1)
+    return camera.get_ray(s, t, u[2])
+
+
+def render_pass():
+    ''' render one ray bounce for every pixel still rendering
+        RETURNS num samples completed
+    '''
+    global compiled
+    t = time.time()
+    compile_start = 0.0 if compiled else get_compile_seconds()
+    if RENDER_MODE == 'WAVEFRONT':
+        samples_done = wavefront_pass()
+    else:
+        samples_done = megakernel_pass()
+    if compiled:
+        stats.add_time('kernel', time.time() - t)
+    else:
+        # the first pass compiles the kernels, or loads them from the offline cache
+        compile_seconds = compile_seconds_since(compile_start, t)
+        stats.add_time('compile', compile_seconds)
+        stats.add_time('load', time.time() - t - compile_seconds)
+        compiled = True
+    stats.gather()
+    return samples_done
+
+
+def get_compile_seconds():
+    ''' Seconds taichi has spent compiling kernels since it started, loading them from the offline cache
+        doesn't count. None if this taichi version doesn't count them, it's not part of its public API
+    '''
+    prog = ti.lang.impl.get_runtime().prog
+    if not hasattr(prog, 'get_total_compilation_time'):
+        return None
+    return prog.get_total_compilation_time()
+
+
+def compile_seconds_since(compile_start, t):
+    ''' Seconds spent compiling since get_compile_seconds returned compile_start at time t,
+        all the time since t if taichi doesn't count them
+    '''
+    compile_seconds = get_compile_seconds()
+    if compile_seconds is None or compile_start is None:
+        return time.time() - t
+    return compile_seconds - compile_start
 
 
 @ti.kernel
-def render_pass() -> ti.i32:
+def megakernel_pass() -> ti.i32:
     ''' render one ray bounce for every pixel in the image
         for each pixel in the image we
             1.  Check if it needs a new camera ray
@@ -75,7 +404,7 @@ def render_pass() -> ti.i32:
     '''
     samples_done = 0
     for i, j in pixel_buffer:
-        if sample_count[i, j] == NUM_SAMPLES:
+        if not is_rendering(i, j):
             # skip this pixel
             continue
 
@@ -83,49 +412,252 @@ def render_pass() -> ti.i32:
         ray = inflight.ray
         depth = inflight.depth
         throughput = inflight.throughput
+        radiance = inflight.radiance
+        bsdf_pdf = inflight.bsdf_pdf
 
         if depth == 0:
             # add a new ray for pixel that needs new one
-            s = (i + ti.random()) / (WIDTH - 1)
-            t = (j + ti.random()) / (HEIGHT - 1)
-            ray = camera.get_ray(s, t)
+            ray = get_camera_ray(i, j)
             depth = MAX_DEPTH
             throughput = Vector4(1.0)
+            radiance = Vector4(0.0)
+            bsdf_pdf = 0.0
 
-        # integrate one bounce along path
-        ray, throughput, ray_stop = integrator.trace_ray(ray, throughput, Vector4(0.0))
+        # integrate one bounce along path, the camera ray's hit goes in the extra passes
+        hit, rec, mat_id = integrator.closest_hit(ray)
+        if depth == MAX_DEPTH:
+            record_aovs(i, j, ray, hit, rec, mat_id)
+        ray, throughput, radiance, bsdf_pdf, ray_stop = \
+            integrator.shade(ray, throughput, radiance, bsdf_pdf, Vector4(0.0), hit, rec, mat_id,
+                             MAX_DEPTH - depth, depth == 1,
+                             get_path_sample(i, j, sampler.bounce_dimension(MAX_DEPTH - depth)))
         depth -= 1
 
         # reset inflight for this pixel if stopped
         if ray_stop or depth == 0:
             # somewhat hack to set alpha to 1 if more than one bounce in
             if MAX_DEPTH - inflight.depth > 0:
-                throughput.w = 1.0
+                radiance.w = 1.0
+
+            if not ray_stop:
+                stats.count(stats.STOPPED_DEPTH)
 
             # add accumulated color to pixel
-            pixel_buffer[i, j] += throughput
-            sample_count[i, j] += 1
+            add_sample(i, j, radiance)
             samples_done += 1
             depth = 0
 
-        rays_in_flight[i, j] = InFlightRay(depth=depth, ray=ray, throughput=throughput)
+        rays_in_flight[i, j] = InFlightRay(depth=depth, ray=ray, throughput=throughput, radiance=radiance,
+                                           bsdf_pdf=bsdf_pdf)
+
+    return samples_done
+
+
+def wavefront_pass():
+    ''' render one ray bounce for every pixel still rendering as separate kernels
+        over a queue of just the active rays
+    '''
+    generate_rays()
+    extend_rays()
+    shade_rays()
+    return accumulate_samples()
+
+
+@ti.kernel
+def generate_rays():
+    ''' Starts a new camera ray for pixels that finished a sample and queues all pixels still rendering '''
+    queue_length[None] = 0
+    done_length[None] = 0
+    for i, j in pixel_buffer:
+        if is_rendering(i, j):
+            if rays_in_flight[i, j].depth == 0:
+                rays_in_flight[i, j] = InFlightRay(depth=MAX_DEPTH, ray=get_camera_ray(i, j),
+                                                   throughput=Vector4(1.0), radiance=Vector4(0.0), bsdf_pdf=0.0)
+            ray_queue[ti.atomic_add(queue_length[None], 1)] = i * TILE_HEIGHT + j
+
+
+@ti.kernel
+def extend_rays():
+    ''' Finds the closest hit of each queued ray '''
+    for k in range(queue_length[None]):
+        pixel = ray_queue[k]
+        hit, rec, mat_id = integrator.closest_hit(rays_in_flight[pixel // TILE_HEIGHT, pixel % TILE_HEIGHT].ray)
+        hit_queue[k] = QueuedHit(hit=hit, rec=rec, mat_id=mat_id)
+
+
+@ti.kernel
+def shade_rays():
+    ''' Shades the hit of each queued ray and queues the paths that stopped to be accumulated '''
+    for k in range(queue_length[None]):
+        pixel = ray_queue[k]
+        i, j = pixel // TILE_HEIGHT, pixel % TILE_HEIGHT
+        inflight = rays_in_flight[i, j]
+        queued_hit = hit_queue[k]
+        if inflight.depth == MAX_DEPTH:
+            record_aovs(i, j, inflight.ray, queued_hit.hit, queued_hit.rec, queued_hit.mat_id)
+
+        ray, throughput, radiance, bsdf_pdf, ray_stop = \
+            integrator.shade(inflight.ray, inflight.throughput, inflight.radiance, inflight.bsdf_pdf, Vector4(0.0),
+                             queued_hit.hit, queued_hit.rec, queued_hit.mat_id,
+                             MAX_DEPTH - inflight.depth, inflight.depth == 1,
+                             get_path_sample(i, j, sampler.bounce_dimension(MAX_DEPTH - inflight.depth)))
+        depth = inflight.depth - 1
+        if ray_stop or depth == 0:
+            if not ray_stop:
+                stats.count(stats.STOPPED_DEPTH)
+            # alpha is 1 as in the megakernel
+            radiance.w = 1.0
+            depth = 0
+            done_queue[ti.atomic_add(done_length[None], 1)] = pixel
+
+        rays_in_flight[i, j] = InFlightRay(depth=depth, ray=ray, throughput=throughput, radiance=radiance,
+                                           bsdf_pdf=bsdf_pdf)
 
+
+@ti.kernel
+def accumulate_samples() -> ti.i32:
+    ''' Adds the color of each stopped path to its pixel '''
+    samples_done = 0
+    for k in range(done_length[None]):
+        pixel = done_queue[k]
+        i, j = pixel // TILE_HEIGHT, pixel % TILE_HEIGHT
+        add_sample(i, j, rays_in_flight[i, j].radiance)
+        samples_done += 1
     return samples_done
 
 
+@ti.func
+def get_aov(kind, i, j, n):
+    ''' The value of an extra pass at a pixel with n samples '''
+    value = Vector4(1.0)
+    if kind == DEPTH_PASS:
+        value = Vector4(aov_depth[i, j])
+    elif kind == NORMAL_PASS:
+        normal = aov_normal[i, j] / n
+        value = Vector4(normal.x, normal.y, normal.z, 1.0)
+    elif kind == ALBEDO_PASS:
+        albedo = aov_albedo[i, j] / n
+        value = Vector4(albedo.x, albedo.y, albedo.z, 1.0)
+    elif kind == EMISSION_PASS:
+        emission = aov_emission[i, j] / n
+        value = Vector4(emission.x, emission.y, emission.z, 1.0)
+    elif kind == OBJECT_INDEX_PASS:
+        value = Vector4(aov_object[i, j])
+    elif kind == MATERIAL_INDEX_PASS:
+        value = Vector4(aov_material[i, j])
+    return value
+
+
+@ti.kernel
+def resolve(out: ti.types.ndarray(), width: ti.i32, height: ti.i32, num_passes: ti.i32):
+    ''' Writes the tile divided by the sample counts to out as rows of RGBA pixels,
+        followed by the rows of each extra pass, pixels of blocks traced as one get the block's value
+    '''
+    step = pixel_step[None]
+    for i, j in pixel_buffer:
+        if is_in_tile(i, j):
+            pixel = j * width + i
+            x, y = i - i % step, j - j % step
+            n = ti.max(sample_count[x, y], 1)
+            color = pixel_buffer[x, y] / n
+            for c in ti.static(range(4)):
+                out[pixel * 4 + c] = color[c]
+
+            for p in range(num_passes):
+                value = get_aov(pass_kind[p], x, y, n)
+                channels = pass_channels[p]
+                start = width * height * pass_offset[p] + pixel * channels
+                for c in ti.static(range(4)):
+                    if c < channels:
+                        out[start + c] = value[c]
+
+
+def setup_output(aux_passes):
+    ''' Allocates the output array the tiles are resolved to for the (name, channels) of the extra passes,
+        the combined pass followed by the extra passes like Blender lays out the passes of a result
+    '''
+    global AUX_PASSES, output
+    AUX_PASSES = list(aux_passes)[:MAX_PASSES]
+    offset = 4
+    for p, (name, channels) in enumerate(AUX_PASSES):
+        pass_kind[p] = AOV_PASSES.get(name, UNKNOWN_PASS)
+        pass_channels[p] = channels
+        pass_offset[p] = offset
+        offset += channels
+    output = np.ones(TILE_WIDTH * TILE_HEIGHT * offset, dtype=np.float32)
+
+
+def get_output():
+    ''' Resolves the tile into the output array and returns the part of it the tile's passes use '''
+    t = time.time()
+    x, y, width, height = TILE
+    resolve(output, width, height, len(AUX_PASSES))
+    stats.add_time('readback', time.time() - t)
+    return output[:width * height * (4 + sum(channels for name, channels in AUX_PASSES))]
+
+
 def get_buffer():
-    # get the framebuffer and divide by sample count
-    buffer = pixel_buffer.to_numpy() / sample_count.to_numpy()[:, :, None]
-    return buffer.swapaxes(0, 1).reshape((HEIGHT * WIDTH, 4))
+    # get the framebuffer of the tile divided by sample count
+    x, y, width, height = TILE
+    t = time.time()
+    buffer = np.empty(width * height * 4, dtype=np.float32)
+    resolve(buffer, width, height, 0)
+    stats.add_time('readback', time.time() - t)
+    return buffer.reshape((height * width, 4))
+
+
+def get_accumulation():
+    ''' The sums of the samples of the tile's pixels and their sample counts, as (height, width) rows of pixels,
+        renders of disjoint sample ranges are merged by adding these
+    '''
+    t = time.time()
+    x, y, width, height = TILE
+    pixel_sum = pixel_buffer.to_numpy()[:width, :height].swapaxes(0, 1)
+    count = sample_count.to_numpy()[:width, :height].swapaxes(0, 1)
+    stats.add_time('readback', time.time() - t)
+    return pixel_sum, count
+
+
+@ti.kernel
+def store_denoise_tile():
+    ''' Copies the tile divided by the sample counts, the variance of its luminance and its albedo, normal and
+        emission to the image the denoiser filters
+    '''
+    for i, j in pixel_buffer:
+        if is_in_tile(i, j):
+            n = ti.cast(ti.max(sample_count[i, j], 1), ti.f32)
+            x, y = tile_origin[None].x + i, tile_origin[None].y + j
+            mean = pixel_buffer[i, j] / n
+            denoise.color[x, y] = mean
+            variance = ti.max(sample_moment[i, j] / n - luminance(mean) ** 2, 0.0)
+            denoise.variance[0, x, y] = variance / ti.max(n - 1.0, 1.0)
+            denoise.albedo[x, y] = aov_albedo[i, j] / n
+            denoise.normal[x, y] = aov_normal[i, j] / n
+            denoise.emission[x, y] = aov_emission[i, j] / n
+
+
+def denoise_image(iterations=3):
+    ''' Filters the noise of the image stored from every tile '''
+    t = time.time()
+    denoise.denoise(iterations)
+    stats.add_time('kernel', time.time() - t)
+
+
+def get_denoised_tile(x, y, width, height):
+    ''' The denoised RGBA of a tile as rows of pixels, the layout of the combined pass in the output '''
+    return denoise.get_tile(x, y, width, height)
 
 
 def clear_data():
-    DATA = None
+    global pixel_tree, state_tree
+    destroy_tree(pixel_tree)
+    destroy_tree(state_tree)
+    pixel_tree = state_tree = None
+    camera.clear_data()
     mesh.clear_data()
     instance.clear_data()
     material.clear_data()
-
-
-def set_camera_from_matrix(self, cam_matrix, cam_angle):
-    # Create a camera from a matrix for the viewport
-    self.camera = Camera(None, self.image_width, self.image_height, cam_matrix, cam_angle)
+    light.clear_data()
+    sampler.clear_data()
+    denoise.clear_data()
+    stats.clear_data()
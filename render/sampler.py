@@ -0,0 +1,157 @@
+import taichi as ti
+from .vector import *
+import numpy as np
+from .sync import place_fields, destroy_tree
+
+
+# 'RANDOM' draws independent random numbers, 'SOBOL' draws Owen scrambled Sobol points
+# (shuffled and scrambled per pixel and dimension, following Burley's "Practical Hash-based Owen Scrambling")
+SAMPLER = 'SOBOL'
+
+# a path uses 4D points, one for the camera ray then one each for the material and light sample of every bounce
+CAMERA_DIMENSION = 0
+MATERIAL_DIMENSION = 0
+LIGHT_DIMENSION = 1
+DIMENSIONS_PER_BOUNCE = 2
+
+# the sample of a path, the pixel's seed, which sample of the pixel it is and the first dimension of its bounce
+PathSample = ti.types.struct(seed=ti.u32, index=ti.u32, dimension=ti.u32)
+
+
+def as_i32(x):
+    ''' A 32 bit constant as the signed int with the same bits, for use as a taichi literal '''
+    return x - (1 << 32) if x >= (1 << 31) else x
+
+
+# multipliers of the Laine-Karras style permutation
+PERMUTATION_CONSTANTS = [as_i32(x) for x in (0x6c50b47c, 0xb82f1e52, 0xc7afe638, 0x8d22f6e6)]
+HASH_CONSTANTS = [as_i32(x) for x in (0x7feb352d, 0x846ca68b)]
+GOLDEN_RATIO = as_i32(0x9e3779b9)
+
+# the SNodeTree the sampler fields are placed in
+tree = None
+
+
+def sobol_directions():
+    ''' Direction numbers of the first 4 Sobol dimensions (from Joe and Kuo) as 32 bit integers '''
+    # (degree, polynomial coefficients, initial direction numbers) of the dimensions after the first
+    polynomials = [(1, 0, [1]), (2, 1, [1, 3]), (3, 1, [1, 3, 1])]
+    directions = [[1 << (31 - b) for b in range(32)]]
+    for s, a, m in polynomials:
+        m = list(m)
+        for k in range(s, 32):
+            value = m[k - s] ^ (m[k - s] << s)
+            for l in range(1, s):
+                value ^= ((a >> (s - 1 - l)) & 1) * (m[k - l] << l)
+            m.append(value)
+        directions.append([m[b] << (31 - b) for b in range(32)])
+    return directions
+
+
+def setup_data(sampler, seed=0):
+    ''' Creates the Sobol direction number field and the seed every pixel's seed is mixed with '''
+    global SAMPLER, directions, scramble_seed, tree
+    SAMPLER = sampler
+    directions = ti.field(dtype=ti.u32)
+    scramble_seed = ti.field(dtype=ti.u32)
+    tree = place_fields(((4, 32), directions), ((), scramble_seed))
+    directions.from_numpy(np.array(sobol_directions(), dtype=np.uint32))
+    scramble_seed[None] = seed
+
+
+def clear_data():
+    global directions, scramble_seed, tree
+    destroy_tree(tree)
+    directions = scramble_seed = tree = None
+
+
+@ti.func
+def u32(x):
+    return ti.cast(x, ti.u32)
+
+
+@ti.func
+def hash(x):
+    ''' Mixes the bits of an unsigned int '''
+    x ^= x >> 16
+    x *= u32(ti.static(HASH_CONSTANTS[0]))
+    x ^= x >> 15
+    x *= u32(ti.static(HASH_CONSTANTS[1]))
+    x ^= x >> 16
+    return x
+
+
+@ti.func
+def hash_combine(seed, v):
+    return seed ^ (v + u32(GOLDEN_RATIO) + (seed << 6) + (seed >> 2))
+
+
+@ti.func
+def reverse_bits(x):
+    x = ((x >> 1) & u32(0x55555555)) | ((x & u32(0x55555555)) << 1)
+    x = ((x >> 2) & u32(0x33333333)) | ((x & u32(0x33333333)) << 2)
+    x = ((x >> 4) & u32(0x0F0F0F0F)) | ((x & u32(0x0F0F0F0F)) << 4)
+    x = ((x >> 8) & u32(0x00FF00FF)) | ((x & u32(0x00FF00FF)) << 8)
+    return (x >> 16) | (x << 16)
+
+
+@ti.func
+def nested_uniform_scramble(x, seed):
+    ''' Owen scrambles the bits of x, a permutation that only carries from low bits to high ones on reversed bits '''
+    x = reverse_bits(x)
+    x += seed
+    for k in ti.static(range(4)):
+        x ^= x * u32(ti.static(PERMUTATION_CONSTANTS[k]))
+    return reverse_bits(x)
+
+
+@ti.func
+def sobol(index, dimension):
+    x = u32(0)
+    b = 0
+    while index != 0:
+        if index & u32(1):
+            x ^= directions[dimension, b]
+        index >>= 1
+        b += 1
+    return x
+
+
+@ti.func
+def to_float(x):
+    # the top 24 bits so the result stays below 1
+    return ti.cast(x >> 8, ti.f32) * (1.0 / (1 << 24))
+
+
+@ti.func
+def sobol_4d(index, seed):
+    ''' A 4D point of the Sobol sequence shuffled and Owen scrambled by seed '''
+    index = nested_uniform_scramble(index, seed)
+    u = Vector4(0.0)
+    for d in ti.static(range(4)):
+        u[d] = to_float(nested_uniform_scramble(sobol(index, d), hash_combine(seed, u32(d))))
+    return u
+
+
+@ti.func
+def pixel_seed(x, y):
+    ''' The seed of the samples of an image pixel '''
+    return hash(hash_combine(hash_combine(hash(u32(x)), u32(y)), scramble_seed[None]))
+
+
+@ti.func
+def bounce_dimension(bounce):
+    ''' The first dimension of a bounce of a path, after the camera's '''
+    return u32(1 + bounce * DIMENSIONS_PER_BOUNCE)
+
+
+@ti.func
+def get_4d(path_sample, dimension):
+    ''' Returns 4 numbers in [0, 1) for a dimension of the path's current bounce '''
+    u = Vector4(0.0)
+    if ti.static(SAMPLER == 'SOBOL'):
+        seed = hash(hash_combine(path_sample.seed, path_sample.dimension + u32(dimension)))
+        u = sobol_4d(path_sample.index, seed)
+    else:
+        u = Vector4(ti.random(), ti.random(), ti.random(), ti.random())
+    return u
@@ -0,0 +1,98 @@
+import json
+import taichi as ti
+from .sync import place_fields, destroy_tree
+
+
+# Counters of the work the render kernels do and seconds spent in each phase of a render, for profiling.
+# The counters are atomic adds that are only compiled into the kernels when ENABLED is set before setup_render,
+# they are gathered from the kernels after every pass and kept as python ints so they don't overflow
+
+ENABLED = False
+
+# kinds of counters
+RAYS, SHADOW_RAYS, AABB_TESTS, TRIANGLE_TESTS, STOPPED_DEPTH, STOPPED_THROUGHPUT, STOPPED_MISS, STOPPED_LIGHT = \
+    range(8)
+COUNTER_NAMES = ['rays', 'shadow_rays', 'aabb_tests', 'triangle_tests',
+                 'paths_stopped_by_depth', 'paths_stopped_by_throughput', 'paths_missed', 'paths_hit_light']
+# phases of a render the seconds are added up for, the first pass is split into compiling kernels and the rest of
+# getting them ready (tracing the python, loading compiled kernels from the offline cache) with its render
+PHASES = ['export', 'upload', 'compile', 'load', 'kernel', 'readback']
+
+counters = None
+# the SNodeTree the counters are placed in
+tree = None
+totals = [0] * len(COUNTER_NAMES)
+seconds = dict.fromkeys(PHASES, 0.0)
+# seconds from moving the viewport camera to drawing the first pixels of the new view
+latencies = []
+
+
+def setup_data():
+    ''' Creates the counters the kernels add to and starts the counts and timings over '''
+    global counters, tree
+    # 64 bit, the box tests of a pass of a large image with many bounces overflow 32 bits
+    counters = ti.field(dtype=ti.i64)
+    tree = place_fields((len(COUNTER_NAMES), counters))
+    reset()
+
+
+def clear_data():
+    global counters, tree
+    destroy_tree(tree)
+    counters = tree = None
+
+
+def reset():
+    global totals, seconds, latencies
+    totals = [0] * len(COUNTER_NAMES)
+    seconds = dict.fromkeys(PHASES, 0.0)
+    latencies = []
+
+
+@ti.func
+def add(kind, n):
+    if ti.static(ENABLED):
+        ti.atomic_add(counters[kind], ti.cast(n, ti.i64))
+
+
+@ti.func
+def count(kind):
+    add(kind, 1)
+
+
+def add_time(phase, elapsed):
+    seconds[phase] += elapsed
+
+
+def add_latency(elapsed):
+    if ENABLED:
+        latencies.append(elapsed)
+
+
+def gather():
+    ''' Adds the kernels' counts to the totals and zeroes them, called after every pass so they can't overflow '''
+    if ENABLED:
+        for k, n in enumerate(counters.to_numpy()):
+            totals[k] += int(n)
+        counters.fill(0)
+
+
+def get_stats():
+    ''' The counts and timings since setup_render as a dict '''
+    stats = {'counters': dict(zip(COUNTER_NAMES, totals)), 'seconds': dict(seconds)}
+    rays = totals[RAYS] + totals[SHADOW_RAYS]
+    if rays > 0:
+        stats['per_ray'] = {'aabb_tests': totals[AABB_TESTS] / rays, 'triangle_tests': totals[TRIANGLE_TESTS] / rays}
+    if seconds['kernel'] > 0.0:
+        stats['rays_per_second'] = rays / seconds['kernel']
+    if latencies:
+        stats['viewport_latency'] = {'count': len(latencies), 'mean': sum(latencies) / len(latencies),
+                                     'max': max(latencies)}
+    return stats
+
+
+def save(path):
+    ''' Writes the stats as JSON '''
+    with open(path, 'w') as f:
+        json.dump(get_stats(), f, indent=2)
+        f.write('\n')
@@ -0,0 +1,53 @@
+import taichi as ti
+import numpy as np
+
+
+@ti.kernel
+def copy_rows(dst: ti.template(), src: ti.types.ndarray(), offset: ti.i32):
+    ''' Copies the rows of a numpy array into a field starting at row offset '''
+    for i in range(src.shape[0]):
+        if ti.static(isinstance(dst, ti.MatrixField)):
+            if ti.static(dst.ndim == 2):
+                for a in ti.static(range(dst.n)):
+                    for b in ti.static(range(dst.m)):
+                        dst[i + offset][a, b] = src[i, a, b]
+            else:
+                for a in ti.static(range(dst.n)):
+                    dst[i + offset][a] = src[i, a]
+        elif ti.static(len(dst.shape) == 2):
+            for a in ti.static(range(dst.shape[1])):
+                dst[i + offset, a] = src[i, a]
+        else:
+            dst[i + offset] = src[i]
+
+
+def upload_changes(fields, changes):
+    ''' Uploads a list of (array name, first row, rows) changes to the matching fields in place
+        returns the number of bytes uploaded
+    '''
+    uploaded = 0
+    for name, start, rows in changes:
+        rows = np.ascontiguousarray(rows)
+        if len(rows) > 0:
+            copy_rows(fields[name], rows, start)
+            uploaded += rows.nbytes
+    return uploaded
+
+
+def place_fields(*placements):
+    ''' Places fields in a new SNodeTree and returns it, each placement is a shape followed by the fields of that
+        shape (() for scalars). Destroying the tree frees the fields, so setup_render can give a new scene new fields
+        without starting taichi over
+    '''
+    builder = ti.FieldsBuilder()
+    for shape, *fields in placements:
+        shape = shape if isinstance(shape, tuple) else (shape,)
+        node = builder.dense(ti.axes(*range(len(shape))), shape) if len(shape) > 0 else builder
+        node.place(*fields)
+    return builder.finalize()
+
+
+def destroy_tree(tree):
+    ''' Frees the fields placed in a tree by place_fields, if there is one '''
+    if tree is not None:
+        tree.destroy()
@@ -10,10 +10,17 @@ Color = Vector
 Point = Vector
 
 EPS = 1e-8
+
+
+@ti.func
+def luminance(color):
+    return 0.2126 * color.x + 0.7152 * color.y + 0.0722 * color.z
+
+
 @ti.func
-def random_in_hemi_sphere(normal):
-    ''' Returns a random vector around a hemisphere centered on a normal'''
-    vec = random_unit_sphere()
+def random_in_hemi_sphere(normal, u):
+    ''' Returns a random vector around a hemisphere centered on a normal from 2 numbers in [0, 1) '''
+    vec = random_unit_sphere(u)
     if vec.dot(normal) <= 0.0:
         vec = -vec
 
@@ -21,12 +28,31 @@ def random_in_hemi_sphere(normal):
 
 
 @ti.func
-def random_unit_sphere():
-    a = ti.random() * math.tau
-    u = ti.Vector([ti.cos(a), ti.sin(a)])
-    s = ti.random() * 2.0 - 1.0
+def cosine_in_hemi_sphere(normal, u):
+    ''' Returns a vector around a hemisphere centered on a normal with density proportional to the cosine
+        to the normal, from 2 numbers in [0, 1)
+    '''
+    # orthonormal basis around the normal (Duff et al. 2017)
+    sign = 1.0 if normal.z >= 0.0 else -1.0
+    a = -1.0 / (sign + normal.z)
+    b = normal.x * normal.y * a
+    tangent = Vector([1.0 + sign * normal.x * normal.x * a, sign * b, -sign * normal.x])
+    bitangent = Vector([b, sign + normal.y * normal.y * a, -normal.y])
+
+    # point on the unit disk projected up to the hemisphere
+    r = ti.sqrt(u[0])
+    phi = u[1] * math.tau
+    x, y = r * ti.cos(phi), r * ti.sin(phi)
+    return tangent * x + bitangent * y + normal * ti.sqrt(ti.max(1.0 - u[0], 0.0))
+
+
+@ti.func
+def random_unit_sphere(u):
+    a = u[0] * math.tau
+    circle = ti.Vector([ti.cos(a), ti.sin(a)])
+    s = u[1] * 2.0 - 1.0
     c = ti.sqrt(1 - s**2)
-    cu = c * u
+    cu = c * circle
     return Vector([cu[0], cu[1], s])
 
 
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from . import render
+
+
+# Renders the viewport on a background thread so Blender stays responsive while it renders.
+# After the view changes the thread first traces one pixel of each block of pixels for every step in STEPS,
+# then refines to every pixel and keeps adding samples, keeping a copy of the latest finished image to draw.
+# Only the thread uses the render data while it runs, the view's camera is handed to it to upload
+
+# pixels per side of the blocks of each low resolution preview, largest first
+STEPS = (8, 4)
+
+# the renderer whose thread is running, only one can use the render data at a time
+current = None
+
+
+def stop_current():
+    ''' Stops the running viewport thread so the render data can be set up again '''
+    if current is not None:
+        current.stop()
+
+
+class ViewportRenderer:
+    ''' Renders the set up scene on a thread, progressively from low resolution to all the samples '''
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.stopping = False
+        # a camera waiting to be uploaded by the thread and when the view moved to it
+        self.camera = None
+        self.moved = None
+        # the latest finished image, counting up with each new one, and the seconds from moving to its first image
+        self.image = None
+        self.version = 0
+        self.latency = None
+        # if the thread has more to render, only changed under the lock
+        self.rendering = False
+
+    def start(self):
+        ''' Starts rendering from the lowest resolution again '''
+        global current
+        stop_current()
+        current = self
+        self.stopping = False
+        with self.lock:
+            self.rendering = True
+        self.wake.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Stops rendering once the current pass is done and waits for the thread '''
+        global current
+        if self.thread is not None:
+            self.stopping = True
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+        if current is self:
+            current = None
+
+    def set_camera(self, exported_camera):
+        ''' Has the thread upload a moved camera and start over from the lowest resolution,
+            the rest of the image of the old view isn't rendered
+        '''
+        with self.lock:
+            self.camera = exported_camera
+            self.moved = time.time()
+            self.rendering = True
+        self.wake.set()
+
+    def get_image(self):
+        ''' The latest finished (pixels, RGBA) image and its version '''
+        with self.lock:
+            return self.image, self.version
+
+    def needs_redraw(self, drawn_version):
+        ''' If the thread is still rendering or has an image newer than the drawn version '''
+        with self.lock:
+            return self.rendering or self.version != drawn_version
+
+    def get_blocks(self, step):
+        ''' Number of blocks of pixels traced as one at a step '''
+        return ((self.width + step - 1) // step) * ((self.height + step - 1) // step)
+
+    def run(self):
+        level = 0
+        samples_done = 0
+        render.set_pixel_step(STEPS[0] if STEPS else 1)
+        while not self.stopping:
+            with self.lock:
+                camera, self.camera = self.camera, None
+            if camera is not None:
+                render.update_camera(camera)
+                level = 0
+                samples_done = 0
+                render.set_pixel_step(STEPS[0] if STEPS else 1)
+
+            step = STEPS[level] if level < len(STEPS) else 1
+            if step == 1 and render.get_finished_pixels() >= self.width * self.height:
+                # every pixel has its samples, wait for the view to change
+                # (unless it changed since, set_camera has already set rendering again for it)
+                with self.lock:
+                    idle = self.camera is None
+                    if idle:
+                        self.rendering = False
+                if idle:
+                    self.wake.wait()
+                    self.wake.clear()
+                continue
+
+            samples_done += render.render_pass()
+            # a new image once every block has another sample or all the samples are done
+            finished = step == 1 and render.get_finished_pixels() >= self.width * self.height
+            if samples_done >= self.get_blocks(step) or finished:
+                image = render.get_buffer()
+                with self.lock:
+                    self.image = image
+                    self.version += 1
+                    if self.moved is not None and self.camera is None:
+                        self.latency = time.time() - self.moved
+                        self.moved = None
+                samples_done = 0
+                if step > 1:
+                    level += 1
+                    render.set_pixel_step(STEPS[level] if level < len(STEPS) else 1)
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from . import render
+from . import viewport
+
+
+# Compiles the render kernels of an exported scene on a background thread, so they are in taichi's offline cache
+# before the scene is rendered. The cache only has kernels compiled for the same settings and sizes of scene data,
+# so the warm up sets up and renders a pass of the scene itself with the settings of its render.
+# Setting up taichi again while it compiles would break the compile, so a render waits for it first
+
+# the running warm up thread, and the (compile, load) seconds of the last warm up
+thread = None
+seconds = None
+
+
+def start(exported_scene, width, height, samples, max_depth, **settings):
+    ''' Starts compiling the kernels of a render of the scene with the arguments of setup_render '''
+    global thread
+    wait()
+    # the render data can't be set up again while the viewport thread renders
+    viewport.stop_current()
+    thread = threading.Thread(target=run, args=(exported_scene, width, height, samples, max_depth),
+                              kwargs=settings, daemon=True)
+    thread.start()
+
+
+def running():
+    ''' If a warm up is still compiling '''
+    return thread is not None and thread.is_alive()
+
+
+def wait():
+    ''' Waits for a running warm up to finish '''
+    global thread
+    if thread is not None:
+        thread.join()
+        thread = None
+
+
+def run(exported_scene, width, height, samples, max_depth, **settings):
+    global seconds
+    t = time.time()
+    render.setup_render(exported_scene, width, height, samples, max_depth, **settings)
+    t_compile = time.time()
+    compile_start = render.get_compile_seconds()
+    render.render_pass()
+    # the kernels turning the accumulation into an image
+    render.setup_output([])
+    render.get_output()
+    if settings.get('denoising'):
+        render.store_denoise_tile()
+        render.denoise_image(1)
+    compile_seconds = render.compile_seconds_since(compile_start, t_compile)
+    seconds = compile_seconds, time.time() - t - compile_seconds
+    print("Kernel warm up compiled {:.2f}s, loaded {:.2f}s".format(*seconds))
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+try:
+    from ..export.scene import Scene
+except ImportError:
+    # run from the repo directory, where render and export are top level packages
+    from export.scene import Scene
+from . import render
+
+
+# Splits the samples of a render of a scene bundle over processes (or machines), each rendering a disjoint range
+# of every pixel's sample sequence and returning the raw sums of its samples and the sample counts.
+# Adding the sums and counts together gives the same image as rendering every sample in one process.
+
+
+def split_samples(samples, workers):
+    ''' The (first sample, samples) range of each worker '''
+    ranges = []
+    first = 0
+    for k in range(workers):
+        count = samples // workers + (1 if k < samples % workers else 0)
+        ranges.append((first, count))
+        first += count
+    return ranges
+
+
+def render_samples(bundle, resolution, first_sample, samples, bounces, seed=0, tile_size=0, cpu_threads=0,
+                   arch='gpu'):
+    ''' Renders a range of samples of a scene bundle, returns a dict of the (height, width, RGBA) sums of the
+        samples, the (height, width) sample counts and the seconds rendering took after compiling
+    '''
+    scene = Scene.load(bundle, resolution)
+    width, height = scene.resolution
+    render.setup_render(scene, width, height, samples, bounces, tile_size=tile_size, seed=seed,
+                        first_sample=first_sample, cpu_threads=cpu_threads, arch=render.ARCHS[arch])
+    # compile the kernels then start again
+    render.render_pass()
+    render.reset_accumulation()
+
+    pixel_sum = np.zeros((height, width, 4), dtype=np.float32)
+    sample_count = np.zeros((height, width), dtype=np.int32)
+    t = time.time()
+    for x, y, tile_width, tile_height in render.get_tiles():
+        render.set_tile(x, y, tile_width, tile_height)
+        while render.get_finished_pixels() < tile_width * tile_height:
+            render.render_pass()
+        tile_sum, tile_count = render.get_accumulation()
+        pixel_sum[y:y + tile_height, x:x + tile_width] = tile_sum
+        sample_count[y:y + tile_height, x:x + tile_width] = tile_count
+    return {'pixel_sum': pixel_sum, 'sample_count': sample_count, 'seconds': time.time() - t}
+
+
+def add(accumulations):
+    ''' Adds the sums and counts of renders of disjoint sample ranges into one accumulation '''
+    return {'pixel_sum': sum(a['pixel_sum'].astype(np.float64) for a in accumulations),
+            'sample_count': sum(a['sample_count'].astype(np.int64) for a in accumulations)}
+
+
+def merge(accumulations):
+    ''' Adds the sums and counts of renders of disjoint sample ranges, returns the (height, width, RGBA) image '''
+    accumulation = add(accumulations)
+    return (accumulation['pixel_sum'] / np.maximum(accumulation['sample_count'], 1)[:, :, None]).astype(np.float32)
+
+
+def save_accumulation(path, accumulation):
+    np.savez(path, pixel_sum=accumulation['pixel_sum'], sample_count=accumulation['sample_count'])
+
+
+def load_accumulation(path):
+    with np.load(path) as data:
+        return {'pixel_sum': data['pixel_sum'], 'sample_count': data['sample_count']}
+
+
+def _render_samples(args):
+    return render_samples(*args)
+
+
+def render_split(bundle, resolution, samples, bounces, workers, seed=0, tile_size=0, arch='cpu', first_sample=0):
+    ''' Renders a scene bundle with the samples from first_sample on split over worker processes sharing the cores,
+        returns the accumulation of each worker
+    '''
+    cpu_threads = max(os.cpu_count() // workers, 1)
+    jobs = [(bundle, resolution, first_sample + first, count, bounces, seed, tile_size, cpu_threads, arch)
+            for first, count in split_samples(samples, workers) if count > 0]
+    # taichi can't be forked once started, so the workers start new interpreters
+    with multiprocessing.get_context('spawn').Pool(len(jobs)) as pool:
+        return pool.map(_render_samples, jobs)
@@ -20,6 +20,36 @@ class RENDER_PT_properties(bpy.types.Panel):
         cycles_settings = context.scene.cycles
         self.layout.prop(cycles_settings, 'samples')
         self.layout.prop(cycles_settings, 'max_bounces')
+        settings = context.scene.bpr
+        self.layout.prop(settings, 'render_mode')
+        self.layout.prop(settings, 'sampler')
+        self.layout.prop(settings, 'use_light_sampling')
+        self.layout.prop(settings, 'use_russian_roulette')
+        col = self.layout.column()
+        col.enabled = settings.use_russian_roulette
+        col.prop(settings, 'roulette_depth')
+        self.layout.prop(settings, 'use_adaptive_sampling')
+        col = self.layout.column()
+        col.enabled = settings.use_adaptive_sampling
+        col.prop(settings, 'noise_threshold')
+        col.prop(settings, 'min_samples')
+        self.layout.prop(settings, 'use_denoising')
+        col = self.layout.column()
+        col.enabled = settings.use_denoising
+        col.prop(settings, 'denoise_iterations')
+        self.layout.prop(settings, 'use_tiles')
+        col = self.layout.column()
+        col.enabled = settings.use_tiles
+        col.prop(settings, 'tile_size')
+        self.layout.prop(settings, 'use_pixel_blocks')
+        col = self.layout.column()
+        col.enabled = settings.use_pixel_blocks
+        col.prop(settings, 'pixel_block_size')
+        self.layout.prop(settings, 'bundle_directory')
+        self.layout.prop(settings, 'use_render_stats')
+        col = self.layout.column()
+        col.enabled = settings.use_render_stats
+        col.prop(settings, 'stats_file')
 
 
 def register():